@@ -0,0 +1,365 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""asyncio Message Access Profile client implementation"""
+
+import asyncio
+import logging
+import os
+import socket
+import struct
+import sys
+
+import mapheaders as headers
+import mapresponses as responses
+
+from mapclient import (FRACTION_FIRST, FRACTION_NEXT, MAS_TARGET_UUID, FolderTree, MAPClient,
+                       MASClientBase, MessageFraction)
+from PyOBEX import requests
+from PyOBEX.common import OBEX_Version
+
+logger = logging.getLogger(__name__)
+
+
+class _PacketReader(object):
+    """Socket like access to an already received packet, lets the PyOBEX
+    response handlers decode it"""
+
+    def __init__(self, data):
+        self._data = data
+        self._offset = 0
+
+    def recv(self, size, flags=0):
+        chunk = self._data[self._offset:self._offset + size]
+        self._offset += len(chunk)
+        return chunk
+
+
+class AsyncMAPClient(MASClientBase):
+    """Message Access Profile Client for asyncio.
+
+    Offers the operations of MAPClient as coroutines. Operations on one
+    client are serialized, as OBEX allows only one operation at a time.
+    Cancelling an operation aborts it on the MSE (OBEX ABORT) before the
+    next operation is started, so the link stays usable.
+
+    sock_factory returns the unconnected socket to use, an RFCOMM socket by
+    default. Any stream socket works, e.g. TCP to a local MSE stand-in.
+    """
+
+    def __init__(self, address, port, sock_factory=None, message_cache=None):
+        self.address = address
+        self.port = port
+        self.sock_factory = sock_factory or self._rfcomm_socket
+        self.max_packet_length = 0xffff
+        self.obex_version = OBEX_Version()
+        self.response_handler = responses.ResponseHandler()
+        self.connection_id = None
+        self.remote_info = None
+        self.current_dir = "/"
+        self.folder_tree = FolderTree()
+        self.mas_instance_id = 0
+        self.message_cache = message_cache
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+        self._exchange_task = None  # send/receive of the running operation
+        self._recovery = None  # abort of a cancelled operation
+
+    @staticmethod
+    def _rfcomm_socket():
+        return socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
+
+    async def _open(self):
+        sock = self.sock_factory()
+        sock.setblocking(False)
+        try:
+            await asyncio.get_event_loop().sock_connect(sock, (self.address, self.port))
+        except BaseException:
+            sock.close()
+            raise
+        self._reader, self._writer = await asyncio.open_connection(sock=sock)
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def _send_and_receive(self, request):
+        self._writer.write(request.encode())
+        await self._writer.drain()
+        data = await self._reader.readexactly(3)
+        _, length = struct.unpack(">BH", data)
+        if length > 3:
+            data += await self._reader.readexactly(length - 3)
+        if isinstance(request, requests.Connect):
+            return self.response_handler.decode_connection(_PacketReader(data))
+        return self.response_handler.decode(_PacketReader(data))
+
+    async def _exchange(self, request):
+        """Sends request and returns its response. A cancelled caller doesn't
+        interrupt the exchange, so no partial packet is left on the link"""
+        self._exchange_task = asyncio.ensure_future(self._send_and_receive(request))
+        return await asyncio.shield(self._exchange_task)
+
+    async def _recover(self, task):
+        """Finishes the exchange interrupted by a cancellation and aborts its operation"""
+        response = None
+        if task is not None:
+            try:
+                response = await task
+            except Exception:
+                logger.exception("Exchange of cancelled operation failed")
+                self._close()
+                return
+        if isinstance(response, responses.Continue):
+            logger.info("Aborting cancelled operation")
+            await self._send_and_receive(requests.Abort())
+
+    async def _run(self, operation, *args):
+        """Runs the operation coroutine function exclusively on the link"""
+        async with self._lock:
+            if self._recovery is not None:
+                await asyncio.shield(self._recovery)
+                self._recovery = None
+            try:
+                return await operation(*args)
+            except asyncio.CancelledError:
+                self._recovery = asyncio.ensure_future(self._recover(self._exchange_task))
+                raise
+            finally:
+                self._exchange_task = None
+
+    async def _send_headers(self, request, header_list, max_length):
+        """Same as client.Client._send_headers"""
+        if self.connection_id:
+            header_list.insert(0, self.connection_id)
+        while header_list:
+            if request.add_header(header_list[0], max_length):
+                header_list.pop(0)
+            else:
+                response = await self._exchange(request)
+                if not isinstance(response, responses.Continue):
+                    return response
+                request.reset_headers()
+        if isinstance(request, requests.Get):
+            request.code = requests.Get_Final.code
+        return await self._exchange(request)
+
+    async def _get(self, name=None, header_list=()):
+        """Returns a tuple of the response headers and body or the failure response"""
+        header_list = list(header_list)
+        if name is not None:
+            header_list = [headers.Name(name)] + header_list
+        max_length = self.remote_info.max_packet_length
+        response = await self._send_headers(requests.Get(), header_list, max_length)
+        returned_headers = []
+        while isinstance(response, responses.Continue):
+            returned_headers += response.header_data
+            response = await self._exchange(requests.Get_Final())
+        if not isinstance(response, responses.Success):
+            return response
+        returned_headers += response.header_data
+        return MAPClient._collect_parts(returned_headers)
+
+    async def _put(self, name, file_data, header_list=()):
+        """Returns the final response of the put operation"""
+        if isinstance(file_data, str):
+            file_data = file_data.encode("utf-8")
+        header_list = [headers.Name(name), headers.Length(len(file_data))] + list(header_list)
+        max_length = self.remote_info.max_packet_length
+        response = await self._send_headers(requests.Put(), header_list, max_length)
+        if not isinstance(response, responses.Continue):
+            return response
+        # maximum packet length minus request and body header
+        optimum_size = max_length - 3 - 3
+        offset = 0
+        while True:
+            data = file_data[offset:offset + optimum_size]
+            offset += len(data)
+            if offset < len(file_data):
+                request = requests.Put()
+                request.add_header(headers.Body(data), max_length)
+                response = await self._exchange(request)
+                if not isinstance(response, responses.Continue):
+                    return response
+            else:
+                request = requests.Put_Final()
+                request.add_header(headers.End_Of_Body(data), max_length)
+                return await self._exchange(request)
+
+    async def _setpath(self, name="", to_parent=False):
+        header_list = [headers.Name(name)] if name is not None else []
+        flags = requests.Set_Path.DontCreateDir
+        if to_parent:
+            flags |= requests.Set_Path.NavigateToParent
+        return await self._send_headers(requests.Set_Path((flags, 0)), header_list,
+                                        self.remote_info.max_packet_length)
+
+    async def connect(self, header_list=None):
+        """Opens the socket and sends the OBEX connect request (to the MAS target
+        if no headers are given), returns the response"""
+        if header_list is None:
+            header_list = [headers.Target(MAS_TARGET_UUID)]
+        return await self._run(self._connect, list(header_list))
+
+    async def _connect(self, header_list):
+        await self._open()
+        data = (self.obex_version.to_byte(), 0, self.max_packet_length)
+        response = await self._send_headers(requests.Connect(data), header_list, self.max_packet_length)
+        if isinstance(response, responses.ConnectSuccess):
+            self.remote_info = response
+            for header in response.header_data:
+                if isinstance(header, headers.Connection_ID):
+                    self.connection_id = headers.Connection_ID(header.decode())
+        else:
+            self._close()
+        return response
+
+    async def disconnect(self, header_list=()):
+        return await self._run(self._disconnect, list(header_list))
+
+    async def _disconnect(self, header_list):
+        try:
+            return await self._send_headers(requests.Disconnect(), header_list,
+                                            self.remote_info.max_packet_length)
+        finally:
+            self._close()
+            self.connection_id = None
+            self.remote_info = None
+            self.current_dir = "/"
+
+    async def get_folder_listing(self, max_list_count=1024, list_startoffset=0):
+        """Retrieves folders list from current folder"""
+        logger.info("Requesting get_folder_listing with appl parameters %s", str(locals()))
+        header_list = MAPClient._folder_listing_header_list(max_list_count, list_startoffset)
+        response = await self._run(self._get, None, header_list)
+        if not isinstance(response, tuple) and isinstance(response, responses.FailureResponse):
+            logger.error("get_folder_listing failed. reason = %s", response)
+            return
+        return response
+
+    async def get_messages_listing(self, name, max_list_count=1024, list_startoffset=0,
+                                   filter_messageType=0, filter_readStatus=0, new_message=0, fields=None,
+                                   subject_length=None):
+        """Retrieves messages listing object from current folder, see MAPClient.get_messages_listing"""
+        logger.info("Requesting get_messages_listing with parameters %s", str(locals()))
+        header_list = MAPClient._messages_listing_header_list(max_list_count, list_startoffset,
+                                                              filter_messageType, filter_readStatus, new_message,
+                                                              *MAPClient._listing_mask(fields, subject_length))
+        response = await self._run(self._get, name, header_list)
+        if not isinstance(response, tuple) and isinstance(response, responses.FailureResponse):
+            logger.error("get_messages_listing failed for bMessage '%s'. reason = %s", name, response)
+            return
+        return response
+
+    async def get_message(self, name, attachment=1, charset=1):
+        """Retrieves a specific message from the MSE device"""
+        logger.info("Requesting get_message with parameters %s", str(locals()))
+        cache_key = (self.mas_instance_id, name, attachment, charset)
+        if self.message_cache is not None:
+            response = self.message_cache.get(cache_key)
+            if response is not None:
+                logger.debug("Serving bMessage '%s' from message cache", name)
+                return response
+        header_list = MAPClient._message_header_list(attachment, charset)
+        response = await self._run(self._get, name, header_list)
+        if not isinstance(response, tuple):
+            logger.error("get_message failed for bMessage '%s'. reason = %s", name, response)
+            return
+        if self.message_cache is not None:
+            self.message_cache.put(cache_key, response, size=len(response[1]))
+        return response
+
+    async def get_message_fraction(self, name, fraction_request=FRACTION_FIRST, attachment=1, charset=1):
+        """Retrieves a fraction of an email, see MAPClient.get_message_fraction"""
+        logger.info("Requesting get_message_fraction with parameters %s", str(locals()))
+        header_list = MAPClient._message_header_list(attachment, charset, fraction_request)
+        response = await self._run(self._get, name, header_list)
+        if not isinstance(response, tuple):
+            logger.error("get_message_fraction failed for bMessage '%s'. reason = %s", name, response)
+            return
+        response_headers, body = response
+        return MessageFraction(name, response_headers, body, MAPClient._more_fractions(response_headers))
+
+    async def iter_message_fractions(self, name, attachment=1, charset=1):
+        """Yields the MessageFractions of an email, see MAPClient.iter_message_fractions"""
+        fraction_request = FRACTION_FIRST
+        while True:
+            fraction = await self.get_message_fraction(name, fraction_request, attachment, charset)
+            if fraction is None:
+                return
+            yield fraction
+            if not fraction.more:
+                return
+            fraction_request = FRACTION_NEXT
+
+    async def set_msg_folder(self, name="", to_parent=False, to_root=False):
+        """Sets the current folder in the virtual folder architecture"""
+        logger.info("Setting current folder with params '%s'", str(locals()))
+        if name == "" and not to_parent and not to_root:
+            logger.error("Not a valid action, "
+                         "either name should be not empty or to_parent/to_root should be True")
+            return
+        if (to_root or to_parent) and self.current_dir == "/":
+            logger.warning("Path is already in root folder, no need to change")
+            return
+        if to_root:
+            action, name = "root", ""
+        elif to_parent:
+            action, name = "up", ""
+        else:
+            action = "down"
+        return await self._run(self._setpath_ops, [(action, name)])
+
+    async def set_msg_folder_path(self, path):
+        """Sets the current folder to path (absolute or relative to the current folder)
+        using the fewest SETPATH operations"""
+        logger.info("Setting current folder path to '%s'", path)
+        target = self._setpath_target(path)
+        if target is None:
+            return
+        return await self._run(self._setpath_ops, self._setpath_plan(self.current_dir, target))
+
+    async def _setpath_ops(self, plan):
+        response = responses.Success()  # already in the target folder
+        for action, name in plan:
+            response = await self._setpath(name, to_parent=action == "up")
+            if not self._setpath_done(action, name, response):
+                return
+        return response
+
+    async def set_msg_status(self, name='', status_indicator=1, status_value=0):
+        """Modify the status of a message on the MSE."""
+        logger.info("Requesting set_msg_status with parameters %s", str(locals()))
+        header_list = MAPClient._msg_status_header_list(status_indicator, status_value)
+        response = await self._run(self._put, name, b"0", header_list)
+        if not isinstance(response, tuple) and isinstance(response, responses.FailureResponse):
+            logger.error("Modify the status to %s of message %s fail'. reason = %s", name, status_value, response)
+            return
+        self._invalidate_messages(name)
+        return response
+
+    async def push_message(self, name, file_name='0123', transparent=0, retry=1, charset=1):
+        """Push a message to a folder of the MSE"""
+        logger.info("Requesting push_message with parameters %s", str(locals()))
+        file_path = sys.path[0] + os.sep + 'test' + os.sep + 'data' + os.sep + file_name
+        header_list = MAPClient._push_message_header_list(transparent, retry, charset)
+        with open(file_path, 'r') as f:
+            file_data = f.read()
+        response = await self._run(self._put, name, file_data, header_list)
+        if not isinstance(response, tuple) and isinstance(response, responses.FailureResponse):
+            logger.error("push bMessage to %s fail'. reason = %s", name, response)
+            return
+        return response
+
+    async def update_inbox(self, name=''):
+        """Initiate an update of the MSE's inbox"""
+        logger.info("Requesting update_inbox with parameters %s", str(locals()))
+        header_list = [headers.Type(b"x-bt/MAP-messageUpdate")]
+        response = await self._run(self._put, name, b"0", header_list)
+        if not isinstance(response, tuple) and isinstance(response, responses.FailureResponse):
+            logger.error("Initiate an update of the MSE's inbox fail'. reason = %s", response)
+            return
+        self._invalidate_messages()
+        return response
@@ -0,0 +1,361 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""Incremental parser for bMessage objects"""
+
+import binascii
+import logging
+import tempfile
+
+from email.parser import BytesHeaderParser
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUFFER_SIZE = 64 * 1024
+
+# bMessage types whose content is a MIME message
+MIME_TYPES = ("EMAIL", "MMS")
+
+
+class BMessageHeader(object):
+    """Properties of the bMessage itself: VERSION, STATUS, TYPE, FOLDER, ..."""
+    __slots__ = ("properties",)
+
+    def __init__(self, properties):
+        self.properties = properties
+
+    def __repr__(self):
+        return "<BMessageHeader {!r}>".format(self.properties)
+
+
+class VCardPart(object):
+    """Originator (outside the envelope) or recipient (inside it) vCard,
+    properties maps the property names to the list of their values"""
+    __slots__ = ("role", "properties")
+
+    def __init__(self, role, properties):
+        self.role = role
+        self.properties = properties
+
+    def __repr__(self):
+        return "<VCardPart {} {!r}>".format(self.role, self.properties)
+
+
+class BodyInfo(object):
+    """Properties of the bMessage body: PARTID, ENCODING, CHARSET, LANGUAGE, LENGTH"""
+    __slots__ = ("properties",)
+
+    def __init__(self, properties):
+        self.properties = properties
+
+    def __repr__(self):
+        return "<BodyInfo {!r}>".format(self.properties)
+
+
+class ContentPart(object):
+    """Message text, or one MIME part of an email/MMS.
+
+    headers are the MIME headers of the part (an email.message.Message,
+    None for SMS text). The decoded content was written to file, the
+    sink of the part; spooled content is rewound, ready to be read.
+    """
+    __slots__ = ("headers", "file", "size")
+
+    def __init__(self, headers, file, size):
+        self.headers = headers
+        self.file = file
+        self.size = size
+
+    @property
+    def content_type(self):
+        return self.headers.get_content_type() if self.headers is not None else "text/plain"
+
+    @property
+    def filename(self):
+        return self.headers.get_filename() if self.headers is not None else None
+
+    def __repr__(self):
+        return "<ContentPart {} {} bytes{}>".format(
+            self.content_type, self.size, " filename={!r}".format(self.filename) if self.filename else "")
+
+
+class _Base64Decoder(object):
+    """Decodes base64 content fed in arbitrary pieces"""
+
+    def __init__(self):
+        self._rest = b""
+
+    def decode(self, data):
+        data = self._rest + b"".join(data.split())
+        usable = len(data) - len(data) % 4
+        self._rest = data[usable:]
+        return binascii.a2b_base64(data[:usable]) if usable else b""
+
+    def flush(self):
+        if self._rest:
+            logger.error("Dropping %d bytes of truncated base64 content", len(self._rest))
+        return b""
+
+
+class _QuotedPrintableDecoder(object):
+    """Decodes quoted-printable content fed in arbitrary pieces.
+
+    Complete lines are decoded one by one; a soft line break (a line
+    ending in '=') joins the line with the next one. The rest of an
+    incomplete line is kept until its line break arrives, a trailing
+    '=' or '=X' of it until the escape is complete.
+    """
+
+    def __init__(self):
+        self._rest = b""
+
+    def decode(self, data):
+        data = self._rest + data
+        lines = data.split(b"\r\n")
+        self._rest = lines.pop()
+        decoded = []
+        for line in lines:
+            line = line.rstrip(b" \t")
+            if line.endswith(b"="):
+                decoded.append(binascii.a2b_qp(line[:-1]))
+            else:
+                decoded.append(binascii.a2b_qp(line) + b"\r\n")
+        # text of the incomplete line, up to a possibly unfinished escape or trailing whitespace
+        cut = len(self._rest.rstrip(b" \t"))
+        escape = self._rest.rfind(b"=", max(cut - 2, 0), cut)
+        if escape >= 0:
+            cut = escape
+        decoded.append(binascii.a2b_qp(self._rest[:cut]))
+        self._rest = self._rest[cut:]
+        return b"".join(decoded)
+
+    def flush(self):
+        rest, self._rest = self._rest, b""
+        return binascii.a2b_qp(rest.rstrip(b" \t").rstrip(b"="))
+
+
+class _RawDecoder(object):
+
+    @staticmethod
+    def decode(data):
+        return data
+
+    @staticmethod
+    def flush():
+        return b""
+
+
+# Content-Transfer-Encoding: decoder class, other encodings are written as is
+_DECODERS = {
+    "base64": _Base64Decoder,
+    "quoted-printable": _QuotedPrintableDecoder,
+}
+
+
+class _PartWriter(object):
+    """Writes the content of one part to its sink.
+
+    Line breaks are written before the next line instead of after the
+    current one, as the break before END:MSG or a MIME boundary is not
+    part of the content.
+    """
+
+    def __init__(self, headers, sink):
+        self.headers = headers
+        self.sink = sink
+        self.size = 0
+        self._newline = False
+        encoding = headers.get("Content-Transfer-Encoding", "") if headers is not None else ""
+        self._decoder = _DECODERS.get(encoding.strip().lower(), _RawDecoder)()
+
+    def write(self, data, line_start, line_end):
+        if line_start and self._newline:
+            data = b"\r\n" + data
+        self._newline = line_end
+        self._emit(self._decoder.decode(data))
+
+    def close(self):
+        self._emit(self._decoder.flush())
+        if self.sink.seekable():
+            self.sink.seek(0)
+        return ContentPart(self.headers, self.sink, self.size)
+
+    def _emit(self, data):
+        if data:
+            self.sink.write(data)
+            self.size += len(data)
+
+
+class BMessageParser(object):
+    """Parses a bMessage chunk by chunk as it is received.
+
+    feed returns the parts completed by a chunk: the BMessageHeader, the
+    VCardParts, the BodyInfo and a ContentPart per message text or MIME
+    part of an email/MMS. Content never stays in memory as a whole: it
+    is written to sink_factory(headers) if given, else to a temporary
+    file that is only created once the part exceeds buffer_size. Lines
+    are buffered up to buffer_size bytes, so memory use is bounded by
+    buffer_size plus one in-memory part.
+    """
+
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE, sink_factory=None):
+        self.buffer_size = buffer_size
+        self.sink_factory = sink_factory
+        self._buffer = bytearray()
+        self._line_start = True  # the buffer starts at the beginning of a line
+        self._parts = []
+        self._stack = []  # open BEGIN: sections
+        self._properties = {}  # properties of the innermost section
+        self._bmessage_properties = None
+        self._header_emitted = False
+        self._in_content = False
+        # MIME state of the current message content
+        self._mime = False
+        self._mime_header_lines = None  # header lines of the next part, None outside headers
+        self._boundaries = []
+        self._writer = None
+
+    def feed(self, data):
+        """Feeds a body chunk and returns the parts completed by it"""
+        self._buffer += data
+        while True:
+            end = self._buffer.find(b"\n")
+            if end < 0:
+                break
+            line = bytes(self._buffer[:end]).rstrip(b"\r")
+            del self._buffer[:end + 1]
+            self._line(line, self._line_start, True)
+            self._line_start = True
+        if len(self._buffer) > self.buffer_size:
+            if not (self._in_content and self._mime_header_lines is None):
+                raise ValueError("bMessage line exceeds {} bytes".format(self.buffer_size))
+            # a long content line, e.g. unwrapped base64, goes to the sink in pieces,
+            # keeping a trailing CR that may start the line break
+            keep = 1 if self._buffer.endswith(b"\r") else 0
+            self._line(bytes(self._buffer[:len(self._buffer) - keep]), self._line_start, False)
+            del self._buffer[:len(self._buffer) - keep]
+            self._line_start = False
+        parts, self._parts = self._parts, []
+        return parts
+
+    def close(self):
+        """Finishes parsing and returns the remaining parts"""
+        if self._buffer:
+            self._line(bytes(self._buffer).rstrip(b"\r"), self._line_start, True)
+            del self._buffer[:]
+        if self._in_content:
+            logger.error("bMessage ended inside the message content")
+            self._end_content()
+        parts, self._parts = self._parts, []
+        return parts
+
+    def _line(self, line, line_start, line_end):
+        if self._in_content:
+            if line_start and line_end and line == b"END:MSG":
+                self._end_content()
+                self._stack.pop()
+            else:
+                self._content_line(line, line_start, line_end)
+            return
+        text = line.decode("utf-8", "replace")
+        if not text:
+            return
+        key, _, value = text.partition(":")
+        if key == "BEGIN":
+            self._begin(value)
+        elif key == "END":
+            self._end(value)
+        else:
+            name = key.split(";")[0].upper()
+            self._properties.setdefault(name, []).append(value)
+
+    def _begin(self, section):
+        if not self._stack:
+            self._properties = {}
+        elif not self._header_emitted:
+            self._header_emitted = True
+            self._bmessage_properties = dict((name, values[0]) for name, values in self._properties.items())
+            self._parts.append(BMessageHeader(self._bmessage_properties))
+        if section == "MSG":
+            if self._stack[-1] == "BBODY" and self._properties:
+                # emitted once, before the first MSG of the body
+                self._parts.append(BodyInfo(dict((name, values[0]) for name, values in self._properties.items())))
+                self._properties = {}
+            self._start_content()
+        else:
+            self._properties = {}
+        self._stack.append(section)
+
+    def _end(self, section):
+        if not self._stack or self._stack[-1] != section:
+            raise ValueError("Unexpected END:{} in bMessage".format(section))
+        self._stack.pop()
+        if section == "VCARD":
+            role = "recipient" if "BENV" in self._stack else "originator"
+            self._parts.append(VCardPart(role, self._properties))
+        self._properties = {}
+
+    def _start_content(self):
+        self._in_content = True
+        message_type = (self._bmessage_properties or {}).get("TYPE", "")
+        self._mime = message_type.upper() in MIME_TYPES
+        self._boundaries = []
+        self._writer = None
+        self._mime_header_lines = [] if self._mime else None
+        if not self._mime:
+            self._open_part(None)
+
+    def _end_content(self):
+        if self._writer is not None:
+            self._parts.append(self._writer.close())
+            self._writer = None
+        self._in_content = False
+        self._mime_header_lines = None
+
+    def _open_part(self, headers):
+        if self.sink_factory is not None:
+            sink = self.sink_factory(headers)
+        else:
+            sink = tempfile.SpooledTemporaryFile(max_size=self.buffer_size)
+        self._writer = _PartWriter(headers, sink)
+
+    def _content_line(self, line, line_start, line_end):
+        if line_start and line_end and self._boundaries and line.startswith(b"--"):
+            for depth in range(len(self._boundaries) - 1, -1, -1):
+                boundary = self._boundaries[depth]
+                if line.rstrip() in (boundary, boundary + b"--"):
+                    if self._writer is not None:
+                        self._parts.append(self._writer.close())
+                        self._writer = None
+                    del self._boundaries[depth + 1:]
+                    if line.rstrip() == boundary:
+                        self._mime_header_lines = []
+                    else:
+                        self._boundaries.pop()  # the epilogue up to the next outer boundary is dropped
+                    return
+        if self._mime_header_lines is not None:
+            if line:
+                self._mime_header_lines.append(line)
+                if sum(len(header) for header in self._mime_header_lines) > self.buffer_size:
+                    raise ValueError("MIME headers exceed {} bytes".format(self.buffer_size))
+                return
+            headers = BytesHeaderParser().parsebytes(b"\r\n".join(self._mime_header_lines) + b"\r\n\r\n")
+            self._mime_header_lines = None
+            boundary = headers.get_boundary() if headers.get_content_maintype() == "multipart" else None
+            if boundary is not None:
+                # the preamble up to the first boundary is dropped
+                self._boundaries.append(b"--" + boundary.encode("utf-8"))
+            else:
+                self._open_part(headers)
+            return
+        if self._writer is not None:
+            self._writer.write(line, line_start, line_end)
+
+
+def iter_parts(parser, chunks):
+    """Yields the parts parsed from an iterable of body chunks"""
+    for chunk in chunks:
+        for part in parser.feed(chunk):
+            yield part
+    for part in parser.close():
+        yield part
@@ -6,89 +6,484 @@
 
 import atexit
 import collections
+import functools
 import logging
 import os
+import posixpath
 import readline
 import sys
+import threading
 import uuid
 
-from xml.etree import ElementTree
-
 import bluetooth
 import cmd2
+import mapbmessage as bmessage
+import mapcommon as common
 import mapheaders as headers
+import maplisting as listing
+import mapmns
+import mapsync
 import mapresponses as responses
 
 from optparse import make_option
-from PyOBEX import client
+from PyOBEX import client, requests
 
 MAS_TARGET_UUID = uuid.UUID('{bb582b40-420c-11db-b0de-0800200c9a66}').bytes
+MAP_PROFILE_ID = "1134"  # profile id of MAP
 
 logger = logging.getLogger(__name__)
 
+# Result of a get_messages download, error is the failure response (headers and body are None then)
+MessageResult = collections.namedtuple("MessageResult", ["handle", "headers", "body", "error"])
+
+# FractionRequest values
+FRACTION_FIRST = 0
+FRACTION_NEXT = 1
+# FractionDeliver values
+FRACTION_MORE = 0
+FRACTION_LAST = 1
+
+# Fraction of an email, more is True if further fractions remain on the MSE
+MessageFraction = collections.namedtuple("MessageFraction", ["handle", "headers", "body", "more"])
+
+
+class FolderTree(object):
+    """Folder structure of the MSE as far as it was seen in folder listings"""
+
+    def __init__(self):
+        # absolute path: (names of sub folders, True if all sub folders are known)
+        self._folders = {}
+
+    @staticmethod
+    def normpath(path):
+        return posixpath.normpath(posixpath.join("/", path))
+
+    @classmethod
+    def split(cls, path):
+        """Returns the components of a normalized absolute path"""
+        return [comp for comp in cls.normpath(path).split("/") if comp]
+
+    def add(self, path, names, complete=False):
+        """Records sub folders of path, complete=True if names are all of them"""
+        path = self.normpath(path)
+        if complete:
+            self._folders[path] = (set(names), True)
+        else:
+            known, was_complete = self._folders.get(path, (set(), False))
+            self._folders[path] = (known | set(names), was_complete)
+        # path itself exists in its parent
+        if path != "/":
+            parent, name = posixpath.split(path)
+            if name not in self._folders.get(parent, (set(), False))[0]:
+                self.add(parent, [name])
+
+    def children(self, path):
+        """Returns the sub folder names of path, None if not all of them are known"""
+        names, complete = self._folders.get(self.normpath(path), (set(), False))
+        return sorted(names) if complete else None
+
+    def exists(self, path):
+        """Returns whether path exists, None if that is not known without asking the MSE"""
+        parent = "/"
+        for comp in self.split(path):
+            names, complete = self._folders.get(parent, (set(), False))
+            if comp not in names:
+                return False if complete else None
+            parent = posixpath.join(parent, comp)
+        return True
+
+    def clear(self):
+        self._folders.clear()
+
+
+class MASClientBase(object):
+    """Folder and message cache bookkeeping shared by MAPClient and AsyncMAPClient"""
+
+    def _invalidate_messages(self, name=None):
+        """Drops cached bMessages of this MAS instance, only the given handle if name is set"""
+        if self.message_cache is None:
+            return
+        instance_id = self.mas_instance_id
+        self.message_cache.invalidate(
+            lambda key: key[0] == instance_id and (name is None or key[1] == name))
+
+    def _setpath_target(self, path):
+        """Returns the folder path (absolute or relative to the current folder) normalized,
+        None if the folder is known not to exist on the MSE"""
+        target = posixpath.normpath(posixpath.join(self.current_dir, path))
+        if self.folder_tree.exists(target) is False:
+            logger.error("Folder '%s' doesn't exist on the MSE", target)
+            return
+        return target
+
+    @staticmethod
+    def _setpath_plan(current_dir, target):
+        """Returns the (action, name) SETPATH operations navigating from current_dir to target,
+        either via the common parent folder or via the root folder, whichever is shorter"""
+        current = FolderTree.split(current_dir)
+        wanted = FolderTree.split(target)
+        common = 0
+        while common < min(len(current), len(wanted)) and current[common] == wanted[common]:
+            common += 1
+        ups = len(current) - common
+        downs = wanted[common:]
+
+        plan = [("up", "")] * ups + [("down", name) for name in downs]
+        if ups and downs:
+            # going to parent and into a sub folder is a single SETPATH
+            plan[ups - 1:ups + 1] = [("up", downs[0])]
+        if 1 + len(wanted) < len(plan):
+            plan = [("root", "")] + [("down", name) for name in wanted]
+        return plan
+
+    def _setpath_done(self, action, name, response):
+        """Tracks the current folder after one SETPATH of a plan: action is 'root',
+        'up' (to parent, then into name if given) or 'down' (into name).
+        Returns False if the MSE refused it"""
+        if not isinstance(response, tuple) and isinstance(response, responses.FailureResponse):
+            logger.error("set_msg_folder failed for '%s'. reason = %s", name, response)
+            return False
+
+        if action == "root":
+            self.current_dir = "/"
+        elif action == "up":
+            self.current_dir = posixpath.dirname(self.current_dir)
+        if name:
+            self.current_dir = posixpath.join(self.current_dir, name)
+            self.folder_tree.add(self.current_dir, [])
+        return True
+
 
-class MAPClient(client.Client):
+class MAPClient(client.Client, MASClientBase):
     """Message Access Profile Client"""
 
-    def __init__(self, address, port):
+    def __init__(self, address, port, message_cache=None):
         client.Client.__init__(self, address, port)
         self.current_dir = "/"
+        self.folder_tree = FolderTree()
+        self.mas_instance_id = 0
+        # optional mapcommon.LRUCache of get_message responses,
+        # keyed by (mas_instance_id, name, attachment, charset)
+        self.message_cache = message_cache
 
     def get_folder_listing(self, max_list_count=1024, list_startoffset=0):
         """Retrieves folders list from current folder"""
         logger.info("Requesting get_folder_listing with appl parameters %s", str(locals()))
+        header_list = self._folder_listing_header_list(max_list_count, list_startoffset)
+        response = self.get(header_list=header_list)
+        if not isinstance(response, tuple) and isinstance(response, responses.FailureResponse):
+            logger.error("get_folder_listing failed. reason = %s", response)
+            return
+        records = list(listing.iter_records(listing.FolderListingParser(), [response[1]]))
+        complete = list_startoffset == 0 and len(records) < max_list_count
+        self.folder_tree.add(self.current_dir, [record.name for record in records], complete)
+        return response
+
+    def walk_folder_listing(self, page_size=1024):
+        """Yields FolderRecord entries of the current folder, requesting them in pages
+        of page_size entries. The next page is requested while the current one is processed."""
+        logger.info("Requesting walk_folder_listing with parameters %s", str(locals()))
+        path = self.current_dir
+        names = []
+        completed = []
+        for record in self._walk_listing(None, self._folder_listing_header_list, listing.FolderListingParser,
+                                         "FolderListingSize", page_size, completed.append):
+            names.append(record.name)
+            yield record
+        if completed:
+            self.folder_tree.add(path, names, complete=True)
+
+    @staticmethod
+    def _folder_listing_header_list(max_list_count, list_startoffset):
         data = {"MaxListCount": headers.MaxListCount(max_list_count),
                 "ListStartOffset": headers.ListStartOffset(list_startoffset)}
         application_parameters = headers.App_Parameters(data, encoded=False)
-        header_list = [headers.Type("x-obex/folder-listing")]
+        header_list = [headers.Type(b"x-obex/folder-listing")]
         if application_parameters.data:
             header_list.append(application_parameters)
+        return header_list
 
-        response = self.get(header_list=header_list)
+    def get_messages_listing(self, name, max_list_count=1024, list_startoffset=0,
+                             filter_messageType=0,filter_readStatus=0,new_message=0, fields=None,
+                             subject_length=None):
+        """Retrieves messages listing object from current folder.
+        fields is the name of a field set of maplisting.FIELD_SETS or an iterable of msg
+        attributes (all of them if None), subject_length defaults to the one of the field set."""
+        logger.info("Requesting get_messages_listing with parameters %s", str(locals()))
+        header_list = self._messages_listing_header_list(max_list_count, list_startoffset,
+                                                         filter_messageType, filter_readStatus, new_message,
+                                                         *self._listing_mask(fields, subject_length))
+        response = self.get(name, header_list)
         if not isinstance(response, tuple) and isinstance(response, responses.FailureResponse):
-            logger.error("get_folder_listing failed. reason = %s", response)
+            logger.error("get_messages_listing failed for bMessage '%s'. reason = %s", name, response)
             return
         return response
 
-    def get_messages_listing(self, name, max_list_count=1024, list_startoffset=0,
-                             filter_messageType=0,filter_readStatus=0,new_message=0):
-        """Retrieves messages listing object from current folder"""
-        logger.info("Requesting get_messages_listing with parameters %s", str(locals()))
+    def iter_messages_listing(self, name, max_list_count=1024, list_startoffset=0,
+                              filter_messageType=0, filter_readStatus=0, new_message=0, fields=None,
+                              subject_length=None):
+        """Retrieves messages listing object from current folder and yields its
+        entries as MessageRecord while the object is still being transferred.
+        Records only have the attributes in fields, see get_messages_listing."""
+        logger.info("Requesting iter_messages_listing with parameters %s", str(locals()))
+        header_list = self._messages_listing_header_list(max_list_count, list_startoffset,
+                                                         filter_messageType, filter_readStatus, new_message,
+                                                         *self._listing_mask(fields, subject_length))
+        parser = listing.MessagesListingParser(fields)
+        for response in self._get(name, header_list):
+            if isinstance(response, responses.FailureResponse):
+                logger.error("iter_messages_listing failed for bMessage '%s'. reason = %s", name, response)
+                return
+            _, body = self._collect_parts(response.header_data)
+            for record in parser.feed(body):
+                yield record
+        for record in parser.close():
+            yield record
+
+    def walk_messages_listing(self, name, page_size=1024, filter_messageType=0, filter_readStatus=0,
+                              new_message=0, fields=None, subject_length=None, on_complete=None):
+        """Yields MessageRecord entries of the whole messages listing, requesting them in pages
+        of page_size entries. The next page is requested while the current one is processed.
+        Records only have the attributes in fields, see get_messages_listing.
+        on_complete is called with the ListingSize if the last page was received, the walk
+        ends without calling it if a page fails."""
+        logger.info("Requesting walk_messages_listing with parameters %s", str(locals()))
+        mask = self._listing_mask(fields, subject_length)
+
+        def header_list(max_list_count, list_startoffset):
+            return self._messages_listing_header_list(max_list_count, list_startoffset, filter_messageType,
+                                                      filter_readStatus, new_message, *mask)
+        return self._walk_listing(name, header_list, lambda: listing.MessagesListingParser(fields),
+                                  "ListingSize", page_size, on_complete)
+
+    def get_listing_versions(self, name):
+        """Returns the application parameters of the messages listing of folder name,
+        without its entries: ListingSize, NewMessage and, depending on the MSE,
+        MSETime, DatabaseIdentifier and FolderVersionCounter. Text values are str."""
+        logger.info("Requesting get_listing_versions with parameters %s", str(locals()))
+        header_list = self._messages_listing_header_list(0, 0, 0, 0, 0)
+        versions = {}
+        for response in self._get(name, header_list):
+            if isinstance(response, responses.FailureResponse):
+                logger.error("get_listing_versions failed for folder '%s'. reason = %s", name, response)
+                return
+            for header in response.header_data:
+                if isinstance(header, headers.App_Parameters):
+                    for param, value in header.decode().items():
+                        value = value.decode()
+                        versions[param] = value.decode("utf-8").rstrip("\0") if isinstance(value, bytes) else value
+        return versions
+
+    def _walk_listing(self, name, header_list, parser_class, size_param, page_size, on_complete=None):
+        """Pages through a listing object until ListingSize/FolderListingSize entries are received.
+        on_complete is called (from the read-ahead thread) with the listing size reported with
+        the last page (None if the MSE reported none) once that page was received.
+        Requests must not be sent on this connection while the listing is walked."""
+        if not 0 < page_size <= 0xFFFF:
+            raise ValueError("page_size should be in range 1..65535")
+
+        def pages():
+            offset = 0
+            while True:
+                page = self._get_listing_page(name, header_list(page_size, offset), parser_class(), size_param)
+                if page is None:
+                    return
+                listing_size, records = page
+                yield records
+                offset += len(records)
+                if len(records) < page_size or (listing_size is not None and offset >= listing_size):
+                    if on_complete is not None:
+                        on_complete(listing_size)
+                    return
+
+        for records in common.read_ahead(pages()):
+            for record in records:
+                yield record
+
+    def _get_listing_page(self, name, header_list, parser, size_param):
+        """Retrieves one page of a listing object, returns the listing size
+        reported by the MSE (if any) and the parsed entries"""
+        listing_size = None
+        records = []
+        for response in self._get(name, header_list):
+            if isinstance(response, responses.FailureResponse):
+                logger.error("Retrieving listing page failed. reason = %s", response)
+                return
+            response_headers, body = self._collect_parts(response.header_data)
+            for header in response_headers:
+                if isinstance(header, headers.App_Parameters):
+                    app_params = header.decode()
+                    if size_param in app_params:
+                        listing_size = app_params[size_param].decode()
+            records.extend(parser.feed(body))
+        records.extend(parser.close())
+        return listing_size, records
+
+    @staticmethod
+    def _listing_mask(fields, subject_length):
+        """Returns the ParameterMask (None for all attributes) and SubjectLength asking for fields"""
+        mask = listing.parameter_mask(fields)
+        if subject_length is None and isinstance(fields, str):
+            subject_length = listing.FIELD_SETS[fields][1]
+        return mask or None, subject_length
+
+    @staticmethod
+    def _messages_listing_header_list(max_list_count, list_startoffset, filter_messageType,
+                                      filter_readStatus, new_message, parameter_mask=None, subject_length=None):
         data = {"MaxListCount": headers.MaxListCount(max_list_count),
                 "ListStartOffset": headers.ListStartOffset(list_startoffset),
                 "FilterMessageType":headers.FilterMessageType(filter_messageType),
                 "FilterReadStatus":headers.FilterReadStatus(filter_readStatus),
                 "NewMessage":headers.NewMessage(new_message)}
+        if parameter_mask is not None:
+            data["ParameterMask"] = headers.ParameterMask(parameter_mask)
+        if subject_length is not None:
+            data["SubjectLength"] = headers.SubjectLength(subject_length)
 
         application_parameters = headers.App_Parameters(data, encoded=False)
-        header_list = [headers.Type("x-bt/MAP-msg-listing")]
+        header_list = [headers.Type(b"x-bt/MAP-msg-listing")]
         if application_parameters.data:
             header_list.append(application_parameters)
-
-        response = self.get(name, header_list)
-        if not isinstance(response, tuple) and isinstance(response, responses.FailureResponse):
-            logger.error("get_messages_listing failed for bMessage '%s'. reason = %s", name, response)
-            return
-        return response
+        return header_list
 
     def get_message(self,name,attachment=1,charset=1):
         """Retrieves a specific message from the MSE device"""
         logger.info("Requesting get_message with parameters %s", str(locals()))
+        result = self._fetch_message(name, attachment, charset, use_srm=False)
+        if result.error is not None:
+            return
+        return result.headers, result.body
+
+    def get_messages(self, handles, attachment=1, charset=1, use_srm=True):
+        """Retrieves the given messages and yields a MessageResult per handle as soon as it is
+        downloaded, the next message is downloaded while the current one is processed.
+        A failure of one message is reported in its result and doesn't abort the others.
+        Requests must not be sent on this connection until all results are consumed."""
+        logger.info("Requesting get_messages with parameters %s", str(locals()))
+
+        def fetch():
+            for handle in handles:
+                yield self._fetch_message(handle, attachment, charset, use_srm)
+        return common.read_ahead(fetch())
+
+    def _fetch_message(self, name, attachment, charset, use_srm):
+        cache_key = (self.mas_instance_id, name, attachment, charset)
+        if self.message_cache is not None:
+            response = self.message_cache.get(cache_key)
+            if response is not None:
+                logger.debug("Serving bMessage '%s' from message cache", name)
+                return MessageResult(name, response[0], response[1], None)
+
+        header_list = self._message_header_list(attachment, charset)
+        returned_headers = []
+        for response in (self._srm_get if use_srm else self._get)(name, header_list):
+            if not isinstance(response, (responses.Continue, responses.Success)):
+                logger.error("get_message failed for bMessage '%s'. reason = %s", name, response)
+                return MessageResult(name, None, None, response)
+            returned_headers += response.header_data
+        response = self._collect_parts(returned_headers)
+        if self.message_cache is not None:
+            self.message_cache.put(cache_key, response, size=len(response[1]))
+        return MessageResult(name, response[0], response[1], None)
+
+    def get_message_parts(self, name, attachment=1, charset=1, buffer_size=bmessage.DEFAULT_BUFFER_SIZE,
+                          sink_factory=None, use_srm=True):
+        """Retrieves a message and yields its parts (see mapbmessage.BMessageParser)
+        while it is being transferred, so attachments are spooled to disk (or to
+        sink_factory(headers)) instead of being held in memory. Not cached.
+        Requests must not be sent on this connection until all parts are consumed."""
+        logger.info("Requesting get_message_parts with parameters %s", str(locals()))
+        header_list = self._message_header_list(attachment, charset)
+        parser = bmessage.BMessageParser(buffer_size, sink_factory)
+        for response in (self._srm_get if use_srm else self._get)(name, header_list):
+            if not isinstance(response, (responses.Continue, responses.Success)):
+                logger.error("get_message_parts failed for bMessage '%s'. reason = %s", name, response)
+                return
+            _, body = self._collect_parts(response.header_data)
+            for part in parser.feed(body):
+                yield part
+        for part in parser.close():
+            yield part
+
+    def get_message_fraction(self, name, fraction_request=FRACTION_FIRST, attachment=1, charset=1):
+        """Retrieves the first (FRACTION_FIRST) or next (FRACTION_NEXT) fraction of an
+        email, returns a MessageFraction. MSEs not splitting the email return all of it
+        as the last fraction. Fractions are not cached."""
+        logger.info("Requesting get_message_fraction with parameters %s", str(locals()))
+        header_list = self._message_header_list(attachment, charset, fraction_request)
+        returned_headers = []
+        for response in self._get(name, header_list):
+            if not isinstance(response, (responses.Continue, responses.Success)):
+                logger.error("get_message_fraction failed for bMessage '%s'. reason = %s", name, response)
+                return
+            returned_headers += response.header_data
+        response_headers, body = self._collect_parts(returned_headers)
+        return MessageFraction(name, response_headers, body, self._more_fractions(response_headers))
+
+    def iter_message_fractions(self, name, attachment=1, charset=1):
+        """Yields the MessageFractions of an email. A fraction is only requested
+        once the previous one was consumed, stop iterating to skip the rest."""
+        fraction_request = FRACTION_FIRST
+        while True:
+            fraction = self.get_message_fraction(name, fraction_request, attachment, charset)
+            if fraction is None:
+                return
+            yield fraction
+            if not fraction.more:
+                return
+            fraction_request = FRACTION_NEXT
+
+    @staticmethod
+    def _more_fractions(response_headers):
+        """Returns whether the FractionDeliver of a response announces further fractions"""
+        for header in response_headers:
+            if isinstance(header, headers.App_Parameters):
+                app_params = header.decode()
+                if "FractionDeliver" in app_params:
+                    return app_params["FractionDeliver"].decode() == FRACTION_MORE
+        return False
+
+    @staticmethod
+    def _message_header_list(attachment, charset, fraction_request=None):
         data = {"Attachment": headers.Attachment(attachment),
                 "Charset": headers.Charset(charset)
                 }
+        if fraction_request is not None:
+            data["FractionRequest"] = headers.FractionRequest(fraction_request)
 
         application_parameters = headers.App_Parameters(data, encoded=False)
-        header_list = [headers.Type("x-bt/message")]
+        header_list = [headers.Type(b"x-bt/message")]
         if application_parameters.data:
             header_list.append(application_parameters)
+        return header_list
 
-        response = self.get(name, header_list)
-        if not isinstance(response, tuple) and isinstance(response, responses.FailureResponse):
-            logger.error("get_messages_listing failed for bMessage '%s'. reason = %s", name, response)
+    def _srm_get(self, name=None, header_list=()):
+        """Same as client.Client._get, but asks for OBEX Single Response Mode. If the MSE enables it,
+        the remaining responses are received without sending a GET request for each of them"""
+        header_list = [headers.SingleResponseMode(headers.SRM_ENABLE)] + list(header_list)
+        if name is not None:
+            header_list = [headers.Name(name)] + header_list
+        max_length = self.remote_info.max_packet_length
+        request = requests.Get()
+        response = self._send_headers(request, header_list, max_length)
+        yield response
+        if not isinstance(response, (responses.Continue, responses.Success)):
             return
-        return response
-    
+
+        srm_enabled = False
+        request = requests.Get_Final()
+        while isinstance(response, responses.Continue):
+            srm_wait = False
+            for header in response.header_data:
+                if isinstance(header, headers.SingleResponseModeParameter):
+                    srm_wait = header.decode() == headers.SRMP_WAIT
+                elif isinstance(header, headers.SingleResponseMode):
+                    srm_enabled = header.decode() == headers.SRM_ENABLE
+            if not srm_enabled or srm_wait:
+                self.socket.sendall(request.encode())
+            response = self.response_handler.decode(self.socket)
+            yield response
+
     def set_msg_folder(self, name="", to_parent=False, to_root=False):
         """Sets the current folder in the virtual folder architecture"""
         logger.info("Setting current folder with params '%s'", str(locals()))
@@ -96,62 +491,68 @@ class MAPClient(client.Client):
             logger.error("Not a valid action, "
                          "either name should be not empty or to_parent/to_root should be True")
             return
-        # TODO: not exactly as per spec, limited by pyobex setpath. need to refine further
         if to_root:
-            path_comp = self.current_dir.split("/")[1:]
-            if not any(path_comp):
+            if self.current_dir == "/":
                 logger.warning("Path is already in root folder, no need to change")
                 return
-            for _ in path_comp:
-                response = self.setpath(to_parent=True)
+            return self._setpath_op("root", "")
         elif to_parent:
             if self.current_dir == "/":
                 logger.warning("Path is already in root folder, can't go to parent dir")
                 return
-            response = self.setpath(to_parent=True)
+            return self._setpath_op("up", "")
         else:
-            response = self.setpath(name)
+            return self._setpath_op("down", name)
 
-        if not isinstance(response, tuple) and isinstance(response, responses.FailureResponse):
-            logger.error("set_phonebook failed. reason = %s", name, response)
+    def set_msg_folder_path(self, path):
+        """Sets the current folder to path (absolute or relative to the current folder)
+        using the fewest SETPATH operations"""
+        logger.info("Setting current folder path to '%s'", path)
+        target = self._setpath_target(path)
+        if target is None:
             return
+        response = responses.Success()  # already in the target folder
+        for action, name in self._setpath_plan(self.current_dir, target):
+            response = self._setpath_op(action, name)
+            if response is None:
+                return
+        return response
 
-        if to_root:
-            self.current_dir = "/"
-        elif to_parent:
-            self.current_dir = os.path.dirname(self.current_dir)
-        else:
-            self.current_dir = os.path.join(self.current_dir, name)
+    def _setpath_op(self, action, name):
+        """Sends one SETPATH of a plan and tracks the current folder"""
+        response = self.setpath(name, to_parent=action == "up")
+        if not self._setpath_done(action, name, response):
+            return
         return response
     
-    def set_msg_status(self,name='',status_indicator=1,status_value=''):
+    def set_msg_status(self,name='',status_indicator=1,status_value=0):
         '''Modify the status of a message on the MSE.'''
         logger.info("Requesting set_msg_status with parameters %s", str(locals()))
+        header_list = self._msg_status_header_list(status_indicator, status_value)
+        response = self.put(name, b"0", header_list=header_list)
+        if not isinstance(response, tuple) and isinstance(response, responses.FailureResponse):
+            logger.error("Modify the status to %s of message %s fail'. reason = %s", name,status_value, response)
+            return
+        # Deleted messages are gone and the bMessage STATUS of read/unread ones changed
+        self._invalidate_messages(name)
+        return response
+
+    @staticmethod
+    def _msg_status_header_list(status_indicator, status_value):
         data = {"StatusIndicator": headers.StatusIndicator(status_indicator),
                 "StatusValue": headers.StatusValue(status_value)
                 }
         application_parameters = headers.App_Parameters(data, encoded=False)
-        header_list = [headers.Type("x-bt/messageStatus")]
+        header_list = [headers.Type(b"x-bt/messageStatus")]
         if application_parameters.data:
             header_list.append(application_parameters)
-        response = self.put(name,'01',header_list=header_list)
-        if not isinstance(response, tuple) and isinstance(response, responses.FailureResponse):
-            logger.error("Modify the status to %s of message %s fail'. reason = %s", name,status_value, response)
-            return
-        return response
+        return header_list
         
     def push_message(self,name,file_name='0123',transparent=0,retry=1,charset=1):
         """Push a message to a folder of the MSE"""
         logger.info("Requesting push_message with parameters %s", str(locals()))
-        data = {"Transparent": headers.Transparent(transparent),
-                "Retry": headers.Retry(retry),
-                "Charset": headers.Charset(charset)
-                }
         file_path=sys.path[0]+os.sep+'test'+os.sep+'data'+os.sep+file_name
-        application_parameters = headers.App_Parameters(data, encoded=False)
-        header_list = [headers.Type("x-bt/message")]
-        if application_parameters.data:
-            header_list.append(application_parameters)
+        header_list = self._push_message_header_list(transparent, retry, charset)
         with open(file_path,'r') as f:
             file_data=f.readlines()
             response = self.put(name,''.join(file_data),header_list)
@@ -161,18 +562,192 @@ class MAPClient(client.Client):
             return response
         logger.error(" Read bMessage data fail")
         return
+
+    @staticmethod
+    def _push_message_header_list(transparent, retry, charset):
+        data = {"Transparent": headers.Transparent(transparent),
+                "Retry": headers.Retry(retry),
+                "Charset": headers.Charset(charset)
+                }
+        application_parameters = headers.App_Parameters(data, encoded=False)
+        header_list = [headers.Type(b"x-bt/message")]
+        if application_parameters.data:
+            header_list.append(application_parameters)
+        return header_list
         
     def update_inbox(self,name=''):
         '''Initiate an update of the MSE's inbox'''
         logger.info("Requesting set_msg_status with parameters %s", str(locals()))
 
-        header_list = [headers.Type("x-bt/MAP-messageUpdate")]
-        response = self.put(name,'00',header_list=header_list)
+        header_list = [headers.Type(b"x-bt/MAP-messageUpdate")]
+        response = self.put(name, b"0", header_list=header_list)
         if not isinstance(response, tuple) and isinstance(response, responses.FailureResponse):
             logger.error("Initiate an update of the MSE's inbox fail'. reason = %s", response)
             return
+        self._invalidate_messages()
         return response
-        
+
+    def set_notification_registration(self, status=1):
+        """Asks the MSE to connect to our MNS and report events (status=1), or to stop (status=0)"""
+        logger.info("Requesting set_notification_registration with parameters %s", str(locals()))
+        data = {"NotificationStatus": headers.NotificationStatus(status)}
+        header_list = [headers.Type(b"x-bt/MAP-NotificationRegistration"),
+                       headers.App_Parameters(data, encoded=False)]
+        response = self.put("", b"0", header_list=header_list)
+        if not isinstance(response, tuple) and isinstance(response, responses.FailureResponse):
+            logger.error("set_notification_registration to %s failed. reason = %s", status, response)
+            return
+        return response
+
+    def set_notification_filter(self, filter_mask):
+        """Selects the event types the MSE reports, filter_mask is a NotificationFilterMask
+        (see mapmns.filter_mask). Only supported by MSEs implementing MAP 1.3 or later."""
+        logger.info("Requesting set_notification_filter with parameters %s", str(locals()))
+        data = {"NotificationFilterMask": headers.NotificationFilterMask(filter_mask)}
+        header_list = [headers.Type(b"x-bt/MAP-notification-filter"),
+                       headers.App_Parameters(data, encoded=False)]
+        response = self.put("", b"0", header_list=header_list)
+        if not isinstance(response, tuple) and isinstance(response, responses.FailureResponse):
+            logger.error("set_notification_filter to 0x%08X failed. reason = %s", filter_mask, response)
+            return
+        return response
+
+
+class MASSessionManager(object):
+    """Connections to all MAS instances (e.g. SMS/MMS and email) of a device.
+
+    Listing and download work is run on all instances in parallel and
+    the results are merged into one stream of (instance id, item) tuples.
+    PyBluez doesn't report the MASInstanceID SDP attribute, so instances
+    are numbered in the order of their RFCOMM channels. MNS events carry
+    the MASInstanceID of the MSE, so they are only matched correctly if
+    the MSE numbers its instances the same way.
+    """
+
+    def __init__(self, address, message_cache=None):
+        self.address = address
+        self.message_cache = message_cache
+        self.clients = collections.OrderedDict()  # instance id: MAPClient
+        self.services = {}  # instance id: SDP record
+        self.mailbox = mapmns.MailboxState()
+        self.mns_server = None
+        self._mns_socket = None
+        self._mns_advertised = False
+
+    def discover(self):
+        """Returns the SDP records of all MAS instances of the device"""
+        logger.info("Finding MAP services ...")
+        services = bluetooth.find_service(address=self.address, uuid=MAP_PROFILE_ID)
+        return sorted(services, key=lambda service: service["port"])
+
+    def connect(self, services=None):
+        """Connects to every discovered MAS instance, returns the connected clients"""
+        if services is None:
+            services = self.discover()
+        for instance_id, service in enumerate(services):
+            client = MAPClient(service["host"], service["port"], message_cache=self.message_cache)
+            client.mas_instance_id = instance_id
+            logger.info("Connecting to MAS instance %d '%s' = (%s, %s)", instance_id, service.get("name"),
+                        service["host"], service["port"])
+            result = client.connect(header_list=[headers.Target(MAS_TARGET_UUID)])
+            if not isinstance(result, responses.ConnectSuccess):
+                logger.error("Connect to MAS instance %d failed. reason = %s", instance_id, result)
+                continue
+            self.clients[instance_id] = client
+            self.services[instance_id] = service
+        return self.clients
+
+    def disconnect(self):
+        if self.mns_server is not None:
+            self.stop_notifications()
+        for instance_id, client in self.clients.items():
+            logger.debug("Disconnecting MAS instance %d", instance_id)
+            client.disconnect()
+        self.clients.clear()
+        self.services.clear()
+
+    def map(self, func):
+        """Runs func(client) on all instances in parallel, func returns an iterable.
+        Yields (instance id, item) for the items of all instances as they arrive."""
+        return common.merge_parallel(
+            dict((instance_id, functools.partial(func, client)) for instance_id, client in self.clients.items()))
+
+    def set_msg_folder_path(self, path):
+        """Sets the current folder of all instances, returns the ids of the failed ones"""
+        return [instance_id for instance_id, response in self.map(lambda client: [client.set_msg_folder_path(path)])
+                if response is None]
+
+    def walk_messages_listing(self, name, page_size=1024, **filters):
+        """Yields (instance id, MessageRecord) for the messages listing of all instances"""
+        return self.map(lambda client: client.walk_messages_listing(name, page_size, **filters))
+
+    def get_messages(self, handles, attachment=1, charset=1, use_srm=True):
+        """Downloads messages from all instances in parallel, handles is a
+        {instance id: handles} dict. Yields (instance id, MessageResult)."""
+        return common.merge_parallel(
+            dict((instance_id, functools.partial(self.clients[instance_id].get_messages, instance_handles,
+                                                 attachment, charset, use_srm))
+                 for instance_id, instance_handles in handles.items()))
+
+    def track_folder(self, path, page_size=1024):
+        """Loads the messages of folder path of all instances into mailbox,
+        MNS events keep them up to date afterwards. Returns the ids of the failed instances."""
+        failed = self.set_msg_folder_path(path)
+        records = dict((instance_id, []) for instance_id in self.clients if instance_id not in failed)
+        for instance_id, record in self.map(lambda client: client.walk_messages_listing("", page_size)
+                                            if client.mas_instance_id in records else []):
+            records[instance_id].append(record)
+        for instance_id, instance_records in records.items():
+            self.mailbox.load(instance_id, path, instance_records)
+        return failed
+
+    def start_notifications(self, filter_mask=None, listen_socket=None):
+        """Starts the MNS server and registers it with all instances, so new,
+        deleted, moved and read messages are applied to mailbox as they happen
+        instead of polling with update_inbox. Without listen_socket the MNS is
+        offered as RFCOMM service. Returns the ids of the failed instances.
+        """
+        self.mns_server = mapmns.MNSServer("", self._on_event)
+        self._mns_advertised = listen_socket is None
+        if listen_socket is None:
+            listen_socket = self.mns_server.start_service()
+        self._mns_socket = listen_socket
+        thread = threading.Thread(target=self._serve_notifications, args=(self.mns_server, listen_socket),
+                                  name="mns-server")
+        thread.daemon = True
+        thread.start()
+        failed = []
+        for instance_id, client in self.clients.items():
+            if filter_mask is not None and client.set_notification_filter(filter_mask) is None:
+                logger.info("MAS instance %d doesn't filter events, all of them are reported", instance_id)
+            if client.set_notification_registration(1) is None:
+                failed.append(instance_id)
+        return failed
+
+    def stop_notifications(self):
+        for client in self.clients.values():
+            client.set_notification_registration(0)
+        if self._mns_advertised:
+            self.mns_server.stop_service(self._mns_socket)
+        self._mns_socket.close()
+        self.mns_server = None
+        self._mns_socket = None
+
+    @staticmethod
+    def _serve_notifications(mns_server, listen_socket):
+        try:
+            mns_server.serve(listen_socket)
+        except IOError:
+            logger.debug("MNS server stopped")
+
+    def _on_event(self, instance_id, event):
+        client = self.clients.get(instance_id)
+        if client is not None and event.handle and event.type in mapmns.SYNC_EVENTS:
+            client._invalidate_messages(event.handle)
+        if self.mailbox.apply(instance_id, event):
+            logger.info("MAS instance %d: applied %s", instance_id, event)
+
+
 class REPL(cmd2.Cmd):
     """REPL to use MAP client"""
 
@@ -181,6 +756,8 @@ class REPL(cmd2.Cmd):
         self.prompt = self.colorize("map> ", "yellow")
         self.intro = self.colorize("Welcome to the MAP Access Profile!", "green")
         self.client = None
+        self.sessions = None
+        self.sync_state = None
         self._store_history()
         cmd2.set_use_arg_list(False)
 
@@ -193,30 +770,32 @@ class REPL(cmd2.Cmd):
         readline.read_history_file(history_file)
         atexit.register(readline.write_history_file, history_file)
 
-    @cmd2.options([], arg_desc="server_address")
+    @cmd2.options([make_option('--cache-entries', default=0, type=int,
+                               help="cache up to this many retrieved bMessages (0 disables the cache)"),
+                   make_option('--cache-bytes', default=4 * 1024 * 1024, type=int,
+                               help="maximum total size of cached bMessages"),
+                   ],
+                  arg_desc="server_address")
     def do_connect(self, line, opts):
-        profile_id = "1134"  # profile id of MAP
         #service_id = "\x79\x61\x35\xf0\xf0\xc5\x11\xd8\x09\x66\x08\x00\x20\x0c\x9a\x66"
         server_address = line
         if not server_address:
             raise ValueError("server_address should not be empty")
-        logger.info("Finding MAP service ...")
-        services = bluetooth.find_service(address=server_address, uuid=profile_id)
+        message_cache = None
+        if opts.cache_entries > 0:
+            message_cache = common.LRUCache(max_entries=opts.cache_entries, max_bytes=opts.cache_bytes)
+        self.sessions = MASSessionManager(server_address, message_cache=message_cache)
+        services = self.sessions.discover()
         if not services:
             sys.stderr.write("No MAP service found\n")
             sys.exit(1)
+        logger.info("%d MAP service(s) found!", len(services))
 
-        host = services[0]["host"]
-        port = services[0]["port"]
-        logger.info("MAP service found!")
-
-        self.client = MAPClient(host, port)
-        logger.info("Connecting to pbap server = (%s, %s)", host, port)
-        result = self.client.connect(header_list=[headers.Target(MAS_TARGET_UUID)])
-        if not isinstance(result, responses.ConnectSuccess):
+        if not self.sessions.connect(services):
             logger.error("Connect Failed, Terminating the MAP client..")
             sys.exit(2)
-        logger.info("Connect success")
+        instance_id, self.client = next(iter(self.sessions.clients.items()))
+        logger.info("Connect success, using MAS instance %d", instance_id)
         self.prompt = self.colorize("map> ", "green")
 
     @cmd2.options([], arg_desc="")
@@ -225,18 +804,39 @@ class REPL(cmd2.Cmd):
             logger.error("MAPClient is not even connected.. Connect and then try disconnect")
             sys.exit(2)
         logger.debug("Disconnecting pbap client with pbap server")
-        self.client.disconnect()
+        self.sessions.disconnect()
         self.client = None
         self.prompt = self.colorize("map> ", "yellow")
 
+    @cmd2.options([], arg_desc="")
+    def do_list_instances(self, line, opts):
+        """Lists the connected MAS instances"""
+        for instance_id, service in self.sessions.services.items():
+            logger.info("MAS instance %d: %s (channel %s)%s", instance_id, service.get("name"), service["port"],
+                        " [selected]" if self.sessions.clients[instance_id] is self.client else "")
+
+    @cmd2.options([], arg_desc="instance_id")
+    def do_select_instance(self, line, opts):
+        """Selects the MAS instance used by the other commands"""
+        try:
+            self.client = self.sessions.clients[int(line)]
+        except (ValueError, KeyError):
+            logger.error("Unknown MAS instance '%s'", line)
+
     @cmd2.options([make_option('-c', '--max-count', default=1024, type=int,
                                help="maximum number of contacts to be returned"),
                    make_option('-o', '--start-offset', default=0, type=int,
                                help="offset of first entry to be returned"),
+                   make_option('-a', '--all', action="store_true", default=False,
+                               help="return all folders, requested in pages of max-count entries"),
                    ],
                   arg_desc="MSG_folder")
     def do_get_folder_listing(self, line,opts):
         """Returns folders as per requested options"""
+        if opts.all:
+            for record in self.client.walk_folder_listing(page_size=opts.max_count):
+                logger.info("Result of get_folder_listing: %s", record)
+            return
         result = self.client.get_folder_listing(max_list_count=opts.max_count, 
                                         list_startoffset=opts.start_offset)
         if result is not None:
@@ -247,10 +847,13 @@ class REPL(cmd2.Cmd):
                                help="maximum number of contacts to be returned"),
                    make_option('-o', '--start-offset', default=0, type=int,
                                help="offset of first entry to be returned"),
-                   #make_option('-o', '--subject-length', default=255, type=int,
-                   #            help="maximum string-length of subject to be returned"),
-                   #make_option('-o', '--parameter-mask', default=0, type=int,
-                   #            help="parameters containe in the messages returned"),
+                   make_option('-l', '--subject-length', default=None, type=int,
+                               help="maximum string-length of subject to be returned"),
+                   make_option('-p', '--parameter-mask', default=None, type=int,
+                               help="parameters containe in the messages returned (0 for all)"),
+                   make_option('-f', '--fields', default=None,
+                               help="named parameter set (handles-only, triage, full) "
+                                    "or comma separated msg attributes to be returned"),
                    make_option('-t', '--filter-messageType', default=0, type=int,
                                help="filter the messages type to be returned"),
                    #make_option('-o', '--filter-periodBegin', default=0, type=int,
@@ -271,14 +874,43 @@ class REPL(cmd2.Cmd):
                    #            help="report the Local Time basis of the MSE and its UTC offset,"),
                    #make_option('-o', '--listing-size', default=0, type=int,
                    #            help="report the number of accessible messages"),
+                   make_option('-a', '--all', action="store_true", default=False,
+                               help="return all messages, requested in pages of max-count entries"),
+                   make_option('-i', '--all-instances', action="store_true", default=False,
+                               help="return all messages of all MAS instances"),
                    ],
                   arg_desc="messags_list")
     def do_get_messages_listing(self, line, opts):
         """Returns Messages_isting as per requested options"""
-        result = self.client.get_messages_listing(name=line,max_list_count=opts.max_count,
+        fields = opts.fields
+        if opts.parameter_mask is not None:
+            fields = listing.mask_fields(opts.parameter_mask)
+        elif fields is not None and fields not in listing.FIELD_SETS:
+            fields = [field.strip() for field in fields.split(",") if field.strip()]
+        try:
+            listing.resolve_fields(fields)
+        except ValueError as err:
+            logger.error("%s", err)
+            return
+        if opts.all_instances:
+            for instance_id, record in self.sessions.walk_messages_listing(
+                    line, page_size=opts.max_count, filter_messageType=opts.filter_messageType,
+                    filter_readStatus=opts.filter_readStatus, new_message=opts.new_message,
+                    fields=fields, subject_length=opts.subject_length):
+                logger.info("Result of get_messages_listing [MAS %d]: %s", instance_id, record)
+            return
+        if opts.all:
+            for record in self.client.walk_messages_listing(name=line, page_size=opts.max_count,
+                                                            filter_messageType=opts.filter_messageType,
+                                                            filter_readStatus=opts.filter_readStatus,
+                                                            new_message=opts.new_message,
+                                                            fields=fields, subject_length=opts.subject_length):
+                logger.info("Result of get_messages_listing: %s", record)
+            return
+        records = self.client.iter_messages_listing(name=line,max_list_count=opts.max_count,
                                                   list_startoffset=opts.start_offset,
-                                                  #subject_length=opts.subject_length,
-                                                  #parameter_mask=opts.parameter_mask,
+                                                  subject_length=opts.subject_length,
+                                                  fields=fields,
                                                   filter_messageType=opts.filter_messageType,
                                                   #filter_periodBegin=opts.filter_periodBegin,
                                                   #filter_periodEnd=opts.filter_periodEnd,
@@ -290,16 +922,31 @@ class REPL(cmd2.Cmd):
                                                   #mse_time=opts.mse_time,
                                                   #listing_size=opts.listing_size
                                                   )
-        if result is not None:
-            header, data = result
-            logger.info("Result of get_messages_listing:\n%s", data)
+        for record in records:
+            logger.info("Result of get_messages_listing: %s", record)
 
     @cmd2.options([make_option('-a', '--attachment', default=1, type=int,help="determine to shall remove any element with a MIME type different than “text/…”"),
-                   make_option('-c', '--charset', default=1, type=int,help="determine the transcoding of the textual parts of the delivered bMessage-content")
+                   make_option('-c', '--charset', default=1, type=int,help="determine the transcoding of the textual parts of the delivered bMessage-content"),
+                   make_option('-f', '--fractions', default=None, choices=["first", "all"],
+                               help="retrieve an email in fractions, only the first or all of them"),
+                   make_option('-p', '--parts', action="store_true", default=False,
+                               help="parse the message while it is retrieved, spooling large parts to disk")
                    ],
                   arg_desc="message")
     def do_get_message(self, line, opts):
         """Returns get_message as per requested options"""
+        if opts.parts:
+            for part in self.client.get_message_parts(line, attachment=opts.attachment, charset=opts.charset):
+                logger.info("Part of get_message: %s", part)
+            return
+        if opts.fractions:
+            for fraction in self.client.iter_message_fractions(line, attachment=opts.attachment,
+                                                               charset=opts.charset):
+                logger.info("Result of get_message (%s):\n%s", "more follow" if fraction.more else "last",
+                            fraction.body)
+                if fraction.more and opts.fractions == "first":
+                    break
+            return
         result = self.client.get_message(name=line,
                                          attachment=opts.attachment,
                                          charset=opts.charset
@@ -308,13 +955,30 @@ class REPL(cmd2.Cmd):
             header, data = result
             logger.info("Result of get_message:\n%s", data)
 
+    @cmd2.options([make_option('-a', '--attachment', default=1, type=int,help="determine to shall remove any element with a MIME type different than “text/…”"),
+                   make_option('-c', '--charset', default=1, type=int,help="determine the transcoding of the textual parts of the delivered bMessage-content"),
+                   make_option('--no-srm', action="store_true", default=False,help="don't request OBEX Single Response Mode")
+                   ],
+                  arg_desc="message [message ...]")
+    def do_get_messages(self, line, opts):
+        """Returns the given messages, downloaded one after another"""
+        for result in self.client.get_messages(line.split(), attachment=opts.attachment,
+                                               charset=opts.charset, use_srm=not opts.no_srm):
+            if result.error is None:
+                logger.info("Result of get_messages for %s:\n%s", result.handle, result.body)
+            else:
+                logger.error("get_messages failed for %s. reason = %s", result.handle, result.error)
+
     @cmd2.options([make_option('--to-parent', action="store_true", default=False,help="navigate to parent dir"),
                    make_option('--to-root', action="store_true", default=False,help="navigate to root dir")
                    ],
-                  arg_desc="[folder_name]")
+                  arg_desc="[folder_name|folder_path]")
     def do_set_msg_folder(self, line, opts):
         """Set current folder path of pbapserver virtual folder"""
-        result = self.client.set_msg_folder(name=line, to_parent=opts.to_parent, to_root=opts.to_root)
+        if "/" in line:
+            result = self.client.set_msg_folder_path(line)
+        else:
+            result = self.client.set_msg_folder(name=line, to_parent=opts.to_parent, to_root=opts.to_root)
         if result is not None:
             logger.info("Result of set_msg_folder:\n%s", result)
     
@@ -344,6 +1008,14 @@ class REPL(cmd2.Cmd):
         # if result is not None:
             # header, data = result
             # logger.info("Result of push_message:\n%s", data)
+    @cmd2.options([], arg_desc="")
+    def do_message_cache_stats(self, line, opts):
+        """Logs the counters of the bMessage cache"""
+        if self.client.message_cache is None:
+            logger.error("Message cache is not enabled, connect with --cache-entries")
+            return
+        logger.info("Message cache stats: %s", self.client.message_cache.stats())
+
     @cmd2.options([],
                   arg_desc="update_inbox")
     def do_update_inbox(self,line,opts):
@@ -351,6 +1023,61 @@ class REPL(cmd2.Cmd):
         if result is not None:
             logger.info("Result of update_inbox:\n%s", result)
             
+    @cmd2.options([make_option('-e', '--events', default=",".join(mapmns.SYNC_EVENTS),
+                               help="comma separated event types to be reported (MAP 1.3 MSEs only)"),
+                   make_option('--off', action="store_true", default=False,
+                               help="stop the event reports"),
+                   ],
+                  arg_desc="")
+    def do_register_notifications(self, line, opts):
+        """Keeps the tracked folders up to date with the event reports of the MSE"""
+        if opts.off:
+            self.sessions.stop_notifications()
+            return
+        try:
+            mask = mapmns.filter_mask(event.strip() for event in opts.events.split(",") if event.strip())
+        except KeyError as err:
+            logger.error("Unknown event type %s, known ones are %s", err, ", ".join(mapmns.EVENT_FILTER_BITS))
+            return
+        failed = self.sessions.start_notifications(filter_mask=mask)
+        if failed:
+            logger.error("Registration failed for MAS instance(s) %s", failed)
+
+    @cmd2.options([make_option('-c', '--page-size', default=1024, type=int,
+                               help="number of messages requested per listing"),
+                   ],
+                  arg_desc="folder_path")
+    def do_track_folder(self, line, opts):
+        """Lists a folder of all instances once, later changes come from the event reports"""
+        failed = self.sessions.track_folder(line, page_size=opts.page_size)
+        if failed:
+            logger.error("Folder %s couldn't be tracked for MAS instance(s) %s", line, failed)
+
+    @cmd2.options([], arg_desc="folder_path")
+    def do_show_folder(self, line, opts):
+        """Logs the messages of a tracked folder"""
+        for instance_id in self.sessions.clients:
+            messages = self.sessions.mailbox.messages(instance_id, line)
+            if messages is None:
+                logger.error("Folder %s of MAS instance %d is not tracked", line, instance_id)
+                continue
+            for record in messages:
+                logger.info("MAS instance %d: %s read=%s", instance_id, record, record.read)
+
+    @cmd2.options([make_option('-s', '--state', default=os.path.expanduser('~/.mapclient_sync.db'),
+                               help="file keeping the folder versions and snapshots between runs"),
+                   make_option('-c', '--page-size', default=1024, type=int,
+                               help="number of messages requested per listing"),
+                   ],
+                  arg_desc="MSG_folder")
+    def do_sync_folder(self, line, opts):
+        """Reports the messages added, removed and modified since the last sync of a folder"""
+        if self.sync_state is None:
+            self.sync_state = mapsync.SyncState(opts.state)
+        delta = mapsync.DeltaSync(self.client, self.sync_state).sync_folder(line, page_size=opts.page_size)
+        if delta is not None:
+            logger.info("Result of sync_folder: %s", delta)
+
     do_q = cmd2.Cmd.do_quit
 
 
@@ -3,6 +3,16 @@
 # -*- coding: utf-8 -*-
 """Common tools and attributes for pbap client and server"""
 
+import collections
+import functools
+import logging
+import queue
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
 FILTER_ATTR_DICT = {
     0: ('VERSION', 'vCard Version'),
     1: ('FN', 'Formatted Name'),
@@ -82,3 +92,195 @@ MANDATORY_ATTR_BITMASK = {
     "2.1": int("10000101", 2),
     "3.0": int("10000111", 2)
 }
+
+
+@functools.lru_cache(maxsize=64)
+def filter_attributes(filter_bitmask, vcard_version="2.1"):
+    """Returns the frozenset of vCard attributes selected by a Filter bitmask,
+    including the mandatory ones of vcard_version. None if filter_bitmask is 0,
+    which selects all attributes."""
+    if filter_bitmask == 0:
+        return None
+    filter_bitmask |= MANDATORY_ATTR_BITMASK[vcard_version]
+    return frozenset(attr for bitmarker, (attr, _) in FILTER_ATTR_DICT.items() if filter_bitmask >> bitmarker & 1)
+
+
+def filter_vcard(vcard, filter_bitmask, vcard_version="2.1"):
+    """Returns vcard (a parsed vCard record) reduced to the attributes selected
+    by filter_bitmask. vcard itself is left untouched, so records can be
+    shared between requests."""
+    attrs = filter_attributes(filter_bitmask, vcard_version)
+    if attrs is None:
+        return vcard
+    filtered = dict(vcard)
+    filtered["vcard"] = [param for param in vcard["vcard"] if param["type"] in attrs]
+    return filtered
+
+
+def read_ahead(iterable, depth=1):
+    """Yields the items of iterable while the next depth items are produced
+    in a background thread.
+
+    Used to overlap requests to the remote device with the processing of
+    the previous result. The producer is stopped and joined when the
+    returned generator is closed, so the connection is idle afterwards.
+    """
+    items = queue.Queue()
+    slots = threading.Semaphore(depth)
+    stopped = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put((item, None))
+                slots.acquire()
+                if stopped.is_set():
+                    return
+        except Exception:
+            items.put((None, sys.exc_info()[1]))
+        finally:
+            items.put((done, None))
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+            slots.release()
+    finally:
+        stopped.set()
+        slots.release()
+        producer.join()
+
+
+def merge_parallel(producers, queue_size=64):
+    """Consumes the iterables returned by the callables of a {key: callable}
+    dict in parallel, one thread each, and yields (key, item) in the order
+    the items arrive. The callables are called in their thread, so blocking
+    work done before the first item runs in parallel too.
+
+    An iterable that raises is logged and dropped, the others continue.
+    The threads are stopped and joined when the returned generator is closed.
+    """
+    items = queue.Queue(queue_size)
+    stopped = threading.Event()
+    done = object()
+
+    def consume(key, producer):
+        try:
+            for item in producer():
+                while not stopped.is_set():
+                    try:
+                        items.put((key, item), timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stopped.is_set():
+                    return
+        except Exception:
+            logger.exception("Parallel work for %s failed", key)
+        finally:
+            items.put((key, done))
+
+    threads = [threading.Thread(target=consume, args=(key, producer)) for key, producer in producers.items()]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        running = len(threads)
+        while running:
+            key, item = items.get()
+            if item is done:
+                running -= 1
+                continue
+            yield key, item
+    finally:
+        stopped.set()
+        # unblock threads waiting for space, they see the stop flag
+        while any(thread.is_alive() for thread in threads):
+            try:
+                items.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for thread in threads:
+            thread.join()
+
+
+class LRUCache(object):
+    """Least recently used cache bounded by entry count and total size.
+
+    The size of an entry is given when it is stored (e.g. length of the
+    cached body). With ttl, entries expire ttl seconds after being stored.
+    hits, misses, evictions, expirations and invalidations are counted
+    to help sizing the cache.
+    """
+
+    def __init__(self, max_entries=128, max_bytes=None, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._entries = collections.OrderedDict()  # key: (value, size, expiry time)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] <= time.monotonic():
+                self.size -= self._entries.pop(key)[1]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size=None):
+        size = len(value) if size is None else size
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        expiry = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size, expiry)
+            self.size += size
+            while len(self._entries) > self.max_entries or \
+                    (self.max_bytes is not None and self.size > self.max_bytes):
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, predicate=None):
+        """Removes the entries whose key matches predicate (all entries if not given)"""
+        with self._lock:
+            keys = [key for key in self._entries if predicate is None or predicate(key)]
+            for key in keys:
+                self.size -= self._entries.pop(key)[1]
+            self.invalidations += len(keys)
+        return len(keys)
+
+    def stats(self):
+        return {"entries": len(self._entries), "size": self.size, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions, "expirations": self.expirations,
+                "invalidations": self.invalidations}
@@ -7,211 +7,349 @@ from PyOBEX.headers import *
 from mapcommon import FILTER_ATTR_DICT
 
 
+# Single Response Mode headers (GOEP 2.0), let the server stream all
+# responses of an operation without waiting for a request per packet
+SRM_ENABLE = 0x01
+SRMP_WAIT = 0x01
+
+
+class SingleResponseMode(ByteHeader):
+    code = 0x97
+
+    def decode(self):
+        # received one byte headers carry the value as int
+        return self.data if isinstance(self.data, int) else struct.unpack(">B", self.data[-1:])[0]
+
+
+class SingleResponseModeParameter(SingleResponseMode):
+    code = 0x98
+
+
+header_dict.update({
+    SingleResponseMode.code: SingleResponseMode,
+    SingleResponseModeParameter.code: SingleResponseModeParameter
+})
+
+
 # Application Parameters Header Properties
+class AppParamCodec(object):
+    """Encoder/decoder of a single application parameter tag.
+
+    Tag, length and value are packed with one precompiled struct. The
+    known constant values of enum and flag tags (values of the property
+    class) are packed once up front, other values on every call.
+    """
+    __slots__ = ("tagid", "length", "packer", "_cache")
+
+    def __init__(self, tagid, fmt=None, values=()):
+        self.tagid = tagid
+        if fmt is None:
+            self.packer = struct.Struct(">BB")
+            self.length = None
+        else:
+            self.packer = struct.Struct(">BB" + fmt.lstrip(">"))
+            self.length = self.packer.size - 2
+        self._cache = dict((value, self.packer.pack(tagid, self.length, value)) for value in values)
+
+    def encode(self, value):
+        if self.length is None:
+            if not isinstance(value, bytes):
+                value = value.encode("utf-8")
+            if len(value) > 0xFF:
+                raise ValueError("Application parameter 0x{:02X} exceeds 255 bytes".format(self.tagid))
+            return self.packer.pack(self.tagid, len(value)) + value
+        data = self._cache.get(value)
+        if data is None:
+            data = self.packer.pack(self.tagid, self.length, value)
+        return data
+
+    def decode(self, buffer, offset, length):
+        """Decodes the value of the tag stored at offset of buffer"""
+        if self.length is None:
+            return bytes(buffer[offset + 2:offset + 2 + length])
+        return self.packer.unpack_from(buffer, offset)[2]
+
+
 class AppParamProperty(object):
+    __slots__ = ("data",)
+    codec = None  # AppParamCodec of the tagid, see app_param_codecs
+    values = ()  # known constant values, pre-encoded by the codec
+
     def __init__(self, data, encoded=False):
         if encoded:
             self.data = data
         else:
-            self.data = self.encode(data)
+            self.data = self.codec.encode(data)
 
     def encode(self, data):
-        if self.__class__.__name__ == "SearchValue":
-            self.length = len(data)
-        return struct.pack(">BB", self.tagid, self.length) + data
+        return self.codec.encode(data)
 
     def decode(self):
-        return struct.unpack(">BB", self.data[:2]), self.data[2:]
+        return self.codec.decode(self.data, 0, len(self.data) - 2)
 
 
 class OneByteProperty(AppParamProperty):
+    __slots__ = ()
     length = 1  # byte
     fmt = ">B"
 
-    def encode(self, data):
-        return super(OneByteProperty, self).encode(struct.pack(self.fmt, data))
-
-    def decode(self):
-        headers, data = super(OneByteProperty, self).decode()
-        return struct.unpack(self.fmt, data)[0]
-
 
 class TwoByteProperty(AppParamProperty):
+    __slots__ = ()
     length = 2  # bytes
     fmt = ">H"
 
-    def encode(self, data):
-        return super(TwoByteProperty, self).encode(struct.pack(self.fmt, data))
 
-    def decode(self):
-        headers, data = super(TwoByteProperty, self).decode()
-        return struct.unpack(self.fmt, data)[0]
-        
 class FourByteProperty(AppParamProperty):
+    __slots__ = ()
     length = 4  # bytes
     fmt = ">I"
 
-    def encode(self, data):
-        return super(FourByteProperty, self).encode(struct.pack(self.fmt, data))
-
-    def decode(self):
-        headers, data = super(FourByteProperty, self).decode()
-        return struct.unpack(self.fmt, data)[0]
-
 
 class EightByteProperty(AppParamProperty):
+    __slots__ = ()
     length = 8  # bytes
     fmt = ">Q"
 
-    def encode(self, data):
-        return super(EightByteProperty, self).encode(struct.pack(self.fmt, data))
-
-    def decode(self):
-        headers, data = super(EightByteProperty, self).decode()
-        return struct.unpack(self.fmt, data)[0]
-
 
 class VariableLengthProperty(AppParamProperty):
-    fmt = "{len}s"
+    __slots__ = ()
+    length = None  # given by the tag length
+    fmt = None
 
-    def encode(self, data):
-        return super(VariableLengthProperty, self).encode(struct.pack(self.fmt.format(len=len(data)), data))
-
-    def decode(self):
-        headers, data = super(VariableLengthProperty, self).decode()
-        tagid, length = headers
-        return struct.unpack(self.fmt.format(len=length), data)[0]
 
 class MaxListCount(TwoByteProperty):
+    __slots__ = ()
     tagid = 0x01
+    values = (0, 1024, 0xFFFF)  # size request, default and unrestricted
 
 
 class ListStartOffset(TwoByteProperty):
+    __slots__ = ()
     tagid = 0x02
+    values = (0,)
+
 
 class FilterMessageType(OneByteProperty):
+    __slots__ = ()
     tagid = 0x03
-    
+    values = range(0x20)  # any combination of the type bits
+
+
 class FilterPeriodBegin(VariableLengthProperty):
+    __slots__ = ()
     tagid = 0x04
-    
+
+
 class EndFilterPeriodEnd(VariableLengthProperty):
+    __slots__ = ()
     tagid = 0x05
-    
+
+
 class FilterReadStatus(OneByteProperty):
+    __slots__ = ()
     tagid = 0x06
-    
+    values = (0, 1, 2)
+
+
 class FilterRecipient(VariableLengthProperty):
+    __slots__ = ()
     tagid = 0x07
-    
+
+
 class FilterOriginator(VariableLengthProperty):
+    __slots__ = ()
     tagid = 0x08
-    
+
+
 class FilterPriority(OneByteProperty):
+    __slots__ = ()
     tagid = 0x09
-    
+    values = (0, 1, 2)
+
+
 class Attachment(OneByteProperty):
+    __slots__ = ()
     tagid = 0x0A
-    
+    values = (0, 1)
+
+
 class Transparent(OneByteProperty):
+    __slots__ = ()
     tagid = 0x0B
-    
+    values = (0, 1)
+
+
 class Retry(OneByteProperty):
+    __slots__ = ()
     tagid = 0x0C
-    
+    values = (0, 1)
+
+
 class NewMessage(OneByteProperty):
+    __slots__ = ()
     tagid = 0x0D
-    
+    values = (0, 1)
+
+
 class NotificationStatus(OneByteProperty):
+    __slots__ = ()
     tagid = 0x0E
-    
+    values = (0, 1)
+
+
 class MASInstanceID(OneByteProperty):
+    __slots__ = ()
     tagid = 0x0F
-    
+
+
 class ParameterMask(FourByteProperty):
+    __slots__ = ()
     tagid = 0x10
-    
+
+
 class FolderListingSize(TwoByteProperty):
+    __slots__ = ()
     tagid = 0x11
-    
+
+
 class ListingSize(TwoByteProperty):
+    __slots__ = ()
     tagid = 0x12
-    
+
+
 class SubjectLength(OneByteProperty):
+    __slots__ = ()
     tagid = 0x13
-    
+
+
 class Charset(OneByteProperty):
+    __slots__ = ()
     tagid = 0x14
-    
+    values = (0, 1)
+
+
 class FractionRequest(OneByteProperty):
+    __slots__ = ()
     tagid = 0x15
-    
+    values = (0, 1)
+
+
 class FractionDeliver(OneByteProperty):
+    __slots__ = ()
     tagid = 0x16
-    
+    values = (0, 1)
+
+
 class StatusIndicator(OneByteProperty):
+    __slots__ = ()
     tagid = 0x17
-    
+    values = (0, 1, 2)
+
+
 class StatusValue(OneByteProperty):
+    __slots__ = ()
     tagid = 0x18
-    
+    values = (0, 1)
+
+
 class MSETime(VariableLengthProperty):
+    __slots__ = ()
     tagid = 0x19
-    
+
+
 class DatabaseIdentifier(VariableLengthProperty):
+    __slots__ = ()
     tagid = 0x1A
-    
+
+
 class ConversationListingVersionCounter(VariableLengthProperty):
+    __slots__ = ()
     tagid = 0x1B
-    
+
+
 class PresenceAvailability(OneByteProperty):
+    __slots__ = ()
     tagid = 0x1C
-    
+    values = range(9)
+
+
 class PresenceText(VariableLengthProperty):
+    __slots__ = ()
     tagid = 0x1D
-    
+
+
 class LastActivity(VariableLengthProperty):
+    __slots__ = ()
     tagid = 0x1E
-    
+
+
 class FilterLastActivityBegin(VariableLengthProperty):
+    __slots__ = ()
     tagid = 0x1F
-    
+
+
 class FilterLastActivityEnd(VariableLengthProperty):
+    __slots__ = ()
     tagid = 0x20
-    
+
+
 class ChatState(OneByteProperty):
+    __slots__ = ()
     tagid = 0x21
-    
+    values = range(6)
+
+
 class ConversationID(VariableLengthProperty):
+    __slots__ = ()
     tagid = 0x22
-    
+
+
 class FolderVersionCounter(VariableLengthProperty):
+    __slots__ = ()
     tagid = 0x23
-    
+
+
 class FilterMessageHandle(VariableLengthProperty):
+    __slots__ = ()
     tagid = 0x24
-    
+
+
 class NotificationFilterMask(FourByteProperty):
+    __slots__ = ()
     tagid = 0x25
-    
+
+
 class ConvParameterMask(FourByteProperty):
+    __slots__ = ()
     tagid = 0x26
-    
+
+
 class OwnerUCI(VariableLengthProperty):
+    __slots__ = ()
     tagid = 0x27
-    
+
+
 class ExtendedData(VariableLengthProperty):
+    __slots__ = ()
     tagid = 0x28
-    
+
+
 class MapSupportedFeatures(FourByteProperty):
+    __slots__ = ()
     tagid = 0x29
-    
+
+
 class MessageHandle(VariableLengthProperty):
+    __slots__ = ()
     tagid = 0x2A
-    
+
+
 class ModifyText(OneByteProperty):
+    __slots__ = ()
     tagid = 0x2B
-    
+    values = (0, 1)
+
 
 app_parameters_dict = {
     0x01: MaxListCount,
@@ -259,6 +397,44 @@ app_parameters_dict = {
     0x2B: ModifyText
 }
 
+app_param_codecs = {}
+for _tagid, _app_param_class in app_parameters_dict.items():
+    app_param_codecs[_tagid] = _app_param_class.codec = AppParamCodec(_tagid, _app_param_class.fmt,
+                                                                      _app_param_class.values)
+
+
+class AppParamView(object):
+    """Application parameter received in an App_Parameters header.
+
+    Refers to the tag inside the received buffer instead of copying it,
+    the value is decoded when it is first accessed.
+    """
+    __slots__ = ("prop_class", "buffer", "offset", "length", "_value")
+
+    def __init__(self, prop_class, buffer, offset, length):
+        self.prop_class = prop_class
+        self.buffer = buffer
+        self.offset = offset
+        self.length = length
+        self._value = None
+
+    @property
+    def tagid(self):
+        return self.prop_class.tagid
+
+    @property
+    def data(self):
+        """Encoded property (tagid, length and value)"""
+        return self.buffer[self.offset:self.offset + self.length + 2].tobytes()
+
+    def decode(self):
+        if self._value is None:
+            self._value = self.prop_class.codec.decode(self.buffer, self.offset, self.length)
+        return self._value
+
+    def __repr__(self):
+        return "<{name} {value!r}>".format(name=self.prop_class.__name__, value=self.decode())
+
 
 # Sample App Parameters data
 # code | length | data
@@ -268,27 +444,63 @@ def extended_decode(self):
     # assumption:
     # size of tagid = 1 byte
     # size of length = 1 byte (This is just the data length)
-    data = self.data
+    data = memoryview(self.data)
+    size = len(data)
+    offset = 0
     res_dict = {}
-    while data:
-        tagid = ord(data[0])
-        length = ord(data[1])
-        app_param_class = app_parameters_dict[tagid]
+    while offset < size:
+        if offset + 2 > size:
+            raise ValueError("Truncated application parameter at offset {}".format(offset))
+        tagid, length = struct.unpack_from(">BB", data, offset)
+        app_param_class = app_parameters_dict.get(tagid)
+        if app_param_class is None:
+            raise ValueError("Unknown application parameter tag 0x{:02X} at offset {}".format(tagid, offset))
+        if offset + 2 + length > size:
+            raise ValueError("Truncated application parameter {} at offset {}".format(
+                app_param_class.__name__, offset))
+        if app_param_class.length is not None and length != app_param_class.length:
+            raise ValueError("Invalid length {} for application parameter {}".format(
+                length, app_param_class.__name__))
         if tagid == 0x1B:
-            res_dict['Conversation-ListingVersionCounter'] = app_param_class(data[:length + 2], encoded=True)
+            res_dict['Conversation-ListingVersionCounter'] = AppParamView(app_param_class, data, offset, length)
         else:
-            res_dict[app_param_class.__name__] = app_param_class(data[:length + 2], encoded=True)
-        data = data[length + 2:]
+            res_dict[app_param_class.__name__] = AppParamView(app_param_class, data, offset, length)
+        offset += length + 2
     return res_dict
 
 
+# Encoded App_Parameters blocks by the encoded properties in the order they
+# were given, so a repeated request (same builder, same values) skips the
+# sort and the copy. The property data are mostly the same bytes objects
+# from the AppParamCodec caches, whose hashes are cached.
+_encoded_blocks = {}
+_ENCODED_BLOCKS_SIZE = 64
+
+
 def extended_encode(self, data_dict):
-    data = ""
-    for item in data_dict.values():
-        if item is None:
-            continue
-        data += item.data
-    return struct.pack(">BH", self.code, len(data) + 3) + data
+    # properties are accepted as dict (as before) or as any iterable and
+    # always encoded in ascending tagid order
+    items = data_dict.values() if isinstance(data_dict, dict) else data_dict
+    items = [item for item in items if item is not None]
+    key = (self.code,) + tuple(item.data for item in items)
+    block = _encoded_blocks.get(key)
+    if block is not None:
+        return block
+
+    properties = sorted(items, key=lambda item: item.tagid)
+    size = 3 + sum(len(item.data) for item in properties)
+    buf = bytearray(size)
+    struct.pack_into(">BH", buf, 0, self.code, size)
+    offset = 3
+    for item in properties:
+        buf[offset:offset + len(item.data)] = item.data
+        offset += len(item.data)
+    block = bytes(buf)
+    if len(_encoded_blocks) >= _ENCODED_BLOCKS_SIZE:
+        # the oldest block, dicts keep insertion order
+        _encoded_blocks.pop(next(iter(_encoded_blocks), None), None)
+    _encoded_blocks[key] = block
+    return block
 
 
 App_Parameters.decode = extended_decode
@@ -0,0 +1,376 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""In-memory indexes over the phonebook folders served by the PBAP server"""
+
+import bisect
+import itertools
+import logging
+import re
+import threading
+
+from concurrent import futures
+from xml.sax.saxutils import quoteattr
+
+logger = logging.getLogger(__name__)
+
+CARD_TAG_TMPL = '<card handle="{handle}.vcf" name={name}/>\r\n'
+
+# vCard properties kept per entry for searching and sorting
+INDEXED_PARAMS = ("N", "TEL", "SOUND")
+
+_NON_DIGITS = re.compile(r"\D+")
+
+_versions = itertools.count(1)
+
+
+def param_values(vcard, param_name):
+    """Returns the values of all param_name properties of a vCard record, each joined by ';'"""
+    return [";".join(param["values"]) for param in vcard["vcard"] if param["type"] == param_name]
+
+
+def normalize_text(value):
+    """Search form of a name or sound: case folded, single spaced"""
+    return " ".join(value.split()).casefold()
+
+
+def normalize_number(value):
+    """Search form of a phone number: its digits only"""
+    return _NON_DIGITS.sub("", value)
+
+
+def name_terms(value):
+    """Search terms of a (structured) name: each component and all of them together"""
+    parts = [normalize_text(part) for part in value.split(";")]
+    parts = [part for part in parts if part]
+    terms = set(parts)
+    if len(parts) > 1:
+        terms.add(" ".join(parts))
+    return terms
+
+
+def number_terms(value):
+    number = normalize_number(value)
+    return {number} if number else set()
+
+
+# vCard property: (term function, normalize function) of the searchable properties
+SEARCH_PARAMS = {
+    "N": (name_terms, normalize_text),
+    "TEL": (number_terms, normalize_number),
+    "SOUND": (name_terms, normalize_text),
+}
+
+
+def query_records(vfolder, path, offset=0, limit=None, projection=None):
+    """Returns the vCard records of folder path from position offset, at most
+    limit of them, each holding only the properties in projection (all if None).
+
+    The work is pushed down to the backend if it implements
+    vfolder.query(path, offset, limit, order, projection), e.g. as
+    skip/limit/projection of a database query. Otherwise the whole
+    folder is listed and trimmed here.
+    """
+    query = getattr(vfolder, "query", None)
+    if query is not None:
+        return query(path, offset=offset, limit=limit, order=None,
+                     projection=None if projection is None else sorted(projection))
+    records = vfolder.listdir(path)
+    records = records[offset:] if limit is None else records[offset:offset + limit]
+    if projection is not None:
+        records = [dict(record, vcard=[param for param in record["vcard"] if param["type"] in projection])
+                   for record in records]
+    return records
+
+
+class TermIndex(object):
+    """Inverted index from normalized search terms to handles.
+
+    Exact lookups are dict hits, prefix lookups bisect the sorted terms,
+    which are only re-sorted after new terms were added.
+    """
+
+    def __init__(self):
+        self._postings = {}  # term: set of handles
+        self._terms = None  # sorted terms, None when outdated
+
+    def add(self, handle, terms):
+        for term in terms:
+            handles = self._postings.get(term)
+            if handles is None:
+                self._postings[term] = handles = set()
+                self._terms = None
+            handles.add(handle)
+
+    def remove(self, handle, terms):
+        for term in terms:
+            handles = self._postings.get(term)
+            if handles is None:
+                continue
+            handles.discard(handle)
+            if not handles:
+                del self._postings[term]
+                self._terms = None
+
+    def exact(self, term):
+        return set(self._postings.get(term, ()))
+
+    def prefix(self, term):
+        if self._terms is None:
+            self._terms = sorted(self._postings)
+        result = set()
+        for i in range(bisect.bisect_left(self._terms, term), len(self._terms)):
+            if not self._terms[i].startswith(term):
+                break
+            result.update(self._postings[self._terms[i]])
+        return result
+
+
+def sort_text(values):
+    """Sort key of the first of values"""
+    return normalize_text(values[0]) if values else ""
+
+
+class SortIndex(object):
+    """Handles of a folder in the order of their sort keys, ties by handle.
+
+    The order is kept up to date on add/remove; after a bulk load it is
+    sorted once, on first use.
+    """
+
+    def __init__(self):
+        self._keys = {}  # handle: sort key
+        self._entries = None  # sorted (key, handle) tuples, None when outdated
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, handle, key):
+        if handle in self._keys:
+            self.remove(handle)
+        self._keys[handle] = key
+        if self._entries is not None:
+            bisect.insort(self._entries, (key, handle))
+
+    def remove(self, handle):
+        key = self._keys.pop(handle)
+        if self._entries is not None:
+            del self._entries[bisect.bisect_left(self._entries, (key, handle))]
+
+    def slice(self, start=0, stop=None):
+        """Returns the handles from position start to stop"""
+        if self._entries is None:
+            self._entries = sorted((key, handle) for handle, key in self._keys.items())
+        return [handle for _, handle in self._entries[start:stop]]
+
+    def sort(self, handles):
+        """Returns handles (a subset of the indexed ones) in sort order"""
+        return sorted(handles, key=lambda handle: (self._keys[handle], handle))
+
+
+# sort param: sort key function of the entry values, for the listing orders
+SORT_PARAMS = {
+    "N": lambda values: sort_text(values["N"]),
+    "SOUND": lambda values: sort_text(values["SOUND"] or values["N"]),
+}
+
+
+class FolderIndex(object):
+    """vCard-listing lines, search and sort indexes of one phonebook folder.
+
+    Entries are keyed by handle, the position of the vCard in the
+    folder as returned by vfolder.listdir (i.e. '<handle>.vcf').
+    version changes with every change of the entries and is unique
+    across rebuilds, so it can key caches of derived results.
+    """
+
+    def __init__(self):
+        self.version = next(_versions)
+        self.handles = []  # sorted
+        self.lines = {}  # handle: rendered <card/> line
+        self.values = {}  # handle: {param: [values]} for INDEXED_PARAMS
+        self.entry_versions = {}  # handle: version of its last change
+        self.terms = dict((param, TermIndex()) for param in SEARCH_PARAMS)
+        self.orders = dict((param, SortIndex()) for param in SORT_PARAMS)
+        self._lock = threading.RLock()
+
+    @classmethod
+    def build(cls, vcards):
+        index = cls()
+        for handle, vcard in enumerate(vcards):
+            index.add(handle, vcard)
+        return index
+
+    def __len__(self):
+        return len(self.handles)
+
+    def add(self, handle, vcard):
+        """Adds or replaces the entry of handle"""
+        values = dict((param, param_values(vcard, param)) for param in INDEXED_PARAMS)
+        names = values["N"]
+        line = CARD_TAG_TMPL.format(handle=handle, name=quoteattr(names[0] if names else ""))
+        with self._lock:
+            if handle in self.lines:
+                self.remove(handle)
+            self.version = self.entry_versions[handle] = next(_versions)
+            bisect.insort(self.handles, handle)
+            self.lines[handle] = line.encode("utf-8")
+            self.values[handle] = values
+            for param, term_index in self.terms.items():
+                term_index.add(handle, self._terms_of(param, values))
+            for param, sort_index in self.orders.items():
+                sort_index.add(handle, SORT_PARAMS[param](values))
+
+    def remove(self, handle):
+        with self._lock:
+            if handle not in self.lines:
+                return
+            self.version = next(_versions)
+            del self.handles[bisect.bisect_left(self.handles, handle)]
+            del self.lines[handle]
+            del self.entry_versions[handle]
+            values = self.values.pop(handle)
+            for param, term_index in self.terms.items():
+                term_index.remove(handle, self._terms_of(param, values))
+            for sort_index in self.orders.values():
+                sort_index.remove(handle)
+
+    @staticmethod
+    def _terms_of(param, values):
+        term_func = SEARCH_PARAMS[param][0]
+        terms = set()
+        for value in values[param]:
+            terms |= term_func(value)
+        return terms
+
+    def search(self, param, value, prefix=True):
+        """Returns the sorted handles having a param property starting with
+        (or equal to, if not prefix) value, compared in normalized form"""
+        term = SEARCH_PARAMS[param][1](value)
+        if not term:
+            return []
+        with self._lock:
+            term_index = self.terms[param]
+            return sorted(term_index.prefix(term) if prefix else term_index.exact(term))
+
+    def select(self, order=None, handles=None, offset=0, count=None):
+        """Returns count handles from offset, in the order of the sort param
+        order (handle order if None). Selects from all handles, or from
+        handles if given (e.g. a search result).
+        """
+        stop = None if count is None else offset + count
+        with self._lock:
+            if handles is None:
+                if order is None:
+                    return self.handles[offset:stop]
+                return self.orders[order].slice(offset, stop)
+            if order is None:
+                return sorted(handles)[offset:stop]
+            return self.orders[order].sort(handles)[offset:stop]
+
+    def iter_lines(self, handles):
+        """Yields the rendered <card/> lines of handles"""
+        for handle in handles:
+            yield self.lines[handle]
+
+
+class PhonebookIndex(object):
+    """FolderIndex of every listed phonebook folder of a vfolder.
+
+    A folder is indexed on its first listing and rebuilt when its state
+    changed since: its entry count and, if the backend keeps a change
+    counter, vfolder.version(path). Other changes are only seen when
+    reported with add/remove (or invalidate), until then the index is
+    kept. Indexes are built outside the lock, sessions asking for a
+    folder being indexed wait for that build instead of starting one.
+    on_reindex(path, index) is called after the index of path was rebuilt.
+    """
+
+    def __init__(self, vfolder, on_reindex=None):
+        self.vfolder = vfolder
+        self.on_reindex = on_reindex
+        self._folders = {}  # path: (state, FolderIndex)
+        self._builds = {}  # path: (state, Future of the FolderIndex) being built
+        self._lock = threading.Lock()
+
+    def state(self, path, count=None):
+        """Returns the state of folder path in the backend. count is the
+        current vfolder count of path if already known."""
+        if count is None:
+            count = self.vfolder.count(path)
+        version = getattr(self.vfolder, "version", None)
+        return count, None if version is None else version(path)
+
+    def folder(self, path, count=None):
+        """Returns the up to date FolderIndex of path, count is the current
+        vfolder count of path if already known"""
+        state = self.state(path, count)
+        with self._lock:
+            entry = self._folders.get(path)
+            if entry is not None and entry[0] == state:
+                return entry[1]
+            build = self._builds.get(path)
+            if build is not None and build[0] == state:
+                future = build[1]
+            else:
+                future = None
+                build = self._builds[path] = (state, futures.Future())
+        if future is not None:
+            return future.result()
+
+        logger.debug("Indexing phonebook folder %s (state %s)", path, state)
+        try:
+            index = FolderIndex.build(query_records(self.vfolder, path, projection=INDEXED_PARAMS))
+        except BaseException as err:
+            with self._lock:
+                if self._builds.get(path) is build:
+                    del self._builds[path]
+            build[1].set_exception(err)
+            raise
+        with self._lock:
+            # a change reported while building outdates this index, it is
+            # returned to the sessions that waited for it but not kept
+            current = self._builds.get(path) is build
+            if current:
+                del self._builds[path]
+                reindexed = path in self._folders
+                self._folders[path] = (state, index)
+        build[1].set_result(index)
+        if current and reindexed and self.on_reindex is not None:
+            self.on_reindex(path, index)
+        return index
+
+    def current(self, path):
+        """Returns the FolderIndex of path if it is up to date, None if path
+        wasn't indexed or changed since. Never builds the index."""
+        with self._lock:
+            entry = self._folders.get(path)
+        if entry is None or entry[0] != self.state(path):
+            return None
+        return entry[1]
+
+    def add(self, path, handle, vcard):
+        """Reports a vCard added to (or changed in) folder path"""
+        with self._lock:
+            self._builds.pop(path, None)
+            entry = self._folders.get(path)
+        if entry is not None:
+            entry[1].add(handle, vcard)
+
+    def remove(self, path, handle):
+        """Reports a vCard removed from folder path"""
+        with self._lock:
+            self._builds.pop(path, None)
+            entry = self._folders.get(path)
+        if entry is not None:
+            entry[1].remove(handle)
+
+    def invalidate(self, path=None):
+        """Drops the index of path, or of all folders"""
+        with self._lock:
+            if path is None:
+                self._folders.clear()
+                self._builds.clear()
+            else:
+                self._folders.pop(path, None)
+                self._builds.pop(path, None)
@@ -0,0 +1,199 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""Incremental parsers for Message Access Profile listing objects"""
+
+import collections
+import logging
+
+from xml.etree import ElementTree
+
+logger = logging.getLogger(__name__)
+
+
+# ParameterMask bits of the msg attributes
+PARAMETER_MASK_BITS = collections.OrderedDict([
+    ("subject", 1 << 0),
+    ("datetime", 1 << 1),
+    ("sender_name", 1 << 2),
+    ("sender_addressing", 1 << 3),
+    ("recipient_name", 1 << 4),
+    ("recipient_addressing", 1 << 5),
+    ("type", 1 << 6),
+    ("size", 1 << 7),
+    ("reception_status", 1 << 8),
+    ("text", 1 << 9),
+    ("attachment_size", 1 << 10),
+    ("priority", 1 << 11),
+    ("read", 1 << 12),
+    ("sent", 1 << 13),
+    ("protected", 1 << 14),
+    ("replyto_addressing", 1 << 15),
+])
+
+# name: (msg attributes, SubjectLength) of the named field sets, None attributes means all
+FIELD_SETS = {
+    "handles-only": ((), 1),
+    "triage": (("subject", "datetime", "sender_name", "sender_addressing", "type", "priority", "read"), 64),
+    "full": (None, None),
+}
+
+_INT_ATTRS = ("size", "attachment_size")
+_YES_NO_ATTRS = ("text", "priority", "read", "sent", "protected")
+
+
+def resolve_fields(fields):
+    """Returns the msg attributes of fields, the name of a field set or an
+    iterable of attribute names, as frozenset (None if all of them)"""
+    if fields is None:
+        return None
+    if isinstance(fields, str):
+        if fields not in FIELD_SETS:
+            raise ValueError("Unknown field set '{}', known are {}".format(fields, ", ".join(sorted(FIELD_SETS))))
+        fields = FIELD_SETS[fields][0]
+        if fields is None:
+            return None
+    unknown = set(fields) - set(PARAMETER_MASK_BITS)
+    if unknown:
+        raise ValueError("Unknown msg attributes {}".format(", ".join(sorted(unknown))))
+    return frozenset(fields)
+
+
+def parameter_mask(fields):
+    """Returns the ParameterMask asking for fields (see resolve_fields).
+    ParameterMask 0 asks for all attributes, so no fields asks for type,
+    which MSEs always include anyway."""
+    fields = resolve_fields(fields)
+    if fields is None:
+        return 0
+    mask = 0
+    for field in fields:
+        mask |= PARAMETER_MASK_BITS[field]
+    return mask or PARAMETER_MASK_BITS["type"]
+
+
+def mask_fields(mask):
+    """Returns the msg attributes selected by a ParameterMask, None if all of them"""
+    if mask == 0:
+        return None
+    return frozenset(field for field, bit in PARAMETER_MASK_BITS.items() if mask & bit)
+
+
+class MessageRecord(object):
+    """Entry (msg element) of a MAP messages-listing object, attributes
+    that weren't requested or reported are None"""
+    __slots__ = ("handle",) + tuple(PARAMETER_MASK_BITS)
+
+    def __init__(self, handle, **attrs):
+        self.handle = handle
+        for field in PARAMETER_MASK_BITS:
+            setattr(self, field, attrs.pop(field, None))
+        if attrs:
+            raise TypeError("Unknown msg attributes {}".format(", ".join(sorted(attrs))))
+
+    @classmethod
+    def from_attrib(cls, attrib, fields=None):
+        """Creates the record of a msg element, only with the attributes in fields if given"""
+        attrs = {}
+        for field, value in attrib.items():
+            if field not in PARAMETER_MASK_BITS or (fields is not None and field not in fields):
+                continue
+            if field in _INT_ATTRS:
+                value = int(value)
+            elif field in _YES_NO_ATTRS:
+                value = value == "yes"
+            attrs[field] = value
+        return cls(attrib["handle"], **attrs)
+
+    def __repr__(self):
+        return "<MessageRecord handle={} type={} subject={!r}>".format(self.handle, self.type, self.subject)
+
+
+class FolderRecord(object):
+    """Entry (folder element) of a folder-listing object"""
+    __slots__ = ("name", "size", "created", "modified")
+
+    def __init__(self, name, size=None, created=None, modified=None):
+        self.name = name
+        self.size = size
+        self.created = created
+        self.modified = modified
+
+    @classmethod
+    def from_attrib(cls, attrib):
+        size = attrib.get("size")
+        return cls(attrib["name"],
+                   size=int(size) if size is not None else None,
+                   created=attrib.get("created"),
+                   modified=attrib.get("modified"))
+
+    def __repr__(self):
+        return "<FolderRecord name={!r}>".format(self.name)
+
+
+class ListingParser(object):
+    """Parses a listing object chunk by chunk as it is received.
+
+    Entries are returned as soon as their element is complete and are
+    dropped from the parsed tree, so memory stays bounded by the chunk
+    size instead of the listing size.
+    """
+    entry_tag = None
+
+    def __init__(self):
+        self._parser = ElementTree.XMLPullParser(events=("start", "end"))
+        self._root = None
+
+    def make_record(self, attrib):
+        raise NotImplementedError
+
+    def feed(self, data):
+        """Feeds a body chunk and returns the entries completed by it"""
+        self._parser.feed(data)
+        return self._read_records()
+
+    def close(self):
+        """Finishes parsing and returns the remaining entries"""
+        self._parser.close()
+        return self._read_records()
+
+    def _read_records(self):
+        records = []
+        for event, elem in self._parser.read_events():
+            if event == "start":
+                if self._root is None:
+                    self._root = elem
+            elif elem.tag == self.entry_tag:
+                records.append(self.make_record(elem.attrib))
+                self._root.clear()
+        return records
+
+
+class MessagesListingParser(ListingParser):
+    """Parser of x-bt/MAP-msg-listing objects, records get only the
+    attributes in fields (see resolve_fields) if given"""
+    entry_tag = "msg"
+
+    def __init__(self, fields=None):
+        ListingParser.__init__(self)
+        self.fields = resolve_fields(fields)
+
+    def make_record(self, attrib):
+        return MessageRecord.from_attrib(attrib, self.fields)
+
+
+class FolderListingParser(ListingParser):
+    """Parser of x-obex/folder-listing objects"""
+    entry_tag = "folder"
+
+    def make_record(self, attrib):
+        return FolderRecord.from_attrib(attrib)
+
+
+def iter_records(parser, chunks):
+    """Yields the entries parsed from an iterable of body chunks"""
+    for chunk in chunks:
+        for record in parser.feed(chunk):
+            yield record
+    for record in parser.close():
+        yield record
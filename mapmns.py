@@ -0,0 +1,233 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""Message Notification Server (MNS) receiving the event reports of an MSE"""
+
+import collections
+import logging
+import posixpath
+import threading
+import uuid
+
+from xml.etree import ElementTree
+
+from bluetooth import OBEX_UUID, RFCOMM_UUID, L2CAP_UUID, PORT_ANY
+from PyOBEX import server
+
+import maplisting as listing
+import mapresponses as responses
+import mapsession
+
+logger = logging.getLogger(__name__)
+
+MNS_TARGET_UUID = uuid.UUID('{bb582b41-420c-11db-b0de-0800200c9a66}').bytes
+
+# NotificationFilterMask bits, a set bit enables the event type
+EVENT_FILTER_BITS = collections.OrderedDict([
+    ("NewMessage", 1 << 0),
+    ("MessageDeleted", 1 << 1),
+    ("MessageShift", 1 << 2),
+    ("SendingSuccess", 1 << 3),
+    ("SendingFailure", 1 << 4),
+    ("DeliverySuccess", 1 << 5),
+    ("DeliveryFailure", 1 << 6),
+    ("MemoryFull", 1 << 7),
+    ("MemoryAvailable", 1 << 8),
+    ("ReadStatusChanged", 1 << 9),
+    ("ConversationChanged", 1 << 10),
+    ("ParticipantPresenceChanged", 1 << 11),
+    ("ParticipantChatStateChanged", 1 << 12),
+    ("MessageExtendedDataChanged", 1 << 13),
+    ("MessageRemoved", 1 << 14),
+])
+
+# events MailboxState.apply keeps the messages up to date with
+SYNC_EVENTS = ("NewMessage", "MessageDeleted", "MessageShift", "ReadStatusChanged", "MessageRemoved")
+
+
+def filter_mask(event_types):
+    """Returns the NotificationFilterMask enabling event_types"""
+    mask = 0
+    for event_type in event_types:
+        mask |= EVENT_FILTER_BITS[event_type]
+    return mask
+
+
+class Event(object):
+    """Entry (event element) of a MAP-event-report object"""
+    __slots__ = ("type", "handle", "folder", "old_folder", "msg_type", "datetime", "subject",
+                 "sender_name", "priority", "read_status")
+
+    def __init__(self, type, handle=None, folder=None, old_folder=None, msg_type=None, datetime=None,
+                 subject=None, sender_name=None, priority=None, read_status=None):
+        self.type = type
+        self.handle = handle
+        self.folder = folder
+        self.old_folder = old_folder
+        self.msg_type = msg_type
+        self.datetime = datetime
+        self.subject = subject
+        self.sender_name = sender_name
+        self.priority = priority
+        self.read_status = read_status
+
+    @classmethod
+    def from_attrib(cls, attrib):
+        read_status = attrib.get("read_status")
+        return cls(attrib["type"],
+                   handle=attrib.get("handle"),
+                   folder=attrib.get("folder"),
+                   old_folder=attrib.get("old_folder"),
+                   msg_type=attrib.get("msg_type"),
+                   datetime=attrib.get("datetime"),
+                   subject=attrib.get("subject"),
+                   sender_name=attrib.get("sender_name"),
+                   priority=attrib.get("priority"),
+                   read_status=read_status == "yes" if read_status is not None else None)
+
+    def __repr__(self):
+        return "<Event type={} handle={} folder={!r}>".format(self.type, self.handle, self.folder)
+
+
+class EventReportParser(listing.ListingParser):
+    """Parser of x-bt/MAP-event-report objects"""
+    entry_tag = "event"
+
+    def make_record(self, attrib):
+        return Event.from_attrib(attrib)
+
+
+class MailboxState(object):
+    """Messages of the tracked folders of every MAS instance.
+
+    A folder is tracked once it was loaded from a messages listing, MNS
+    events then keep it up to date without listing it again. Events of
+    folders that are not tracked are ignored. Folder names compare
+    case-insensitively, MSEs report them e.g. as 'TELECOM/MSG/INBOX'.
+    """
+
+    def __init__(self):
+        self._folders = {}  # (instance id, folder): OrderedDict of handle: MessageRecord
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normpath(folder):
+        return posixpath.normpath(posixpath.join("/", folder)).lower()
+
+    def load(self, instance_id, folder, records):
+        """Tracks folder with the MessageRecords of its listing"""
+        messages = collections.OrderedDict((record.handle, record) for record in records)
+        with self._lock:
+            self._folders[(instance_id, self.normpath(folder))] = messages
+
+    def messages(self, instance_id, folder):
+        """Returns the MessageRecords of a tracked folder, None if it is not tracked"""
+        with self._lock:
+            messages = self._folders.get((instance_id, self.normpath(folder)))
+            return None if messages is None else list(messages.values())
+
+    def apply(self, instance_id, event):
+        """Applies an MNS event, returns whether a tracked folder changed"""
+        with self._lock:
+            if event.type == "NewMessage":
+                messages = self._folders.get((instance_id, self.normpath(event.folder or "")))
+                if messages is None:
+                    return False
+                messages[event.handle] = listing.MessageRecord(
+                    event.handle, subject=event.subject, datetime=event.datetime, sender_name=event.sender_name,
+                    type=event.msg_type, read=event.read_status if event.read_status is not None else False)
+                messages.move_to_end(event.handle, last=False)  # listings are newest first
+                return True
+            if event.type in ("MessageDeleted", "MessageRemoved"):
+                return self._pop(instance_id, event.handle) is not None
+            if event.type == "MessageShift":
+                record = self._pop(instance_id, event.handle)
+                messages = self._folders.get((instance_id, self.normpath(event.folder or "")))
+                if messages is None:
+                    return record is not None
+                if record is None:
+                    record = listing.MessageRecord(event.handle, type=event.msg_type)
+                messages[event.handle] = record
+                return True
+            if event.type == "ReadStatusChanged":
+                record = self._find(instance_id, event.handle)
+                if record is None or event.read_status is None:
+                    # MSEs before MAP 1.3 don't report the new status, keep the known one
+                    return False
+                record.read = event.read_status
+                return True
+        return False
+
+    def _find(self, instance_id, handle):
+        for (folder_instance, _), messages in self._folders.items():
+            if folder_instance == instance_id and handle in messages:
+                return messages[handle]
+        return None
+
+    def _pop(self, instance_id, handle):
+        """Removes handle from the tracked folders, returns its record"""
+        for (folder_instance, _), messages in self._folders.items():
+            if folder_instance == instance_id and handle in messages:
+                return messages.pop(handle)
+        return None
+
+
+class MNSServer(mapsession.SessionServer):
+    """MNS server passing the events reported by MSEs to handler(mas_instance_id, event)"""
+    profile = "MNS"
+    target = MNS_TARGET_UUID
+
+    def __init__(self, address, handler, max_sessions=4):
+        mapsession.SessionServer.__init__(self, address, "", max_sessions)
+        self.handler = handler
+
+    def put(self, socket, request):
+        try:
+            decoded_header = self._collect_request(socket, request)
+        except ValueError as err:
+            logger.error("Malformed request headers: %s", err)
+            self.send_response(socket, responses.Bad_Request())
+            return
+        if decoded_header is None:
+            return
+        if decoded_header.get("Type") != "x-bt/MAP-event-report":
+            logger.error("Requested type = %s is not supported.", decoded_header.get("Type"))
+            self.send_response(socket, responses.Bad_Request())
+            return
+        instance_id = self._app_param(decoded_header.get("App_Parameters", {}), "MASInstanceID", 0)
+        try:
+            events = list(listing.iter_records(EventReportParser(), [decoded_header.get("Body", b"")]))
+        except ElementTree.ParseError as err:
+            logger.error("Malformed event report: %s", err)
+            self.send_response(socket, responses.Bad_Request())
+            return
+        # respond first, the MSE waits for it before sending the next report
+        self.send_response(socket, responses.Success())
+        for event in events:
+            logger.info("MAS instance %d reported %s", instance_id, event)
+            try:
+                self.handler(instance_id, event)
+            except Exception as err:
+                logger.error("Handling %s failed: %s", event, err)
+
+    def get(self, socket, request):
+        logger.error("MNS doesn't support GET")
+        self.send_response(socket, responses.Bad_Request())
+
+    def setpath(self, socket, request):
+        logger.error("MNS doesn't support SETPATH")
+        self.send_response(socket, responses.Bad_Request())
+
+    def start_service(self, port=PORT_ANY):
+        name = "MAP MNS"
+        uuid = "00001133-0000-1000-8000-00805F9B34FB"
+        service_classes = ["1133"]
+        service_profiles = [("1134", 0x0104)]
+        provider = "BMW CarIT GmbH"
+        description = "Message Access Profile - MNS"
+        protocols = [L2CAP_UUID, RFCOMM_UUID, OBEX_UUID]
+
+        return server.Server.start_service(
+            self, port, name, uuid, service_classes, service_profiles,
+            provider, description, protocols
+        )
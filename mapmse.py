@@ -0,0 +1,367 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""Message Access Profile server (MSE) implementation"""
+
+import argparse
+import itertools
+import logging
+import posixpath
+import re
+import sys
+import uuid
+
+from email import policy
+from email.parser import BytesParser, Parser
+from xml.sax.saxutils import quoteattr
+
+from bluetooth import OBEX_UUID, RFCOMM_UUID, L2CAP_UUID, PORT_ANY
+from PyOBEX import server
+
+import mapbmessage
+import mapheaders as headers
+import maplisting as listing
+import mapresponses as responses
+import mapsession
+import mapstore
+
+logger = logging.getLogger(__name__)
+
+MAS_TARGET_UUID = uuid.UUID('{bb582b40-420c-11db-b0de-0800200c9a66}').bytes
+
+FOLDER_LISTING_HEAD = (b'<?xml version="1.0"?>\r\n'
+                       b'<!DOCTYPE folder-listing SYSTEM "obex-folder-listing.dtd">\r\n'
+                       b'<folder-listing version="1.0">\r\n')
+FOLDER_LISTING_TAIL = b'</folder-listing>\r\n'
+MSG_LISTING_HEAD = b'<MAP-msg-listing version="1.0">\r\n'
+MSG_LISTING_TAIL = b'</MAP-msg-listing>\r\n'
+
+# msg attributes holding yes/no values
+YES_NO_ATTRS = ("text", "priority", "read", "sent", "protected")
+
+FRACTION_LAST = 1  # FractionDeliver value
+
+ATTACHMENT_OFF = 0
+CHARSET_NATIVE = 0
+CHARSET_UTF8 = 1
+
+_BMESSAGE_TYPE = re.compile(rb"^TYPE:(.*?)\r?$", re.MULTILINE)
+_BMESSAGE_LENGTH = re.compile(rb"^LENGTH:\d+(?=\r?$)", re.MULTILINE)
+_BMESSAGE_CONTENT = re.compile(rb"(?<=BEGIN:MSG\r\n)(.*?)(?=\r\nEND:MSG\r\n)", re.DOTALL)
+
+STATUS_INDICATOR_READ = 0x00
+STATUS_INDICATOR_DELETED = 0x01
+
+
+def msg_listing_line(entry, columns=mapstore.LISTING_COLUMNS, subject_length=None):
+    """Returns the <msg/> element of a messages listing entry with the attributes in columns"""
+    attrs = []
+    for column in columns:
+        value = entry[column]
+        if column in YES_NO_ATTRS:
+            value = "yes" if value else "no"
+        elif value == "" and column not in ("handle", "subject", "datetime", "type"):
+            continue
+        elif column == "subject" and subject_length is not None:
+            value = value[:subject_length]
+        attrs.append("{}={}".format(column, quoteattr(str(value))))
+    return "<msg {}/>\r\n".format(" ".join(attrs)).encode("utf-8")
+
+
+def bmessage_fields(bmessage):
+    """Returns the listing columns of a pushed bMessage"""
+    fields = {}
+    vcard_level = None  # BENV depth of the current vCard
+    benv_depth = 0
+    in_msg = False
+    text = []
+    for line in bmessage.decode("utf-8", "replace").splitlines():
+        if in_msg:
+            if line == "END:MSG":
+                in_msg = False
+            else:
+                text.append(line)
+            continue
+        key, _, value = line.partition(":")
+        if key == "BEGIN" and value == "BENV":
+            benv_depth += 1
+        elif key == "END" and value == "BENV":
+            benv_depth -= 1
+        elif key == "BEGIN" and value == "VCARD":
+            vcard_level = benv_depth
+        elif key == "END" and value == "VCARD":
+            vcard_level = None
+        elif key == "BEGIN" and value == "MSG":
+            in_msg = True
+        elif key == "TYPE" and vcard_level is None:
+            fields["type"] = value
+        elif key == "STATUS":
+            fields["read"] = int(value == "READ")
+        elif vcard_level is not None and key.split(";")[0] in ("N", "FN", "TEL", "EMAIL"):
+            prefix = "sender" if vcard_level == 0 else "recipient"
+            column = prefix + ("_name" if key.split(";")[0] in ("N", "FN") else "_addressing")
+            fields.setdefault(column, value)
+    body = "\r\n".join(text)
+    fields.setdefault("type", "SMS_GSM")
+    if fields["type"].upper() in mapbmessage.MIME_TYPES:
+        # RFC 822 message, the Subject header (RFC 2047 encoded words decoded)
+        subject = Parser(policy=policy.default).parsestr(body, headersonly=True).get("Subject", "")
+        fields["subject"] = " ".join(str(subject).split())[:256]
+    else:
+        fields["subject"] = body.split("\r\n", 1)[0][:256]
+    fields["size"] = len(body.encode("utf-8"))
+    return fields
+
+
+def bmessage_type(bmessage):
+    """Returns the TYPE of a stored bMessage, e.g. 'SMS_GSM' or 'EMAIL'"""
+    match = _BMESSAGE_TYPE.search(bmessage)
+    return match.group(1).decode("utf-8", "replace").strip().upper() if match else "SMS_GSM"
+
+
+def strip_attachments(bmessage):
+    """Returns an email/MMS bMessage without the attachment parts of its
+    MIME content, the LENGTH of its body updated"""
+    def strip(match):
+        message = BytesParser(policy=policy.SMTP).parsebytes(match.group(1))
+        for part in message.walk():
+            if part.is_multipart():
+                part.set_payload([child for child in part.get_payload() if not child.is_attachment()])
+        return message.as_bytes().rstrip(b"\r\n")
+
+    stripped, count = _BMESSAGE_CONTENT.subn(strip, bmessage)
+    # LENGTH counts from BEGIN:MSG to END:MSG of every message content
+    length = sum(len(b"BEGIN:MSG\r\n\r\nEND:MSG\r\n") + len(content)
+                 for content in _BMESSAGE_CONTENT.findall(stripped))
+    return _BMESSAGE_LENGTH.sub(b"LENGTH:" + str(length).encode("ascii"), stripped, count=1) if count else bmessage
+
+
+class MSEServer(mapsession.SessionServer):
+    """MAP Message Server Equipment serving one MAS instance from a MessageStore"""
+    profile = "MAP"
+    target = MAS_TARGET_UUID
+
+    def __init__(self, address, store, mas_instance_id=0, max_sessions=4):
+        mapsession.SessionServer.__init__(self, address, "", max_sessions)
+        self.store = store
+        self.mas_instance_id = mas_instance_id
+
+    def disconnect(self, socket, request):
+        server.Server.disconnect(self, socket, request)
+        self.session.curdir = self.rootdir
+
+    def setpath(self, socket, request):
+        decoded_header = self._decode_header_data(request)
+        name = decoded_header.get("Name", "")
+        path = self.session.curdir
+        if request.flags & request.NavigateToParent:
+            if not path:
+                logger.error("Current directory is the root, so can't go to parent")
+                self.send_response(socket, responses.Not_Found())
+                return
+            path = posixpath.dirname(path)
+        elif not name:
+            path = ""
+        if name:
+            path = posixpath.join(path, name)
+        if not self.store.folder_exists(path):
+            logger.error("Requested folder %s doesn't exist", path)
+            self.send_response(socket, responses.Not_Found())
+            return
+        self.session.curdir = self.store.normpath(path)
+        logger.info("Setting current directory = /%s", self.session.curdir)
+        self.send_response(socket, responses.Success())
+
+    def get(self, socket, request):
+        try:
+            decoded_header = self._collect_request(socket, request)
+        except ValueError as err:
+            logger.error("Malformed request headers: %s", err)
+            self.send_response(socket, responses.Bad_Request())
+            return
+        if decoded_header is None:
+            return
+        request_type = decoded_header.get("Type")
+        app_params = decoded_header.get("App_Parameters", {})
+        if request_type == "x-obex/folder-listing":
+            self._get_folder_listing(socket, decoded_header, app_params)
+        elif request_type == "x-bt/MAP-msg-listing":
+            self._get_messages_listing(socket, decoded_header, app_params)
+        elif request_type == "x-bt/message":
+            self._get_message(socket, decoded_header, app_params)
+        else:
+            logger.error("Requested type = %s is not supported yet.", request_type)
+            self.send_response(socket, responses.Bad_Request())
+
+    def put(self, socket, request):
+        try:
+            decoded_header = self._collect_request(socket, request)
+        except ValueError as err:
+            logger.error("Malformed request headers: %s", err)
+            self.send_response(socket, responses.Bad_Request())
+            return
+        if decoded_header is None:
+            return
+        request_type = decoded_header.get("Type")
+        app_params = decoded_header.get("App_Parameters", {})
+        if request_type == "x-bt/message":
+            self._push_message(socket, decoded_header, app_params)
+        elif request_type == "x-bt/messageStatus":
+            self._set_message_status(socket, decoded_header, app_params)
+        elif request_type == "x-bt/MAP-messageUpdate":
+            logger.info("Inbox update requested, the store is always up to date")
+            self.send_response(socket, responses.Success())
+        else:
+            logger.error("Requested type = %s is not supported yet.", request_type)
+            self.send_response(socket, responses.Bad_Request())
+
+    def _child_folder(self, decoded_header):
+        return posixpath.join(self.session.curdir, decoded_header.get("Name", ""))
+
+    def _get_folder_listing(self, socket, decoded_header, app_params):
+        folder = self._child_folder(decoded_header)
+        if not self.store.folder_exists(folder):
+            self.send_response(socket, responses.Not_Found())
+            return
+        max_list_count = self._app_param(app_params, "MaxListCount", 1024)
+        offset = self._app_param(app_params, "ListStartOffset", 0)
+        count, names = self.store.list_folders(folder, offset, max_list_count)
+        response_params = headers.App_Parameters({"FolderListingSize": headers.FolderListingSize(count)})
+        if max_list_count == 0:
+            self.send_response(socket, responses.Success(), [response_params])
+            return
+        lines = ("<folder name={}/>\r\n".format(quoteattr(name)).encode("utf-8") for name in names)
+        self._send_body(socket, itertools.chain([FOLDER_LISTING_HEAD], lines, [FOLDER_LISTING_TAIL]),
+                        [response_params])
+
+    def _get_messages_listing(self, socket, decoded_header, app_params):
+        folder = self._child_folder(decoded_header)
+        if not self.store.folder_exists(folder):
+            self.send_response(socket, responses.Not_Found())
+            return
+        max_list_count = self._app_param(app_params, "MaxListCount", 1024)
+        offset = self._app_param(app_params, "ListStartOffset", 0)
+        filters = {
+            "message_type": self._app_param(app_params, "FilterMessageType", 0),
+            "period_begin": self._app_param(app_params, "FilterPeriodBegin"),
+            "period_end": self._app_param(app_params, "EndFilterPeriodEnd"),
+            "read_status": self._app_param(app_params, "FilterReadStatus", 0),
+            "recipient": self._app_param(app_params, "FilterRecipient"),
+            "originator": self._app_param(app_params, "FilterOriginator"),
+            "priority": self._app_param(app_params, "FilterPriority", 0),
+        }
+        # read before listing, so a concurrent change is never hidden behind a current counter
+        folder_version = self.store.folder_version(folder)
+        count, entries = self.store.list_messages(folder, offset, max_list_count, **filters)
+        response_params = headers.App_Parameters({
+            "ListingSize": headers.ListingSize(count),
+            "NewMessage": headers.NewMessage(int(self.store.has_unread(folder))),
+            "MSETime": headers.MSETime(mapstore.mse_time()),
+            "DatabaseIdentifier": headers.DatabaseIdentifier(self.store.database_id),
+            "FolderVersionCounter": headers.FolderVersionCounter(folder_version)})
+        if max_list_count == 0:
+            self.send_response(socket, responses.Success(), [response_params])
+            return
+        fields = listing.mask_fields(self._app_param(app_params, "ParameterMask", 0))
+        columns = [column for column in mapstore.LISTING_COLUMNS
+                   if column == "handle" or fields is None or column in fields]
+        subject_length = self._app_param(app_params, "SubjectLength")
+        lines = (msg_listing_line(entry, columns, subject_length) for entry in entries)
+        self._send_body(socket, itertools.chain([MSG_LISTING_HEAD], lines, [MSG_LISTING_TAIL]), [response_params])
+
+    def _get_message(self, socket, decoded_header, app_params):
+        bmessage = self.store.get_message(decoded_header.get("Name", ""))
+        if bmessage is None:
+            logger.error("Requested message %s doesn't exist", decoded_header.get("Name"))
+            self.send_response(socket, responses.Not_Found())
+            return
+        attachment = self._app_param(app_params, "Attachment")
+        charset = self._app_param(app_params, "Charset")
+        if attachment not in (0, 1) or charset not in (CHARSET_NATIVE, CHARSET_UTF8):
+            logger.error("Invalid Attachment = %s or Charset = %s", attachment, charset)
+            self.send_response(socket, responses.Bad_Request())
+            return
+        message_type = bmessage_type(bmessage)
+        if message_type in mapbmessage.MIME_TYPES:
+            if attachment == ATTACHMENT_OFF:
+                bmessage = strip_attachments(bmessage)
+        elif charset == CHARSET_NATIVE:
+            # messages are stored as UTF-8 text, their PDUs are not kept
+            logger.error("Native charset of %s message %s is not available", message_type, decoded_header.get("Name"))
+            self.send_response(socket, responses.Not_Acceptable())
+            return
+        header_list = []
+        if "FractionRequest" in app_params:
+            # emails are stored whole, so the first fraction is the last one
+            header_list.append(headers.App_Parameters({"FractionDeliver": headers.FractionDeliver(FRACTION_LAST)}))
+        self._send_body(socket, [bmessage], header_list)
+
+    def _push_message(self, socket, decoded_header, app_params):
+        folder = self._child_folder(decoded_header)
+        if not self.store.folder_exists(folder):
+            self.send_response(socket, responses.Not_Found())
+            return
+        bmessage = decoded_header.get("Body", b"")
+        handle = self.store.add_message(folder, bmessage, **bmessage_fields(bmessage))
+        logger.info("Pushed message %s to /%s", handle, folder)
+        self.send_response(socket, responses.Success(), [headers.Name(handle)])
+
+    def _set_message_status(self, socket, decoded_header, app_params):
+        handle = decoded_header.get("Name", "")
+        indicator = self._app_param(app_params, "StatusIndicator")
+        value = self._app_param(app_params, "StatusValue")
+        if indicator == STATUS_INDICATOR_READ:
+            done = self.store.set_read(handle, value == 1)
+        elif indicator == STATUS_INDICATOR_DELETED:
+            done = self.store.delete_message(handle) if value == 1 else self.store.undelete_message(handle)
+        else:
+            logger.error("Unsupported StatusIndicator = %s", indicator)
+            self.send_response(socket, responses.Bad_Request())
+            return
+        self.send_response(socket, responses.Success() if done else responses.Not_Found())
+
+    def start_service(self, port=PORT_ANY):
+        name = "MAP MAS-{}".format(self.mas_instance_id)
+        uuid = "00001132-0000-1000-8000-00805F9B34FB"
+        service_classes = ["1132"]
+        service_profiles = [("1134", 0x0104)]
+        provider = "BMW CarIT GmbH"
+        description = "Message Access Profile - MSE"
+        protocols = [L2CAP_UUID, RFCOMM_UUID, OBEX_UUID]
+
+        return server.Server.start_service(
+            self, port, name, uuid, service_classes, service_profiles,
+            provider, description, protocols
+        )
+
+
+def run_server(device_address, database, max_sessions=4):
+    try:
+        mse_server = MSEServer(device_address, mapstore.MessageStore(database), max_sessions=max_sessions)
+        socket = mse_server.start_service(port=PORT_ANY)
+        mse_server.serve(socket)
+    except IOError:
+        mse_server.stop_service(socket)
+
+
+def main():
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(name)s %(levelname)-8s %(message)s')
+
+    parser = argparse.ArgumentParser(description="Message Access Profile server")
+    parser.add_argument("--address", required=True,
+                        help="bluetooth address to start the server")
+    parser.add_argument("--database", default="messages.db",
+                        help="SQLite message store, created if it doesn't exist")
+    parser.add_argument("--max-sessions", type=int, default=4,
+                        help="maximum number of clients served at the same time")
+    args = parser.parse_args()
+
+    while True:
+        run_server(device_address=args.address, database=args.database, max_sessions=args.max_sessions)
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,10 @@ class Not_Acceptable(FailureResponse):
     code = OBEX_Not_Acceptable = 0xC6
 
 
+class Internal_Server_Error(FailureResponse):
+    code = OBEX_Internal_Server_Error = 0xD0
+
+
 class Not_Implemented(FailureResponse):
     code = OBEX_Not_Implemented = 0xD1
 
@@ -21,6 +25,7 @@ class Service_Unavailable(FailureResponse):
 
 ResponseHandler.message_dict.update({
     Not_Acceptable.code: Not_Acceptable,
+    Internal_Server_Error.code: Internal_Server_Error,
     Not_Implemented.code: Not_Implemented,
     Service_Unavailable.code: Service_Unavailable
 })
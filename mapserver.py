@@ -4,53 +4,89 @@
 """Phone Book Access Profile server implementation"""
 
 import argparse
+import itertools
 import logging
 import os
 import sys
 
 from bluetooth import OBEX_UUID, RFCOMM_UUID, L2CAP_UUID, PORT_ANY
-from PyOBEX import requests, server
+from PyOBEX import server
 
+import mapcommon as common
 import mapheaders as headers
+import mapindex
 import mapresponses as responses
+import mapsession
 
-from mapcommon import FILTER_ATTR_DICT, MANDATORY_ATTR_BITMASK
 from vfolder import VFolderPhoneBook_FS, VFolderPhoneBook_DB
 from vcard_helper import VCard
 
 logger = logging.getLogger(__name__)
 
+VCARD_LISTING_HEAD = (b'<?xml version="1.0"?>\r\n'
+                      b'<!DOCTYPE vcard-listing SYSTEM "vcard-listing.dtd">\r\n'
+                      b'<vCard-listing version="1.0">\r\n')
+VCARD_LISTING_TAIL = b'</vCard-listing>\r\n'
 
-class PbapServer(server.Server):
 
-    def __init__(self, address, rootdir="/", use_fs=True):
-        server.Server.__init__(self, address)
-        self.vfolder = VFolderPhoneBook_FS(rootdir) if use_fs else VFolderPhoneBook_DB(rootdir)
+class PbapSession(mapsession.Session):
 
-    def process_request(self, connection, request):
-        """Processes the request from the connection."""
-        if isinstance(request, requests.Connect):
-            logger.debug("Request type = connect")
-            self.connect(connection, request)
-        elif isinstance(request, requests.Disconnect):
-            logger.debug("Request type = disconnect")
-            self.disconnect(connection, request)
-        elif isinstance(request, requests.Put):
-            logger.debug("Request type = put")
-            self.put(connection, request)
-        elif isinstance(request, requests.Get):
-            logger.debug("Request type = get")
-            self.get(connection, request)
-        elif isinstance(request, requests.Set_Path):
-            logger.debug("Request type = setpath")
-            self.setpath(connection, request)
-        else:
-            logger.debug("Request type = Unknown. so rejected")
-            self._reject(connection)
+    def __init__(self, connection, address, rootdir):
+        mapsession.Session.__init__(self, connection, address, rootdir)
+        self.missed_calls_baseline = {}  # mch object: its size at the last pull
+
+
+class PbapServer(mapsession.SessionServer):
+    """PBAP server serving up to max_sessions clients concurrently"""
+    session_class = PbapSession
+    profile = "PBAP"
+
+    def __init__(self, address, rootdir="/", use_fs=True, max_sessions=4, listing_cache_entries=64,
+                 listing_cache_ttl=60, vcard_cache_bytes=4 * 1024 * 1024):
+        mapsession.SessionServer.__init__(self, address, rootdir, max_sessions)
+        self.vfolder = VFolderPhoneBook_FS(rootdir) if use_fs else VFolderPhoneBook_DB(rootdir)
+        self.phonebook_index = mapindex.PhonebookIndex(self.vfolder, self._folder_reindexed)
+        # ordered handles of recent listing queries, so that paging through
+        # a listing doesn't repeat the search and sort for every page
+        self.listing_cache = common.LRUCache(max_entries=listing_cache_entries, ttl=listing_cache_ttl)
+        # serialized vCards by (folder, handle, entry version, filter, format), see _entry_versions
+        self.vcard_cache = common.LRUCache(max_entries=sys.maxsize, max_bytes=vcard_cache_bytes)
+
+    def _folder_reindexed(self, folder, index):
+        """Drops the listings of folder cached for its previous index and the
+        vCards of folder whose entry version changed, their keys can't be hit anymore"""
+        self.listing_cache.invalidate(lambda key: key[0] == folder)
+        self.vcard_cache.invalidate(
+            lambda key: key[0] == folder and key[2] != self._entry_versions(folder, [key[1]], index)[0])
+
+    def _entry_versions(self, folder, handles, index=None):
+        """Returns the versions of vCards handles of folder keying vcard_cache, None
+        for unknown ones: vfolder.entry_version(path) of backends keeping one, else
+        the modification time and size of the file, else the version in the up to
+        date index of folder (index if given), which is never built for this"""
+        entry_version = getattr(self.vfolder, "entry_version", None)
+        looked_up = index is not None
+        versions = []
+        for handle in handles:
+            path = self.vfolder.join(folder, "{}.vcf".format(handle))
+            if entry_version is not None:
+                versions.append(entry_version(path))
+                continue
+            try:
+                stat = os.stat(path)
+                versions.append((stat.st_mtime_ns, stat.st_size))
+                continue
+            except OSError:
+                pass
+            if not looked_up:
+                index = self.phonebook_index.current(folder)
+                looked_up = True
+            versions.append(None if index is None else index.entry_versions.get(handle))
+        return versions
 
     def disconnect(self, socket, request):
         server.Server.disconnect(self, socket, request)
-        self.vfolder.curdir = self.vfolder.rootdir
+        self.session.curdir = self.vfolder.rootdir
 
     def setpath(self, socket, request):
         decoded_header = self._decode_header_data(request)
@@ -61,19 +97,19 @@ class PbapServer(server.Server):
         # TODO: set_phonebook, to_root is not yet supported
         # This is just a overloaded version of obex setpath
         if toparent:
-            if self.vfolder.curdir == self.vfolder.rootdir:
+            if self.session.curdir == self.vfolder.rootdir:
                 logger.error("Current directory is same as Root dir, so can't go to parent")
                 self.send_response(socket, responses.Forbidden())
                 return
             else:
-                self.vfolder.curdir = self.vfolder.join(self.vfolder.curdir, "..")
-                logger.info("Setting current directory = %s", self.vfolder.curdir)
+                self.session.curdir = self.vfolder.join(self.session.curdir, "..")
+                logger.info("Setting current directory = %s", self.session.curdir)
                 if decoded_header["Name"] == "":
                     logger.debug("Sending response success")
                     self.send_response(socket, responses.Success())
                     return
 
-        requested_dir = self.vfolder.join(self.vfolder.curdir, decoded_header["Name"])
+        requested_dir = self.vfolder.join(self.session.curdir, decoded_header["Name"])
         if createdir:
             if self.vfolder.isdir(requested_dir):
                 logger.error("Requested path already exists, so can't create it again.")
@@ -82,8 +118,8 @@ class PbapServer(server.Server):
             else:
                 logger.info("Creating new directory = %s", requested_dir)
                 self.vfolder.makedirs(requested_dir)
-                self.vfolder.curdir = requested_dir
-                logger.info("Setting current directory = %s", self.vfolder.curdir)
+                self.session.curdir = requested_dir
+                logger.info("Setting current directory = %s", self.session.curdir)
                 logger.debug("Sending response success")
                 self.send_response(socket, responses.Success())
                 return
@@ -93,14 +129,19 @@ class PbapServer(server.Server):
             self.send_response(socket, responses.Precondition_Failed())
             return
         else:
-            self.vfolder.curdir = requested_dir
-            logger.info("Setting current directory = %s", self.vfolder.curdir)
+            self.session.curdir = requested_dir
+            logger.info("Setting current directory = %s", self.session.curdir)
             logger.debug("Sending response success")
             self.send_response(socket, responses.Success())
             return
 
     def get(self, socket, request):
-        decoded_header = self._decode_header_data(request)
+        try:
+            decoded_header = self._decode_header_data(request)
+        except ValueError as err:
+            logger.error("Malformed request headers: %s", err)
+            self.send_response(socket, responses.Bad_Request())
+            return
         if request.is_final():
             logger.debug("request is final")
             if decoded_header["Type"] == "x-bt/vcard-listing":
@@ -114,8 +155,7 @@ class PbapServer(server.Server):
                 self.send_response(socket, responses.Bad_Request())
 
     def _pull_vcard_listing(self, socket, request, decoded_header):
-        mch_size = 0  # mch_size for phonebook folder (Don't optimize)
-        abs_name = self.vfolder.join(self.vfolder.curdir, decoded_header["Name"])
+        abs_name = self.vfolder.join(self.session.curdir, decoded_header["Name"])
         logger.info("Absolute path of requested vcard_listing object = %s", abs_name)
         app_params = self._decode_app_params(decoded_header.get("App_Parameters", {}))
         if not self.vfolder.isdir(abs_name):
@@ -123,165 +163,148 @@ class PbapServer(server.Server):
             self.send_response(socket, responses.Not_Found())
         else:
             phonebook_size = self.vfolder.count(abs_name)
-            search_query = self._get_search_query(app_params["SearchAttribute"], app_params["SearchValue"])
-            # TODO: sorting based on order not works, since handle is not part of db record. it is not proper
-            # make the "handle" as part of db record
-            sort_key = self._get_sort_key(app_params["Order"])
-            vcard_list = self.vfolder.listdir(abs_name, query=search_query)
-            vcard_list = self._sort_vcard_list(vcard_list, sort_key)
-
             if app_params["MaxListCount"] == 0:
                 self._respond_phonebook_size(socket, phonebook_size)
                 return
 
-            data = ""
-            res_vcard_list = self._limit_phonebook(vcard_list, app_params["MaxListCount"],
-                                                   app_params["ListStartOffset"])
-            res_vcard_list_range = range(app_params["ListStartOffset"],
-                                         min((app_params["ListStartOffset"] + app_params["MaxListCount"]), 65535))
+            index = self.phonebook_index.folder(abs_name, phonebook_size)
+
+            handles = self._query_handles(abs_name, index, app_params["SearchAttribute"],
+                                          app_params["SearchValue"], app_params["Order"])
+            res_handles = self._limit_phonebook(handles, app_params["MaxListCount"], app_params["ListStartOffset"])
             # "NewMissedCalls": This application parameter shall be used in the response when and only when the
             # phone book object is mch. It indicates the number of missed calls that have been
             # received on the PSE since the last PullPhoneBook request on the mch folder, at the
             # point of the request.
             if "mch" in abs_name:
-                response_dict = {'NewMissedCalls': headers.NewMissedCalls(phonebook_size - mch_size)}
-                mch_size = phonebook_size
+                response_dict = {'NewMissedCalls': headers.NewMissedCalls(self._new_missed_calls(abs_name,
+                                                                                                phonebook_size))}
             else:
                 response_dict = {}
 
-            vcard_listing_object_tmpl = ('<?xml version="1.0"?>\r\n'
-                                         '<!DOCTYPE vcard-listing SYSTEM "vcard-listing.dtd">\r\n'
-                                         '<vCard-listing version="1.0">\r\n'
-                                         '{cards}'
-                                         '</vCard-listing>\r\n')
-            card_tag_tmpl = '<card handle="{handle}" name="{name}"/>\r\n'
-            cards = ""
-            # TODO: As per spec the handles should be hex??
-            for index, vcard in zip(res_vcard_list_range, res_vcard_list):
-                cards += card_tag_tmpl.format(handle="{}.vcf".format(index),
-                                              name=self._get_param_values(vcard, "N"))
-            data = vcard_listing_object_tmpl.format(cards=cards)
-            logger.debug("Sending response success with following data")
-            logger.debug("vcard-listing data: \r\n%s", data)
-            self.send_response(socket, responses.Success(),
-                               [headers.End_Of_Body(data), headers.App_Parameters(response_dict)])
-
-    def _get_param_values(self, vcard, param_name):
-        for param in vcard["vcard"]:
-            if param["type"] == param_name:
-                return ";".join(param["values"])
+            logger.debug("Sending response success with %d cards", len(res_handles))
+            chunks = itertools.chain([VCARD_LISTING_HEAD], index.iter_lines(res_handles), [VCARD_LISTING_TAIL])
+            self._send_body(socket, chunks, [headers.App_Parameters(response_dict)])
 
     def _pull_vcard_entry(self, socket, request, decoded_header):
-        abs_name = self.vfolder.join(self.vfolder.curdir, decoded_header["Name"])
+        abs_name = self.vfolder.join(self.session.curdir, decoded_header["Name"])
         logger.info("Absolute path of requested vcard_entry object = %s", abs_name)
         app_params = self._decode_app_params(decoded_header.get("App_Parameters", {}))
         if not self.vfolder.isfile(abs_name):
             logger.error("Requested vcard file doesn't exists")
             self.send_response(socket, responses.Not_Found())
         else:
-            filtered_data = self._filter_attributes(app_params["Filter"],
-                                                    self.vfolder.read(abs_name),
-                                                    app_params["Format"])
-            data = VCard(filtered_data, parsed=True).serialize(app_params["Format"])
-            logger.debug("Sending response success with following data")
-            logger.debug("vcard data: \r\n%s", data)
-            self.send_response(socket, responses.Success(), [
-                               headers.End_Of_Body(data)])
+            folder, name = os.path.split(abs_name)
+            handle = os.path.splitext(name)[0]
+            handle = int(handle) if handle.isdigit() else None
+            versions = [None] if handle is None else self._entry_versions(folder, [handle])
+            chunks = self._serialize_vcards(folder, [handle], versions, app_params["Filter"], app_params["Format"],
+                                            lambda handles: [self.vfolder.read(abs_name)])
+            self._send_body(socket, chunks)
 
     def _pull_phonebook(self, socket, request, decoded_header):
-        mch_size = 0  # mch_size for phonebook folder (Don't optimize)
-        abs_name = self.vfolder.join(self.vfolder.curdir, decoded_header["Name"])
+        abs_name = self.vfolder.join(self.session.curdir, decoded_header["Name"])
         logger.info("Absolute path of requested phonebook object = %s", abs_name)
         app_params = self._decode_app_params(decoded_header.get("App_Parameters", {}))
         if not self.vfolder.isfile(abs_name):
             logger.error("Requested phonebook file doesn't exists")
             self.send_response(socket, responses.Not_Found())
         else:
-            phonebook_size = self.vfolder.count(os.path.splitext(abs_name)[0])
-            vcard_list = self.vfolder.listdir(os.path.splitext(abs_name)[0])
+            folder = os.path.splitext(abs_name)[0]
+            phonebook_size = self.vfolder.count(folder)
 
             if app_params["MaxListCount"] == 0:
                 self._respond_phonebook_size(socket, phonebook_size)
                 return
 
-            data = ""
-            res_vcard_list = self._limit_phonebook(vcard_list, app_params["MaxListCount"],
-                                                   app_params["ListStartOffset"])
+            # the phonebook object is in handle order, a window of it needs no folder index
+            res_handles = self._limit_phonebook(range(phonebook_size), app_params["MaxListCount"],
+                                                app_params["ListStartOffset"])
             # "NewMissedCalls": This application parameter shall be used in the response when and only when the
             # phone book object is mch. It indicates the number of missed calls that have been
             # received on the PSE since the last PullPhoneBook request on the mch folder, at the
             # point of the request.
             if "mch" in abs_name:
-                response_dict = {'NewMissedCalls': headers.NewMissedCalls(phonebook_size - mch_size)}
-                mch_size = phonebook_size
+                response_dict = {'NewMissedCalls': headers.NewMissedCalls(self._new_missed_calls(abs_name,
+                                                                                                phonebook_size))}
             else:
                 response_dict = {}
 
-            for item in res_vcard_list:
-                filtered_data = self._filter_attributes(app_params["Filter"], item, app_params["Format"])
-                data += VCard(filtered_data, parsed=True).serialize(app_params["Format"])
-
-            logger.debug("Sending response success with following data")
-            logger.debug("phonebook data: \r\n%s", data)
-
-            # Sends the chunked response
-            # TODO: This needs to be handled properly in pyobex: server.py: send_response
-            bytes_transferred = 0
-            datasize = len(data)
-            # ideally max data length per packet should be as follows
-            # max_datalen = self._max_length() - Message().minimum_length
-            # but because of some unknown reasons we could only able to transmit ~700 bytes
-            # TODO: figure out exactly what is the reason
-            max_datalen = 700
-            if datasize < max_datalen:
-                data_last_chunk = data
-            else:
-                while bytes_transferred < datasize:
-                    data_chunk = data[bytes_transferred: (bytes_transferred + max_datalen)]
-                    header_list = [headers.App_Parameters(response_dict), headers.Body(data_chunk)]
-                    # 'continue' response and process the subsequent requests
-                    self.send_response(socket, responses.Continue(), header_list)
-                    while True:
-                        request = self.request_handler.decode(self.connection)
-                        if not isinstance(request, requests.Get_Final):
-                            self.process_request(self.connection, request)
-                            continue
-                        else:
-                            break
-                    bytes_transferred += max_datalen
-                data_last_chunk = ""
-
-            header_list = [headers.App_Parameters(response_dict), headers.End_Of_Body(data_last_chunk)]
-            self.send_response(socket, responses.Success(), header_list)
-
-    def _get_search_query(self, searchattribute, searchvalue):
+            def load_records(handles):
+                # only the requested window, reduced to the filtered attributes
+                return mapindex.query_records(self.vfolder, folder, app_params["ListStartOffset"], len(handles),
+                                              common.filter_attributes(app_params["Filter"], app_params["Format"]))
+
+            versions = self._entry_versions(folder, res_handles)
+            chunks = self._serialize_vcards(folder, res_handles, versions, app_params["Filter"],
+                                            app_params["Format"], load_records)
+            self._send_body(socket, chunks, [headers.App_Parameters(response_dict)])
+
+    def _serialize_vcards(self, folder, handles, versions, filter_bitmask, vcard_format, load_records):
+        """Yields the serialized vCards of handles one by one, as needed by _send_body.
+
+        Serialized vCards are taken from vcard_cache when possible, keyed by
+        the entry versions of the handles. The records are loaded with
+        load_records(handles) on the first miss. A vCard without a version
+        is never cached.
+        """
+        records = None
+        for position, (handle, version) in enumerate(zip(handles, versions)):
+            key = None
+            if version is not None:
+                key = (folder, handle, version, filter_bitmask, vcard_format)
+                data = self.vcard_cache.get(key)
+                if data is not None:
+                    yield data
+                    continue
+            if records is None:
+                records = load_records(handles)
+            filtered_data = self._filter_attributes(filter_bitmask, records[position], vcard_format)
+            data = VCard(filtered_data, parsed=True).serialize(vcard_format).encode("utf-8")
+            if key is not None:
+                self.vcard_cache.put(key, data)
+            yield data
+
+    def _new_missed_calls(self, abs_name, phonebook_size):
+        """Returns the number of missed calls since this session last pulled the mch object"""
+        key = os.path.splitext(abs_name)[0]
+        baseline = self.session.missed_calls_baseline
+        new_missed_calls = phonebook_size - baseline.get(key, 0)
+        baseline[key] = phonebook_size
+        return new_missed_calls
+
+    def _query_handles(self, abs_name, index, searchattribute, searchvalue, order):
+        """Returns the ordered handles of a listing query, cached for the following pages"""
+        key = (abs_name, searchattribute, searchvalue, order, index.version)
+        handles = self.listing_cache.get(key)
+        if handles is None:
+            handles = self._search_handles(index, searchattribute, searchvalue)
+            handles = index.select(self._get_sort_param(order), handles)
+            self.listing_cache.put(key, handles, size=len(handles))
+        return handles
+
+    def _search_handles(self, index, searchattribute, searchvalue):
+        """Returns the handles matching the search, None if there is nothing to search"""
+        if not searchvalue:
+            return None
         if searchattribute == 0x00:
             searchattribute = "N"
         elif searchattribute == 0x01:
-            searchattribute = "Number"
+            searchattribute = "TEL"
         elif searchattribute == 0x02:
-            searchattribute = "Sound"
+            searchattribute = "SOUND"
         else:
             logger.error("Unsupported value for SearchAttribute=%s", searchattribute)
-            return {}
-        query = {"vcard": {"$elemMatch": {'type': searchattribute, 'values': {"$in": [searchvalue]}}}}
-        return query if searchvalue else {}
+            return None
+        return index.search(searchattribute, searchvalue)
 
-    def _get_sort_key(self, order):
+    def _get_sort_param(self, order):
         if order == 0:  # Indexed order
-            sort_key = ("_id", 1)
+            return None
         elif order == 1:  # Alphanumeric order
-            sort_key = ("N", 1)
+            return "N"
         else:  # Phonetical order
-            sort_key = ("SOUND", 1)
-        return sort_key
-
-    def _sort_vcard_list(self, vcard_list, sort_key):
-        def _key_func(item):
-            for param in item["vcard"]:
-                if param["type"] == sort_key[0]:
-                    return ";".join(param["values"])
-        return sorted(vcard_list, key=_key_func)
+            return "SOUND"
 
     def _respond_phonebook_size(self, socket, phonebook_size):
         # MaxListCount = 0 signifies to the PSE that the PCE wants to know the number of used
@@ -295,32 +318,6 @@ class PbapServer(server.Server):
         self.send_response(socket, responses.Success(), [
                            headers.App_Parameters(response_dict)])
 
-    def _decode_header_data(self, request):
-        """Decodes all headers in given request and return the decoded values in dict"""
-        header_dict = {}
-        for header in request.header_data:
-            if isinstance(header, headers.Name):
-                header_dict["Name"] = header.decode().rstrip("\r\n\t\0")
-                logger.info("Name = %s" % header_dict["Name"])
-            elif isinstance(header, headers.Length):
-                header_dict["Length"] = header.decode().rstrip("\r\n\t\0")
-                logger.info("Length = %i" % header_dict["Length"])
-            elif isinstance(header, headers.Type):
-                header_dict["Type"] = header.decode().rstrip("\r\n\t\0")
-                logger.info("Type = %s" % header_dict["Type"])
-            elif isinstance(header, headers.Connection_ID):
-                header_dict["Connection_ID"] = header.decode().rstrip("\r\n\t\0")
-                logger.info("Connection ID = %s" % header_dict["Connection_ID"])
-            elif isinstance(header, headers.App_Parameters):
-                header_dict["App_Parameters"] = header.decode()
-                logger.info("App Parameters are :")
-                for param, value in header_dict["App_Parameters"].items():
-                    logger.info("{param}: {value}".format(param=param, value=value.decode()))
-            else:
-                logger.error("Some Header data is not yet added in _decode_header_data")
-                raise NotImplementedError("Some Header data is not yet added in _decode_header_data")
-        return header_dict
-
     def _limit_phonebook(self, vcard_list, max_listcount, list_startoffset=0):
         """limit the phonebook size based on max listcount and list startoffset
         and update the index of phonebook accordingly."""
@@ -368,42 +365,11 @@ class PbapServer(server.Server):
 
     def _filter_attributes(self, filter_bitmask, data, vcard_version="2.1"):
         """receives filter bitmask and vcard data as dict then returns the filtered dict"""
-        logger.debug("Filtering attributes for bitmask: {bitmask} data: {data}".format(
-            bitmask=filter_bitmask, data=data))
-        # if filter is 0, return all the attributes
-        if filter_bitmask == 0:
-            return data
-        unfiltered_attrs = set()
-        logger.debug("Adding mandatory attributes to necessary attributes list")
-        filter_bitmask |= MANDATORY_ATTR_BITMASK[vcard_version]
-        for bitmarker, attr_tuple in FILTER_ATTR_DICT.items():
-            bit = 1 << bitmarker
-            if bit & filter_bitmask == bit:
-                unfiltered_attrs.add(attr_tuple[0])
-        logger.debug("Necessary attributes: {unfiltered}".format(unfiltered=unfiltered_attrs))
-        for param in data["vcard"][:]:
-            attr = param["type"]
-            if attr in unfiltered_attrs:
-                continue
-            else:
-                data["vcard"].remove(param)
-        return data
+        return common.filter_vcard(data, filter_bitmask, vcard_version)
 
-    def serve(self, socket):
-        """Override: changes 'connection' as instance variable.
-        So we can access it in other methods, enables handling
-        of 'Continue' response and subsequent requests
-        """
-        while True:
-            self.connection, self.address = socket.accept()
-            if not self.accept_connection(*self.address):
-                self.connection.close()
-                continue
-            logger.info("PBAP, Connection from %s", self.address)
-            self.connected = True
-            while self.connected:
-                request = self.request_handler.decode(self.connection)
-                self.process_request(self.connection, request)
+    def _session_closed(self, session):
+        logger.info("PBAP, Session of %s closed, listing cache: %s, vCard cache: %s", session.address,
+                    self.listing_cache.stats(), self.vcard_cache.stats())
 
     def start_service(self, port=PORT_ANY):
 
@@ -434,14 +400,14 @@ class PbapServer(server.Server):
         )
 
 
-def run_server(device_address, rootdir, use_fs):
+def run_server(device_address, rootdir, use_fs, max_sessions=4):
 
     # Run the server in a function so that, if the server causes an exception
     # to be raised, the server instance will be deleted properly, giving us a
     # chance to create a new one and start the service again without getting
     # errors about the address still being in use.
     try:
-        map_server = PbapServer(device_address, rootdir, use_fs)
+        map_server = PbapServer(device_address, rootdir, use_fs, max_sessions)
         socket = map_server.start_service(port=PORT_ANY)
         map_server.serve(socket)
     except IOError:
@@ -460,6 +426,8 @@ def main():
                              "(if not given will use the phonebook from mongodb)")
     parser.add_argument("--rootdir", help="rootdir of phonebook virtual folder, "
                                           "required while using filesystem as storage")
+    parser.add_argument("--max-sessions", type=int, default=4,
+                        help="maximum number of clients served at the same time")
     args = parser.parse_args()
 
     if args.use_fs and args.rootdir is None:
@@ -470,7 +438,8 @@ def main():
         rootdir = args.rootdir
 
     while True:
-        run_server(device_address=args.address, rootdir=rootdir, use_fs=args.use_fs)
+        run_server(device_address=args.address, rootdir=rootdir, use_fs=args.use_fs,
+                   max_sessions=args.max_sessions)
 
     sys.exit(0)
 
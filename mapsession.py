@@ -0,0 +1,288 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""OBEX server base serving concurrent client sessions"""
+
+import itertools
+import logging
+import struct
+import threading
+
+from PyOBEX import requests, server
+
+import mapheaders as headers
+import mapresponses as responses
+
+logger = logging.getLogger(__name__)
+
+
+class Session(object):
+    """State of one client connection"""
+
+    def __init__(self, connection, address, rootdir):
+        self.connection = connection
+        self.address = address
+        self.curdir = rootdir
+        self.connected = False
+        self.remote_info = None
+        self.connection_id = None
+
+
+class SessionServer(server.Server):
+    """OBEX server serving up to max_sessions clients concurrently.
+
+    Every connection is served in its own thread. The per-connection
+    state lives in a session_class instance, which the request handlers
+    reach through the thread-local 'session' attribute.
+    """
+    session_class = Session
+    profile = "OBEX"  # used in log messages
+    target = None  # Target header (service UUID bytes) a CONNECT must carry, if any
+
+    def __init__(self, address, rootdir="/", max_sessions=4):
+        self._local = threading.local()
+        self._idle_session = self.session_class(None, None, rootdir)
+        server.Server.__init__(self, address)
+        self.rootdir = rootdir
+        self.max_sessions = max_sessions
+        self._connection_ids = itertools.count(1)
+
+    @property
+    def session(self):
+        return getattr(self._local, "session", self._idle_session)
+
+    @property
+    def connection(self):
+        return self.session.connection
+
+    # PyOBEX's Server keeps these on the instance, keep them per session instead
+    @property
+    def connected(self):
+        return self.session.connected
+
+    @connected.setter
+    def connected(self, value):
+        self.session.connected = value
+
+    @property
+    def remote_info(self):
+        return self.session.remote_info
+
+    @remote_info.setter
+    def remote_info(self, value):
+        self.session.remote_info = value
+
+    def connect(self, socket, request):
+        """Override: accepts only connections to target if it is set,
+        answering them with Who and Connection_ID headers"""
+        if self.target is None:
+            server.Server.connect(self, socket, request)
+            return
+        targets = [header.data for header in request.header_data if isinstance(header, headers.Target)]
+        if request.obex_version > self.obex_version or targets != [self.target]:
+            logger.error("%s, Rejecting connect without %s target", self.profile, self.profile)
+            self._reject(socket)
+            return
+        self.remote_info = request
+        self.session.connection_id = next(self._connection_ids)
+        data = (self.obex_version.to_byte(), 0, self.max_packet_length)
+        self.send_response(socket, responses.ConnectSuccess(data),
+                           [headers.Who(self.target), headers.Connection_ID(self.session.connection_id)])
+
+    def process_request(self, connection, request):
+        """Processes the request from the connection."""
+        if isinstance(request, requests.Connect):
+            logger.debug("Request type = connect")
+            self.connect(connection, request)
+        elif isinstance(request, requests.Disconnect):
+            logger.debug("Request type = disconnect")
+            self.disconnect(connection, request)
+        elif isinstance(request, requests.Put):
+            logger.debug("Request type = put")
+            self.put(connection, request)
+        elif isinstance(request, requests.Get):
+            logger.debug("Request type = get")
+            self.get(connection, request)
+        elif isinstance(request, requests.Set_Path):
+            logger.debug("Request type = setpath")
+            self.setpath(connection, request)
+        else:
+            logger.debug("Request type = Unknown. so rejected")
+            self._reject(connection)
+
+    def _send_body(self, socket, chunks, header_list=()):
+        """Sends the byte strings of chunks as body of the GET response.
+
+        Every packet is filled up to the negotiated max packet length and is
+        built in one reusable buffer, so only a packet worth of the body is
+        held at a time. header_list is repeated in every packet.
+        Returns False if the client aborted the operation.
+        """
+        max_length = self._max_length()
+        prefix = b"".join(header.data for header in header_list)
+        body_offset = 3 + len(prefix) + 3  # response header, headers, body header
+        capacity = max_length - body_offset
+        if capacity <= 0:
+            logger.error("Headers don't fit in max packet length %d", max_length)
+            self.send_response(socket, responses.Internal_Server_Error())
+            return False
+        packet = bytearray(max_length)
+        packet[3:3 + len(prefix)] = prefix
+        view = memoryview(packet)
+        filled = 0
+        for chunk in chunks:
+            chunk = memoryview(chunk)
+            while chunk:
+                if filled == capacity:
+                    # packet is full and there is more to send
+                    self._send_body_packet(socket, view, body_offset, filled, final=False)
+                    if not self._wait_for_get_final(socket):
+                        return False
+                    filled = 0
+                size = min(capacity - filled, len(chunk))
+                view[body_offset + filled:body_offset + filled + size] = chunk[:size]
+                filled += size
+                chunk = chunk[size:]
+        self._send_body_packet(socket, view, body_offset, filled, final=True)
+        return True
+
+    def _send_body_packet(self, socket, view, body_offset, body_length, final):
+        length = body_offset + body_length
+        response, body = (responses.Success, headers.End_Of_Body) if final else (responses.Continue, headers.Body)
+        struct.pack_into(">BH", view, 0, response.code, length)
+        struct.pack_into(">BH", view, body_offset - 3, body.code, body_length + 3)
+        logger.debug("Sending %s with %d bytes of body", response.__name__, body_length)
+        socket.sendall(view[:length])
+
+    def _collect_request(self, socket, request):
+        """Returns the decoded headers of a PUT or GET request whose headers
+        (or body) span several packets, answering the non-final packets with
+        Continue. Returns None if the client aborted the operation."""
+        header_dict = self._decode_header_data(request)
+        while not request.is_final():
+            self.send_response(socket, responses.Continue())
+            request = self.request_handler.decode(socket)
+            if isinstance(request, requests.Abort):
+                logger.info("Client aborted the operation")
+                self.send_response(socket, responses.Success())
+                return None
+            for name, value in self._decode_header_data(request).items():
+                if name == "Body":
+                    header_dict["Body"] = header_dict.get("Body", b"") + value
+                elif name == "App_Parameters":
+                    header_dict.setdefault("App_Parameters", {}).update(value)
+                else:
+                    header_dict[name] = value
+        return header_dict
+
+    @staticmethod
+    def _app_param(app_params, name, default=None):
+        """Returns the decoded value of application parameter name, text ones as str"""
+        if name not in app_params:
+            return default
+        value = app_params[name].decode()
+        if isinstance(value, bytes):
+            value = value.decode("utf-8").rstrip("\0")
+        return value
+
+    def _wait_for_get_final(self, socket):
+        """Processes the requests up to the GET continuing the current operation.
+        Returns False if the client aborted the operation instead."""
+        while True:
+            request = self.request_handler.decode(socket)
+            if isinstance(request, requests.Get_Final):
+                return True
+            if isinstance(request, requests.Abort):
+                logger.info("Client aborted the GET operation")
+                self.send_response(socket, responses.Success())
+                return False
+            self.process_request(socket, request)
+
+    def _max_length(self):
+        """Override: max packet length negotiated at CONNECT"""
+        if self.remote_info is None:
+            return self.max_packet_length
+        return min(self.max_packet_length, self.remote_info.max_packet_length)
+
+    @staticmethod
+    def _header_text(header):
+        """Decodes a Name or Type header to str, without its terminator. PyOBEX
+        returns Type (and Name in some versions) as bytes, Name as str otherwise."""
+        value = header.decode()
+        if isinstance(value, bytes):
+            value = value.decode("utf-8", "replace")
+        return value.rstrip("\r\n\t\0")
+
+    def _decode_header_data(self, request):
+        """Decodes all headers in given request and return the decoded values in dict"""
+        header_dict = {}
+        for header in request.header_data:
+            if isinstance(header, headers.Name):
+                header_dict["Name"] = self._header_text(header)
+                logger.info("Name = %s" % header_dict["Name"])
+            elif isinstance(header, headers.Length):
+                header_dict["Length"] = header.decode()
+                logger.info("Length = %i" % header_dict["Length"])
+            elif isinstance(header, headers.Type):
+                header_dict["Type"] = self._header_text(header)
+                logger.info("Type = %s" % header_dict["Type"])
+            elif isinstance(header, headers.Connection_ID):
+                header_dict["Connection_ID"] = header.decode()
+                logger.info("Connection ID = %s" % header_dict["Connection_ID"])
+            elif isinstance(header, headers.App_Parameters):
+                header_dict["App_Parameters"] = header.decode()
+                logger.info("App Parameters are :")
+                for param, value in header_dict["App_Parameters"].items():
+                    logger.info("{param}: {value}".format(param=param, value=value.decode()))
+            elif isinstance(header, (headers.Body, headers.End_Of_Body)):
+                header_dict["Body"] = header_dict.get("Body", b"") + header.decode()
+            elif isinstance(header, headers.SingleResponseMode):
+                # SRM is not supported, not confirming it makes the client use normal GETs
+                logger.info("Ignoring %s header", type(header).__name__)
+            else:
+                # optional headers (Description, Time, Who, ...) don't change how a request is served
+                logger.info("Ignoring %s header", type(header).__name__)
+        return header_dict
+
+    def serve(self, socket):
+        """Override: serves every connection in its own thread, at most
+        max_sessions at a time. Further connections wait in the listen
+        backlog until a session ends.
+        """
+        slots = threading.BoundedSemaphore(self.max_sessions)
+        while True:
+            slots.acquire()
+            try:
+                connection, address = socket.accept()
+            except IOError:
+                slots.release()
+                raise
+            if not self.accept_connection(*address):
+                connection.close()
+                slots.release()
+                continue
+            session = self.session_class(connection, address, self.rootdir)
+            thread = threading.Thread(target=self._serve_session, args=(session, slots),
+                                      name="{}-session-{}".format(self.profile.lower(), address[0]))
+            thread.daemon = True
+            thread.start()
+
+    def _serve_session(self, session, slots):
+        """Handles the requests of one connection until it disconnects"""
+        self._local.session = session
+        logger.info("%s, Connection from %s", self.profile, session.address)
+        session.connected = True
+        try:
+            while session.connected:
+                request = self.request_handler.decode(session.connection)
+                self.process_request(session.connection, request)
+        except (IOError, struct.error) as err:
+            logger.error("%s, Connection from %s lost: %s", self.profile, session.address, err)
+        finally:
+            session.connection.close()
+            del self._local.session
+            slots.release()
+            self._session_closed(session)
+
+    def _session_closed(self, session):
+        logger.info("%s, Session of %s closed", self.profile, session.address)
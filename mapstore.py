@@ -0,0 +1,269 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""SQLite message store of the MSE server"""
+
+import logging
+import posixpath
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FOLDERS = ["telecom", "telecom/msg", "telecom/msg/inbox", "telecom/msg/outbox",
+                   "telecom/msg/sent", "telecom/msg/deleted", "telecom/msg/draft"]
+
+# FilterMessageType bits, a set bit filters the type out
+MESSAGE_TYPE_BITS = {
+    "SMS_GSM": 0x01,
+    "SMS_CDMA": 0x02,
+    "EMAIL": 0x04,
+    "MMS": 0x08,
+    "IM": 0x10,
+}
+
+# columns of a message, in the order of the MAP-msg-listing attributes
+LISTING_COLUMNS = ["handle", "subject", "datetime", "sender_name", "sender_addressing", "replyto_addressing",
+                   "recipient_name", "recipient_addressing", "type", "size", "text", "reception_status",
+                   "attachment_size", "priority", "read", "sent", "protected"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS folders (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS folders_parent ON folders (parent);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    folder TEXT NOT NULL,
+    type TEXT NOT NULL,
+    subject TEXT NOT NULL DEFAULT '',
+    datetime TEXT NOT NULL DEFAULT '',
+    sender_name TEXT NOT NULL DEFAULT '' COLLATE NOCASE,
+    sender_addressing TEXT NOT NULL DEFAULT '' COLLATE NOCASE,
+    replyto_addressing TEXT NOT NULL DEFAULT '',
+    recipient_name TEXT NOT NULL DEFAULT '' COLLATE NOCASE,
+    recipient_addressing TEXT NOT NULL DEFAULT '' COLLATE NOCASE,
+    size INTEGER NOT NULL DEFAULT 0,
+    text INTEGER NOT NULL DEFAULT 1,
+    reception_status TEXT NOT NULL DEFAULT 'complete',
+    attachment_size INTEGER NOT NULL DEFAULT 0,
+    priority INTEGER NOT NULL DEFAULT 0,
+    read INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    protected INTEGER NOT NULL DEFAULT 0,
+    bmessage BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_folder_datetime ON messages (folder, datetime);
+CREATE INDEX IF NOT EXISTS messages_folder_type ON messages (folder, type, datetime);
+CREATE INDEX IF NOT EXISTS messages_folder_read ON messages (folder, read, datetime);
+CREATE INDEX IF NOT EXISTS messages_folder_priority ON messages (folder, priority, datetime);
+CREATE INDEX IF NOT EXISTS messages_sender_name ON messages (sender_name);
+CREATE INDEX IF NOT EXISTS messages_sender_addressing ON messages (sender_addressing);
+CREATE INDEX IF NOT EXISTS messages_recipient_name ON messages (recipient_name);
+CREATE INDEX IF NOT EXISTS messages_recipient_addressing ON messages (recipient_addressing);
+"""
+
+
+def format_handle(message_id):
+    return "{:016X}".format(message_id)
+
+
+def parse_handle(handle):
+    """Returns the message id of a handle, None if it is not one of ours"""
+    try:
+        return int(handle, 16)
+    except ValueError:
+        return None
+
+
+def mse_time(timestamp=None):
+    """Returns timestamp (default: now) in the MSETime format"""
+    return time.strftime("%Y%m%dT%H%M%S%z", time.localtime(timestamp))
+
+
+def _like_pattern(value):
+    """LIKE pattern of a filter string, '*' being the wildcard"""
+    value = value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return value.replace("*", "%")
+
+
+class MessageStore(object):
+    """Messages and folders of one MAS instance in a SQLite database.
+
+    Folder paths are relative to the root and have no leading '/', e.g.
+    'telecom/msg/inbox'. Messages listing filters are translated into
+    WHERE clauses on indexed columns.
+    """
+
+    def __init__(self, path=":memory:", folders=DEFAULT_FOLDERS):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.executescript(_SCHEMA)
+            self._db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('database_id', ?)",
+                             (uuid.uuid4().hex.upper(),))
+            self.database_id = self._db.execute("SELECT value FROM meta WHERE key = 'database_id'").fetchone()[0]
+        for folder in folders:
+            self.add_folder(folder)
+        self.analyze()
+
+    def analyze(self):
+        """Updates the statistics the query planner uses to pick an index
+        per filter, to be called after large changes"""
+        with self._lock, self._db:
+            self._db.execute("PRAGMA analysis_limit = 400")
+            self._db.execute("ANALYZE")
+
+    def close(self):
+        self._db.close()
+
+    @staticmethod
+    def normpath(path):
+        return posixpath.normpath(path).strip("/") if path.strip("/") else ""
+
+    def add_folder(self, path):
+        path = self.normpath(path)
+        parent = posixpath.dirname(path)
+        if parent and not self.folder_exists(parent):
+            self.add_folder(parent)
+        with self._lock, self._db:
+            self._db.execute("INSERT OR IGNORE INTO folders (path, parent) VALUES (?, ?)", (path, parent))
+
+    def folder_exists(self, path):
+        path = self.normpath(path)
+        if not path:
+            return True
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM folders WHERE path = ?", (path,)).fetchone() is not None
+
+    def list_folders(self, path, offset=0, limit=None):
+        """Returns the total number of subfolders of path and the names of the requested ones"""
+        path = self.normpath(path)
+        with self._lock:
+            count = self._db.execute("SELECT COUNT(*) FROM folders WHERE parent = ?", (path,)).fetchone()[0]
+            rows = self._db.execute("SELECT path FROM folders WHERE parent = ? ORDER BY path LIMIT ? OFFSET ?",
+                                    (path, -1 if limit is None else limit, offset)).fetchall()
+        return count, [posixpath.basename(row[0]) for row in rows]
+
+    def folder_version(self, path):
+        """Returns the FolderVersionCounter of path, it changes with every change of its messages"""
+        with self._lock:
+            row = self._db.execute("SELECT version FROM folders WHERE path = ?", (self.normpath(path),)).fetchone()
+        return "{:032X}".format(row[0] if row is not None else 0)
+
+    def _bump_folders(self, condition, args):
+        """Increments the version of the folders of the messages matching condition"""
+        self._db.execute("UPDATE folders SET version = version + 1 WHERE path IN "
+                         "(SELECT folder FROM messages WHERE " + condition + ")", args)
+
+    def _filter_clause(self, folder, message_type=0, period_begin=None, period_end=None, read_status=0,
+                       recipient=None, originator=None, priority=0):
+        clauses = ["folder = ?"]
+        args = [self.normpath(folder)]
+        if message_type:
+            types = [name for name, bit in MESSAGE_TYPE_BITS.items() if not message_type & bit]
+            clauses.append("type IN ({})".format(", ".join("?" * len(types))) if types else "0")
+            args.extend(types)
+        if period_begin:
+            clauses.append("datetime >= ?")
+            args.append(period_begin)
+        if period_end:
+            clauses.append("datetime < ?")
+            args.append(period_end)
+        if read_status in (1, 2):  # 1: unread only, 2: read only
+            clauses.append("read = ?")
+            args.append(1 if read_status == 2 else 0)
+        if priority in (1, 2):  # 1: high priority only, 2: non-high priority only
+            clauses.append("priority = ?")
+            args.append(1 if priority == 1 else 0)
+        if recipient:
+            clauses.append("(recipient_name LIKE ? ESCAPE '\\' OR recipient_addressing LIKE ? ESCAPE '\\')")
+            args.extend([_like_pattern(recipient)] * 2)
+        if originator:
+            clauses.append("(sender_name LIKE ? ESCAPE '\\' OR sender_addressing LIKE ? ESCAPE '\\')")
+            args.extend([_like_pattern(originator)] * 2)
+        return " AND ".join(clauses), args
+
+    def list_messages(self, folder, offset=0, limit=None, **filters):
+        """Returns the number of messages of folder matching filters and the
+        requested ones, newest first, as dicts of LISTING_COLUMNS.
+
+        filters are message_type, period_begin, period_end, read_status,
+        recipient, originator and priority with the values of the
+        corresponding MAP application parameters.
+        """
+        where, args = self._filter_clause(folder, **filters)
+        with self._lock:
+            count = self._db.execute("SELECT COUNT(*) FROM messages WHERE " + where, args).fetchone()[0]
+            rows = self._db.execute("SELECT * FROM messages WHERE " + where +
+                                    " ORDER BY datetime DESC, id DESC LIMIT ? OFFSET ?",
+                                    args + [-1 if limit is None else limit, offset]).fetchall()
+        return count, [self._listing_entry(row) for row in rows]
+
+    @staticmethod
+    def _listing_entry(row):
+        entry = dict((column, row[column]) for column in LISTING_COLUMNS if column != "handle")
+        entry["handle"] = format_handle(row["id"])
+        return entry
+
+    def has_unread(self, folder):
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM messages WHERE folder = ? AND read = 0 LIMIT 1",
+                                    (self.normpath(folder),)).fetchone() is not None
+
+    def get_message(self, handle):
+        """Returns the bMessage of handle, None if there is no such message"""
+        message_id = parse_handle(handle)
+        with self._lock:
+            row = self._db.execute("SELECT bmessage FROM messages WHERE id = ?", (message_id,)).fetchone()
+        return None if row is None else bytes(row[0])
+
+    def add_message(self, folder, bmessage, **fields):
+        """Stores a bMessage in folder, fields are the listing columns. Returns its handle"""
+        fields.setdefault("datetime", time.strftime("%Y%m%dT%H%M%S"))
+        columns = ["folder", "bmessage"] + sorted(fields)
+        values = [self.normpath(folder), bmessage] + [fields[column] for column in sorted(fields)]
+        with self._lock, self._db:
+            cursor = self._db.execute("INSERT INTO messages ({}) VALUES ({})".format(
+                ", ".join(columns), ", ".join("?" * len(columns))), values)
+            self._db.execute("UPDATE folders SET version = version + 1 WHERE path = ?", (values[0],))
+        return format_handle(cursor.lastrowid)
+
+    def set_read(self, handle, read):
+        """Sets the read status of a message, returns False if there is no such message"""
+        message_id = parse_handle(handle)
+        with self._lock, self._db:
+            cursor = self._db.execute("UPDATE messages SET read = ? WHERE id = ?", (1 if read else 0, message_id))
+            self._bump_folders("id = ?", (message_id,))
+        return cursor.rowcount > 0
+
+    def delete_message(self, handle, deleted_folder="telecom/msg/deleted"):
+        """Moves a message to the deleted folder, or removes it if it is there
+        already. Returns False if there is no such message."""
+        message_id = parse_handle(handle)
+        with self._lock, self._db:
+            self._bump_folders("id = ?", (message_id,))
+            cursor = self._db.execute("UPDATE messages SET folder = ? WHERE id = ? AND folder != ?",
+                                      (deleted_folder, message_id, deleted_folder))
+            if cursor.rowcount == 0:
+                cursor = self._db.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+            else:
+                self._bump_folders("id = ?", (message_id,))
+        return cursor.rowcount > 0
+
+    def undelete_message(self, handle, folder="telecom/msg/inbox"):
+        message_id = parse_handle(handle)
+        with self._lock, self._db:
+            self._bump_folders("id = ?", (message_id,))
+            cursor = self._db.execute("UPDATE messages SET folder = ? WHERE id = ?", (folder, message_id))
+            self._bump_folders("id = ?", (message_id,))
+        return cursor.rowcount > 0
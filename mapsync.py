@@ -0,0 +1,158 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""Delta sync of MAP folders using the MSE version counters"""
+
+import collections
+import json
+import logging
+import posixpath
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Changes of a folder since the last sync. resync is True if the stored
+# snapshot was dropped (new DatabaseIdentifier), every handle is added then.
+FolderDelta = collections.namedtuple("FolderDelta", ["folder", "added", "removed", "modified", "resync"])
+
+# MessageRecord attributes whose change makes a message modified
+FINGERPRINT_FIELDS = ("subject", "datetime", "sender_name", "sender_addressing", "type", "size", "read")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS folder_versions (
+    device TEXT NOT NULL,
+    instance INTEGER NOT NULL,
+    folder TEXT NOT NULL,
+    database_id TEXT,
+    folder_version TEXT,
+    conversation_version TEXT,
+    mse_time TEXT,
+    PRIMARY KEY (device, instance, folder)
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    device TEXT NOT NULL,
+    instance INTEGER NOT NULL,
+    folder TEXT NOT NULL,
+    handle TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    PRIMARY KEY (device, instance, folder, handle)
+);
+"""
+
+
+def fingerprint(record):
+    return json.dumps([getattr(record, field) for field in FINGERPRINT_FIELDS])
+
+
+class SyncState(object):
+    """Last seen version counters and messages of the synced folders, in SQLite"""
+
+    def __init__(self, path=":memory:"):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.executescript(_SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def versions(self, device, instance, folder):
+        """Returns (database_id, folder_version) of the last sync of folder, None if it was never synced"""
+        with self._lock:
+            return self._db.execute("SELECT database_id, folder_version FROM folder_versions "
+                                    "WHERE device = ? AND instance = ? AND folder = ?",
+                                    (device, instance, folder)).fetchone()
+
+    def database_ids(self, device, instance):
+        with self._lock:
+            rows = self._db.execute("SELECT DISTINCT database_id FROM folder_versions "
+                                    "WHERE device = ? AND instance = ? AND database_id IS NOT NULL",
+                                    (device, instance)).fetchall()
+        return set(row[0] for row in rows)
+
+    def snapshot(self, device, instance, folder):
+        """Returns {handle: fingerprint} of folder as of its last sync"""
+        with self._lock:
+            return dict(self._db.execute("SELECT handle, fingerprint FROM snapshots "
+                                         "WHERE device = ? AND instance = ? AND folder = ?",
+                                         (device, instance, folder)))
+
+    def reset(self, device, instance):
+        """Drops the state of all folders of a MAS instance"""
+        with self._lock, self._db:
+            for table in ("folder_versions", "snapshots"):
+                self._db.execute("DELETE FROM {} WHERE device = ? AND instance = ?".format(table), (device, instance))
+
+    def save(self, device, instance, folder, versions, added, removed, modified):
+        """Stores the versions of folder and applies a delta to its snapshot,
+        added and modified are {handle: fingerprint}, removed are handles"""
+        key = (device, instance, folder)
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO folder_versions VALUES (?, ?, ?, ?, ?, ?, ?)", key + (
+                versions.get("DatabaseIdentifier"), versions.get("FolderVersionCounter"),
+                versions.get("Conversation-ListingVersionCounter"), versions.get("MSETime")))
+            self._db.executemany("DELETE FROM snapshots WHERE device = ? AND instance = ? AND folder = ? "
+                                 "AND handle = ?", [key + (handle,) for handle in removed])
+            self._db.executemany("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?)",
+                                 [key + item for item in list(added.items()) + list(modified.items())])
+
+
+class DeltaSync(object):
+    """Syncs folders of one MAS instance against their stored snapshot.
+
+    The listing of a folder is only requested if its FolderVersionCounter
+    changed, and then only the difference to the snapshot is reported. A
+    new DatabaseIdentifier means handles may have been reused, so the
+    state of the whole instance is dropped and synced from scratch. MSEs
+    before MAP 1.3 report no counters, their folders are always listed.
+    """
+
+    def __init__(self, client, state, device=None):
+        self.client = client
+        self.state = state
+        self.device = device if device is not None else client.address
+
+    def sync_folder(self, name="", page_size=1024):
+        """Syncs sub folder name of the current folder (the current folder if empty).
+        Returns a FolderDelta, None if the MSE failed to list the folder completely."""
+        folder = posixpath.normpath(posixpath.join(self.client.current_dir, name))
+        instance = self.client.mas_instance_id
+        # the counters are read before the entries, so a change while listing
+        # shows up as a new counter on the next sync
+        versions = self.client.get_listing_versions(name)
+        if versions is None:
+            return
+        database_id = versions.get("DatabaseIdentifier")
+        resync = False
+        if database_id is not None and self.state.database_ids(self.device, instance) - {database_id}:
+            logger.info("DatabaseIdentifier of MAS instance %d changed, syncing from scratch", instance)
+            self.state.reset(self.device, instance)
+            resync = True
+
+        stored = self.state.versions(self.device, instance, folder)
+        folder_version = versions.get("FolderVersionCounter")
+        if stored is not None and folder_version is not None and stored[1] == folder_version:
+            logger.debug("Folder %s unchanged (version %s)", folder, folder_version)
+            return FolderDelta(folder, [], [], [], resync)
+
+        old = self.state.snapshot(self.device, instance, folder)
+        new = collections.OrderedDict()
+        completed = []
+        for record in self.client.walk_messages_listing(name, page_size, fields=FINGERPRINT_FIELDS,
+                                                        on_complete=completed.append):
+            new[record.handle] = fingerprint(record)
+        # a failed page ends the walk early, and messages changing while it pages
+        # shift the entries between pages, the snapshot would miss some of them then
+        listing_sizes = set([versions.get("ListingSize")] + completed) - {None}
+        if not completed or listing_sizes - {len(new)}:
+            logger.error("Listing of folder %s is incomplete (%d entries, ListingSize %s), not saving it",
+                         folder, len(new), sorted(listing_sizes))
+            return
+        added = dict((handle, value) for handle, value in new.items() if handle not in old)
+        modified = dict((handle, value) for handle, value in new.items() if handle in old and old[handle] != value)
+        removed = [handle for handle in old if handle not in new]
+        self.state.save(self.device, instance, folder, versions, added, removed, modified)
+        logger.info("Folder %s: %d added, %d removed, %d modified", folder, len(added), len(removed), len(modified))
+        return FolderDelta(folder, [handle for handle in new if handle in added], removed,
+                           [handle for handle in new if handle in modified], resync)
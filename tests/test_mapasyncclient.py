@@ -0,0 +1,104 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""Tests of the cancellation of AsyncMAPClient operations"""
+
+import asyncio
+import socket
+import struct
+import unittest
+
+import mapasyncclient
+
+OBEX_CONNECT = 0x80
+OBEX_GET_FINAL = 0x83
+OBEX_ABORT = 0xFF
+
+CONNECT_SUCCESS = struct.pack(">BHBBH", 0xA0, 7, 0x10, 0, 0xffff)
+CONTINUE = struct.pack(">BH", 0x90, 3)
+ABORT_SUCCESS = struct.pack(">BH", 0xA0, 3)
+
+
+def success_with_body(body):
+    return struct.pack(">BHBH", 0xA0, 6 + len(body), 0x49, 3 + len(body)) + body
+
+
+class StandInMSE(object):
+    """Answers OBEX requests on a TCP port. The response to the first GET
+    is held back until release is set, so the test can cancel the client
+    while it waits for it."""
+
+    def __init__(self, first_get_response):
+        self.first_get_response = first_get_response
+        self.opcodes = []
+        self.get_received = asyncio.Event()
+        self.release = asyncio.Event()
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                opcode, length = struct.unpack(">BH", await reader.readexactly(3))
+                await reader.readexactly(length - 3)
+                self.opcodes.append(opcode)
+                if opcode == OBEX_CONNECT:
+                    writer.write(CONNECT_SUCCESS)
+                elif opcode == OBEX_ABORT:
+                    writer.write(ABORT_SUCCESS)
+                elif opcode == OBEX_GET_FINAL and self.opcodes.count(OBEX_GET_FINAL) == 1:
+                    self.get_received.set()
+                    await self.release.wait()
+                    writer.write(self.first_get_response)
+                else:
+                    writer.write(success_with_body(b"BEGIN:BMSG\r\nEND:BMSG\r\n"))
+                await writer.drain()
+        except asyncio.IncompleteReadError:
+            writer.close()
+
+
+class TestCancellation(unittest.TestCase):
+
+    def run_cancelled_get(self, first_get_response):
+        """Cancels a messages listing while its response is outstanding,
+        then gets a message. Returns the request opcodes seen by the MSE
+        and the message body."""
+        async def scenario():
+            mse = StandInMSE(first_get_response)
+            port = await mse.start()
+            map_client = mapasyncclient.AsyncMAPClient("127.0.0.1", port, sock_factory=socket.socket)
+            try:
+                await map_client.connect()
+                listing = asyncio.ensure_future(map_client.get_messages_listing("inbox"))
+                await asyncio.wait_for(mse.get_received.wait(), 5)
+                listing.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await listing
+                mse.release.set()
+                response = await asyncio.wait_for(map_client.get_message("0000000000000001"), 5)
+            finally:
+                map_client._close()
+                await mse.stop()
+            return mse.opcodes, response[1]
+        return asyncio.run(scenario())
+
+    def test_cancelled_operation_is_aborted_before_the_next_one(self):
+        opcodes, body = self.run_cancelled_get(CONTINUE)
+        self.assertEqual(opcodes, [OBEX_CONNECT, OBEX_GET_FINAL, OBEX_ABORT, OBEX_GET_FINAL])
+        self.assertEqual(body, b"BEGIN:BMSG\r\nEND:BMSG\r\n")
+
+    def test_completed_operation_is_not_aborted(self):
+        opcodes, body = self.run_cancelled_get(success_with_body(b"<MAP-msg-listing/>"))
+        self.assertEqual(opcodes, [OBEX_CONNECT, OBEX_GET_FINAL, OBEX_GET_FINAL])
+        self.assertEqual(body, b"BEGIN:BMSG\r\nEND:BMSG\r\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,187 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""Tests of the incremental bMessage parser"""
+
+import base64
+import io
+import unittest
+
+import mapbmessage
+
+
+def bmessage(message_type, content):
+    return (b"BEGIN:BMSG\r\nVERSION:1.0\r\nSTATUS:UNREAD\r\nTYPE:" + message_type + b"\r\n"
+            b"FOLDER:TELECOM/MSG/INBOX\r\n"
+            b"BEGIN:VCARD\r\nVERSION:2.1\r\nN:Bob\r\nTEL:+4912345\r\nEND:VCARD\r\n"
+            b"BEGIN:BENV\r\n"
+            b"BEGIN:VCARD\r\nVERSION:2.1\r\nN:Alice\r\nEMAIL:alice@example.com\r\nEND:VCARD\r\n"
+            b"BEGIN:BBODY\r\nENCODING:8BIT\r\nCHARSET:UTF-8\r\nLENGTH:" + str(len(content) + 22).encode() + b"\r\n"
+            b"BEGIN:MSG\r\n" + content + b"\r\nEND:MSG\r\n"
+            b"END:BBODY\r\nEND:BENV\r\nEND:BMSG\r\n")
+
+
+def email(*lines):
+    return b"\r\n".join(lines)
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class ParserTestCase(unittest.TestCase):
+
+    def parse(self, data, chunk_size=None, **kwargs):
+        """Returns the parts of data fed in one piece, or in pieces of chunk_size bytes"""
+        chunks = [data] if chunk_size is None else chunked(data, chunk_size)
+        return list(mapbmessage.iter_parts(mapbmessage.BMessageParser(**kwargs), chunks))
+
+    def contents(self, parts):
+        return [(part.content_type, part.file.read()) for part in parts
+                if isinstance(part, mapbmessage.ContentPart)]
+
+    def assert_contents(self, data, expected, **kwargs):
+        """Checks the contents of data for every way of splitting it in chunks"""
+        for chunk_size in (None, 1, 2, 3, 5, 7, 64):
+            self.assertEqual(self.contents(self.parse(data, chunk_size, **kwargs)), expected,
+                             "chunk size {}".format(chunk_size))
+
+
+class TestBMessageParser(ParserTestCase):
+
+    def test_sms(self):
+        header, originator, recipient, body_info, text = self.parse(bmessage(b"SMS_GSM", b"hello\r\nworld"))
+        self.assertEqual(header.properties["TYPE"], "SMS_GSM")
+        self.assertEqual((originator.role, originator.properties["N"]), ("originator", ["Bob"]))
+        self.assertEqual((recipient.role, recipient.properties["N"]), ("recipient", ["Alice"]))
+        self.assertEqual(body_info.properties["CHARSET"], "UTF-8")
+        self.assertEqual(text.file.read(), b"hello\r\nworld")
+        self.assertIsNone(text.headers)
+
+    def test_sms_text_split_in_chunks(self):
+        self.assert_contents(bmessage(b"SMS_GSM", b"line one\r\n\r\nEND:MSG is text here\r\nlast"),
+                             [("text/plain", b"line one\r\n\r\nEND:MSG is text here\r\nlast")])
+
+    def test_unbalanced_end_is_rejected(self):
+        with self.assertRaises(ValueError):
+            self.parse(b"BEGIN:BMSG\r\nEND:BENV\r\n")
+
+
+class TestContentTransferEncodings(ParserTestCase):
+
+    def test_quoted_printable_split_escapes_and_soft_breaks(self):
+        content = email(b"Content-Type: text/plain; charset=utf-8",
+                        b"Content-Transfer-Encoding: quoted-printable",
+                        b"",
+                        b"caf=C3=A9 au lait, a very long line that is wrapped =",
+                        b"with a soft line break, an escaped =3D sign=20",
+                        b"and trailing whitespace   ",
+                        b"=E2=82=AC")
+        self.assert_contents(bmessage(b"EMAIL", content), [(
+            "text/plain",
+            "café au lait, a very long line that is wrapped with a soft line break, an escaped = sign \r\n"
+            "and trailing whitespace\r\n€".encode("utf-8"))])
+
+    def test_quoted_printable_soft_break_at_the_end(self):
+        content = email(b"Content-Transfer-Encoding: quoted-printable", b"", b"no break at the end=")
+        self.assert_contents(bmessage(b"EMAIL", content), [("text/plain", b"no break at the end")])
+
+    def test_base64_across_chunks_and_lines(self):
+        data = bytes(range(256)) * 3
+        encoded = base64.encodebytes(data).replace(b"\n", b"\r\n").rstrip()
+        content = email(b"Content-Type: application/octet-stream",
+                        b"Content-Transfer-Encoding: base64", b"", encoded)
+        self.assert_contents(bmessage(b"MMS", content), [("application/octet-stream", data)])
+
+
+class TestMultipart(ParserTestCase):
+
+    def test_nested_multiparts(self):
+        content = email(b"Content-Type: multipart/mixed; boundary=outer",
+                        b"",
+                        b"preamble, dropped",
+                        b"--outer",
+                        b"Content-Type: multipart/alternative; boundary=inner",
+                        b"",
+                        b"--inner",
+                        b"Content-Type: text/plain",
+                        b"",
+                        b"plain text",
+                        b"--inner",
+                        b"Content-Type: text/html",
+                        b"",
+                        b"<p>html</p>",
+                        b"--inner--",
+                        b"epilogue of inner, dropped",
+                        b"--outer",
+                        b"Content-Type: image/png",
+                        b"Content-Disposition: attachment; filename=dot.png",
+                        b"Content-Transfer-Encoding: base64",
+                        b"",
+                        base64.b64encode(b"\x89PNG dot"),
+                        b"--outer--",
+                        b"epilogue, dropped")
+        self.assert_contents(bmessage(b"EMAIL", content), [("text/plain", b"plain text"),
+                                                           ("text/html", b"<p>html</p>"),
+                                                           ("image/png", b"\x89PNG dot")])
+        attachment = [part for part in self.parse(bmessage(b"EMAIL", content))
+                      if isinstance(part, mapbmessage.ContentPart)][-1]
+        self.assertEqual(attachment.filename, "dot.png")
+
+    def test_boundary_like_text_is_content(self):
+        content = email(b"Content-Type: multipart/mixed; boundary=b1",
+                        b"",
+                        b"--b1",
+                        b"",
+                        b"--b1 is not alone on this line",
+                        b"--b2",
+                        b"--b1--")
+        self.assert_contents(bmessage(b"EMAIL", content),
+                             [("text/plain", b"--b1 is not alone on this line\r\n--b2")])
+
+
+class TestBufferSize(ParserTestCase):
+
+    def test_small_part_stays_in_memory(self):
+        text, = [part for part in self.parse(bmessage(b"SMS_GSM", b"short"), buffer_size=64)
+                 if isinstance(part, mapbmessage.ContentPart)]
+        self.assertFalse(text.file._rolled)
+        self.assertEqual(text.file.read(), b"short")
+
+    def test_large_part_spills_to_disk(self):
+        content = b"\r\n".join(b"line %04d of a long message" % i for i in range(100))
+        for chunk_size in (None, 7, 100):
+            text, = [part for part in self.parse(bmessage(b"SMS_GSM", content), chunk_size, buffer_size=64)
+                     if isinstance(part, mapbmessage.ContentPart)]
+            self.assertTrue(text.file._rolled)
+            self.assertEqual((text.size, text.file.read()), (len(content), content))
+
+    def test_long_content_line_is_written_in_pieces(self):
+        data = bytes(range(256)) * 8
+        content = email(b"Content-Type: application/octet-stream",
+                        b"Content-Transfer-Encoding: base64", b"", base64.b64encode(data))
+        self.assert_contents(bmessage(b"MMS", content), [("application/octet-stream", data)], buffer_size=80)
+
+    def test_long_line_outside_content_is_rejected(self):
+        with self.assertRaises(ValueError):
+            self.parse(b"BEGIN:BMSG\r\nFOLDER:" + b"x" * 100 + b"\r\n", 16, buffer_size=64)
+        content = email(b"Content-Type: text/plain", b"X-Long: " + b"x" * 100, b"", b"text")
+        with self.assertRaises(ValueError):
+            self.parse(bmessage(b"EMAIL", content), buffer_size=64)
+
+    def test_sink_factory(self):
+        sinks = []
+
+        def sink_factory(headers):
+            sinks.append((headers.get_content_type(), io.BytesIO()))
+            return sinks[-1][1]
+        content = email(b"Content-Type: multipart/mixed; boundary=b1", b"",
+                        b"--b1", b"Content-Type: text/plain", b"", b"one",
+                        b"--b1", b"Content-Type: text/html", b"", b"two", b"--b1--")
+        self.assertEqual(self.contents(self.parse(bmessage(b"EMAIL", content), sink_factory=sink_factory)),
+                         [("text/plain", b"one"), ("text/html", b"two")])
+        self.assertEqual([content_type for content_type, _ in sinks], ["text/plain", "text/html"])
+
+
+if __name__ == "__main__":
+    unittest.main()
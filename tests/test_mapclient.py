@@ -0,0 +1,105 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""Tests of the MAPClient and AsyncMAPClient requests against an MSE server"""
+
+import asyncio
+import socket
+import threading
+import unittest
+
+import mapasyncclient
+import mapclient
+import mapheaders as headers
+import mapmse
+import mapresponses as responses
+import mapstore
+
+
+def serve(server, sock):
+    try:
+        server.serve(sock)
+    except IOError:
+        pass  # listen socket closed by the test
+
+
+class MSETestCase(unittest.TestCase):
+    """Runs an MSE server with one inbox message on a TCP port"""
+
+    def setUp(self):
+        self.store = mapstore.MessageStore()
+        self.handle = self.store.add_message("telecom/msg/inbox", b"BEGIN:BMSG", type="SMS_GSM", subject="one")
+        self.mas_socket = socket.socket()
+        self.mas_socket.bind(("127.0.0.1", 0))
+        self.mas_socket.listen(1)
+        thread = threading.Thread(target=serve, args=(mapmse.MSEServer("", self.store), self.mas_socket))
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.mas_socket.close()
+
+    def inbox(self):
+        return [(entry["handle"], entry["read"]) for entry in self.store.list_messages("telecom/msg/inbox")[1]]
+
+
+class TestMAPClient(MSETestCase):
+
+    def setUp(self):
+        MSETestCase.setUp(self)
+        self.client = mapclient.MAPClient("127.0.0.1", self.mas_socket.getsockname()[1])
+        self.client.set_socket(socket.create_connection(self.mas_socket.getsockname()))
+        self.assertIsInstance(self.client.connect(header_list=[headers.Target(mapmse.MAS_TARGET_UUID)]),
+                              responses.ConnectSuccess)
+
+    def tearDown(self):
+        self.client.socket.close()
+        MSETestCase.tearDown(self)
+
+    def test_set_msg_status_read(self):
+        self.assertIsInstance(self.client.set_msg_status(self.handle, 0, 1), responses.Success)
+        self.assertEqual(self.inbox(), [(self.handle, 1)])
+
+    def test_set_msg_status_deleted(self):
+        self.assertIsInstance(self.client.set_msg_status(self.handle, 1, 1), responses.Success)
+        self.assertEqual(self.inbox(), [])
+
+    def test_update_inbox(self):
+        self.assertIsInstance(self.client.update_inbox(), responses.Success)
+
+    def test_set_msg_folder_path(self):
+        self.assertIsInstance(self.client.set_msg_folder_path("/telecom/msg/inbox"), responses.Success)
+        self.assertIsInstance(self.client.set_msg_folder_path("../sent"), responses.Success)
+        self.assertEqual(self.client.current_dir, "/telecom/msg/sent")
+        self.assertIsNone(self.client.set_msg_folder_path("/telecom/nothere"))
+        self.assertEqual(self.client.current_dir, "/telecom/msg")  # the first of the two SETPATHs went through
+
+
+class TestAsyncMAPClient(MSETestCase):
+
+    def run_client(self, operations):
+        async def scenario():
+            map_client = mapasyncclient.AsyncMAPClient("127.0.0.1", self.mas_socket.getsockname()[1],
+                                                       sock_factory=socket.socket)
+            try:
+                await map_client.connect()
+                return [await operation(map_client) for operation in operations]
+            finally:
+                map_client._close()
+        return asyncio.run(scenario())
+
+    def test_set_msg_status_and_update_inbox(self):
+        results = self.run_client([lambda map_client: map_client.set_msg_status(self.handle, 0, 1),
+                                   lambda map_client: map_client.update_inbox()])
+        self.assertEqual([type(result) for result in results], [responses.Success, responses.Success])
+        self.assertEqual(self.inbox(), [(self.handle, 1)])
+
+    def test_set_msg_folder_path(self):
+        results = self.run_client([lambda map_client: map_client.set_msg_folder_path("/telecom/msg/outbox"),
+                                   lambda map_client: map_client.set_msg_folder_path("../inbox"),
+                                   lambda map_client: map_client.set_msg_folder_path("../")])
+        self.assertEqual([type(result) for result in results], [responses.Success] * 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""Tests of the application parameters encoding"""
+
+import unittest
+
+import mapheaders as headers
+
+
+def listing_params(max_list_count=1024, offset=0):
+    return {"MaxListCount": headers.MaxListCount(max_list_count),
+            "ListStartOffset": headers.ListStartOffset(offset),
+            "FilterReadStatus": headers.FilterReadStatus(0)}
+
+
+class TestAppParametersEncoding(unittest.TestCase):
+
+    def encode(self, data):
+        return headers.App_Parameters(data, encoded=False).data
+
+    def test_properties_are_encoded_in_tagid_order(self):
+        expected = bytes.fromhex("4C000E" "01020400" "02020000" "060100")
+        self.assertEqual(self.encode(listing_params()), expected)
+        self.assertEqual(self.encode([headers.FilterReadStatus(0), headers.ListStartOffset(0),
+                                      headers.MaxListCount(1024), None]), expected)
+
+    def test_repeated_request_reuses_the_block(self):
+        first = self.encode(listing_params())
+        self.assertIs(self.encode(listing_params()), first)
+        next_page = self.encode(listing_params(offset=1024))
+        self.assertEqual(next_page, bytes.fromhex("4C000E" "01020400" "02020400" "060100"))
+
+    def test_blocks_are_bounded(self):
+        for offset in range(headers._ENCODED_BLOCKS_SIZE * 2):
+            self.encode(listing_params(offset=offset))
+        self.assertLessEqual(len(headers._encoded_blocks), headers._ENCODED_BLOCKS_SIZE)
+        self.assertEqual(headers.App_Parameters(self.encode(listing_params(offset=3))[3:], encoded=True)
+                         .decode()["ListStartOffset"].decode(), 3)
+
+
+class TestAppParamCodec(unittest.TestCase):
+
+    def test_known_values_are_encoded_once(self):
+        self.assertIs(headers.FilterReadStatus(2).data, headers.FilterReadStatus(2).data)
+        self.assertIs(headers.MaxListCount(1024).data, headers.MaxListCount(1024).data)
+        self.assertIs(headers.Attachment(True).data, headers.Attachment(1).data)
+        self.assertEqual(headers.FilterMessageType(0x1F).data, bytes.fromhex("03011F"))
+
+    def test_other_values_are_not_kept(self):
+        codec = headers.ListStartOffset.codec
+        known = len(codec._cache)
+        for offset in range(1, 200):
+            self.assertEqual(headers.ListStartOffset(offset).decode(), offset)
+        self.assertEqual(len(codec._cache), known)
+        self.assertEqual(headers.ListingSize(300).data, bytes.fromhex("1202012C"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""Tests of the phonebook folder indexes"""
+
+import threading
+import unittest
+
+import mapindex
+
+PB = "/telecom/pb"
+
+
+def vcard(name, tel="123"):
+    return {"vcard": [{"type": "N", "values": [name, ""]}, {"type": "TEL", "values": [tel]}]}
+
+
+class MemoryPhoneBook(object):
+    """vfolder stand-in keeping the vCards of its folders in lists"""
+
+    def __init__(self, cards):
+        self.books = {PB: cards}
+        self.listings = 0
+        self.listing = threading.Event()  # set while listdir runs
+        self.release = threading.Event()
+        self.release.set()
+
+    def count(self, path):
+        return len(self.books[path])
+
+    def listdir(self, path):
+        self.listings += 1
+        self.listing.set()
+        self.release.wait(5)
+        return list(self.books[path])
+
+
+class VersionedPhoneBook(MemoryPhoneBook):
+
+    def __init__(self, cards):
+        MemoryPhoneBook.__init__(self, cards)
+        self.versions = {PB: 1}
+
+    def version(self, path):
+        return self.versions[path]
+
+
+class TestPhonebookIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.vfolder = MemoryPhoneBook([vcard("Bob"), vcard("Alice")])
+        self.reindexed = []
+        self.index = mapindex.PhonebookIndex(self.vfolder, lambda path, index: self.reindexed.append(path))
+
+    def names(self, folder_index):
+        return [folder_index.values[handle]["N"] for handle in folder_index.handles]
+
+    def test_index_is_kept_while_the_state_is_unchanged(self):
+        first = self.index.folder(PB)
+        self.vfolder.books[PB][0] = vcard("Bobby")  # not reported
+        self.assertIs(self.index.folder(PB, 2), first)
+        self.assertEqual(self.vfolder.listings, 1)
+        self.assertEqual(self.reindexed, [])
+
+    def test_count_change_rebuilds(self):
+        first = self.index.folder(PB)
+        self.vfolder.books[PB].append(vcard("Carol"))
+        second = self.index.folder(PB)
+        self.assertIsNot(second, first)
+        self.assertEqual(self.names(second), [["Bob;"], ["Alice;"], ["Carol;"]])
+        self.assertEqual(self.reindexed, [PB])
+
+    def test_backend_version_change_rebuilds(self):
+        self.vfolder = VersionedPhoneBook([vcard("Bob")])
+        self.index = mapindex.PhonebookIndex(self.vfolder, lambda path, index: self.reindexed.append(path))
+        first = self.index.folder(PB)
+        self.assertIs(self.index.folder(PB), first)
+        self.vfolder.books[PB][0] = vcard("Bobby")
+        self.vfolder.versions[PB] += 1
+        self.assertEqual(self.names(self.index.folder(PB)), [["Bobby;"]])
+        self.assertEqual(self.vfolder.listings, 2)
+
+    def test_current_never_builds(self):
+        self.assertIsNone(self.index.current(PB))
+        folder_index = self.index.folder(PB)
+        self.assertIs(self.index.current(PB), folder_index)
+        self.vfolder.books[PB].pop()
+        self.assertIsNone(self.index.current(PB))
+        self.assertEqual(self.vfolder.listings, 1)
+
+    def test_reported_changes_update_the_index(self):
+        folder_index = self.index.folder(PB)
+        self.vfolder.books[PB][1] = vcard("Alicia")
+        self.index.add(PB, 1, self.vfolder.books[PB][1])
+        self.assertEqual(folder_index.search("N", "alicia"), [1])
+        self.index.invalidate(PB)
+        self.assertIsNot(self.index.folder(PB), folder_index)
+        self.assertEqual(self.vfolder.listings, 2)
+
+    def test_concurrent_requests_share_one_build(self):
+        self.vfolder.release.clear()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.index.folder(PB))) for _ in range(4)]
+        threads[0].start()
+        self.assertTrue(self.vfolder.listing.wait(5))
+        for thread in threads[1:]:
+            thread.start()
+        # the build runs outside the lock, other folders are served meanwhile
+        self.vfolder.books["/telecom/ich"] = []
+        self.vfolder.listing.clear()
+        threading.Thread(target=self.index.folder, args=("/telecom/ich",)).start()
+        self.assertTrue(self.vfolder.listing.wait(5))
+        self.vfolder.release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(result is results[0] for result in results))
+        self.assertEqual(self.vfolder.listings, 2)  # one per folder
+
+    def test_change_reported_while_building_outdates_the_build(self):
+        self.vfolder.release.clear()
+        results = []
+        thread = threading.Thread(target=lambda: results.append(self.index.folder(PB)))
+        thread.start()
+        self.assertTrue(self.vfolder.listing.wait(5))
+        self.index.invalidate(PB)
+        self.vfolder.release.set()
+        thread.join(5)
+        self.assertEqual(len(results), 1)
+        self.assertIsNot(self.index.folder(PB), results[0])
+        self.assertEqual(self.vfolder.listings, 2)
+
+    def test_failed_build_is_not_kept(self):
+        def listdir(path):
+            raise IOError("backend gone")
+        self.vfolder.listdir = listdir
+        with self.assertRaises(IOError):
+            self.index.folder(PB)
+        del self.vfolder.listdir
+        self.assertEqual(self.names(self.index.folder(PB)), [["Bob;"], ["Alice;"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,303 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""Tests of the MNS server, event reports and the mailbox kept up to date by them"""
+
+import socket
+import struct
+import threading
+import unittest
+
+from PyOBEX import client, requests
+
+import mapclient
+import mapcommon
+import mapheaders as headers
+import maplisting as listing
+import mapmns
+import mapmse
+import mapresponses as responses
+import mapstore
+
+INBOX = "/telecom/msg/inbox"
+SENT = "/telecom/msg/sent"
+
+
+def event_report(*events):
+    return ('<MAP-event-report version="1.1">' + "".join(events) + '</MAP-event-report>').encode("utf-8")
+
+
+def parse_events(body):
+    return list(listing.iter_records(mapmns.EventReportParser(), [body]))
+
+
+def new_message(handle, folder="TELECOM/MSG/INBOX", **attrs):
+    return mapmns.Event("NewMessage", handle=handle, folder=folder, msg_type="SMS_GSM", **attrs)
+
+
+def listen_socket():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(1)
+    return sock
+
+
+def serve(server, sock):
+    try:
+        server.serve(sock)
+    except IOError:
+        pass  # listen socket closed by the test
+
+
+class TestEventReportParser(unittest.TestCase):
+
+    def test_parses_events(self):
+        body = event_report(
+            '<event type="NewMessage" handle="00000000000000AA" folder="TELECOM/MSG/INBOX" msg_type="SMS_GSM" '
+            'subject="hi &amp; there" datetime="20260105T000000" sender_name="Bob" read_status="no"/>',
+            '<event type="MessageShift" handle="01" folder="TELECOM/MSG/SENT" old_folder="TELECOM/MSG/OUTBOX" '
+            'msg_type="EMAIL"/>',
+            '<event type="MemoryFull"/>')
+        new, shift, memory_full = parse_events(body)
+        self.assertEqual((new.type, new.handle, new.folder), ("NewMessage", "00000000000000AA", "TELECOM/MSG/INBOX"))
+        self.assertEqual((new.subject, new.datetime, new.sender_name), ("hi & there", "20260105T000000", "Bob"))
+        self.assertIs(new.read_status, False)
+        self.assertEqual((shift.folder, shift.old_folder, shift.msg_type),
+                         ("TELECOM/MSG/SENT", "TELECOM/MSG/OUTBOX", "EMAIL"))
+        self.assertIsNone(shift.read_status)
+        self.assertEqual(memory_full.type, "MemoryFull")
+        self.assertIsNone(memory_full.handle)
+
+    def test_parses_report_split_in_chunks(self):
+        body = event_report(*['<event type="MessageDeleted" handle="{:02X}" folder="TELECOM/MSG/INBOX" '
+                              'msg_type="SMS_GSM"/>'.format(i) for i in range(20)])
+        events = list(listing.iter_records(mapmns.EventReportParser(), [body[i:i + 7] for i in range(0, len(body), 7)]))
+        self.assertEqual([event.handle for event in events], ["{:02X}".format(i) for i in range(20)])
+
+
+class TestMailboxState(unittest.TestCase):
+
+    def setUp(self):
+        self.mailbox = mapmns.MailboxState()
+        self.mailbox.load(0, INBOX, [listing.MessageRecord("01", subject="one", read=False),
+                                     listing.MessageRecord("02", subject="two", read=True)])
+        self.mailbox.load(0, SENT, [])
+
+    def handles(self, folder, instance_id=0):
+        return [record.handle for record in self.mailbox.messages(instance_id, folder)]
+
+    def test_new_message_is_listed_first(self):
+        self.assertTrue(self.mailbox.apply(0, new_message("03", subject="three", sender_name="Bob")))
+        self.assertEqual(self.handles(INBOX), ["03", "01", "02"])
+        record = self.mailbox.messages(0, INBOX)[0]
+        self.assertEqual((record.subject, record.sender_name, record.type, record.read),
+                         ("three", "Bob", "SMS_GSM", False))
+
+    def test_new_message_of_untracked_folder_or_instance_is_ignored(self):
+        self.assertFalse(self.mailbox.apply(0, new_message("03", folder="TELECOM/MSG/OUTBOX")))
+        self.assertFalse(self.mailbox.apply(1, new_message("03")))
+        self.assertEqual(self.handles(INBOX), ["01", "02"])
+        self.assertIsNone(self.mailbox.messages(1, INBOX))
+
+    def test_message_shift_moves_the_record(self):
+        event = mapmns.Event("MessageShift", handle="01", folder="TELECOM/MSG/SENT", old_folder="TELECOM/MSG/INBOX")
+        self.assertTrue(self.mailbox.apply(0, event))
+        self.assertEqual(self.handles(INBOX), ["02"])
+        self.assertEqual([(record.handle, record.subject) for record in self.mailbox.messages(0, SENT)],
+                         [("01", "one")])
+
+    def test_message_shift_of_unknown_message_adds_a_minimal_record(self):
+        event = mapmns.Event("MessageShift", handle="09", folder="TELECOM/MSG/SENT", msg_type="EMAIL")
+        self.assertTrue(self.mailbox.apply(0, event))
+        record, = self.mailbox.messages(0, SENT)
+        self.assertEqual((record.handle, record.type, record.subject), ("09", "EMAIL", None))
+
+    def test_message_shift_to_untracked_folder_removes_the_record(self):
+        event = mapmns.Event("MessageShift", handle="02", folder="TELECOM/MSG/DELETED")
+        self.assertTrue(self.mailbox.apply(0, event))
+        self.assertEqual(self.handles(INBOX), ["01"])
+
+    def test_message_deleted(self):
+        self.assertTrue(self.mailbox.apply(0, mapmns.Event("MessageDeleted", handle="02", folder="TELECOM/MSG/INBOX")))
+        self.assertEqual(self.handles(INBOX), ["01"])
+        self.assertFalse(self.mailbox.apply(0, mapmns.Event("MessageDeleted", handle="02")))
+
+    def test_read_status_changed(self):
+        self.assertTrue(self.mailbox.apply(0, mapmns.Event("ReadStatusChanged", handle="01", read_status=True)))
+        self.assertTrue(self.mailbox.apply(0, mapmns.Event("ReadStatusChanged", handle="02", read_status=False)))
+        self.assertEqual([record.read for record in self.mailbox.messages(0, INBOX)], [True, False])
+        self.assertFalse(self.mailbox.apply(0, mapmns.Event("ReadStatusChanged", handle="09", read_status=True)))
+
+    def test_read_status_changed_without_status_keeps_the_known_one(self):
+        self.assertFalse(self.mailbox.apply(0, mapmns.Event("ReadStatusChanged", handle="02")))
+        self.assertEqual([record.read for record in self.mailbox.messages(0, INBOX)], [False, True])
+
+    def test_other_events_change_nothing(self):
+        self.assertFalse(self.mailbox.apply(0, mapmns.Event("MemoryFull")))
+        self.assertEqual(self.handles(INBOX), ["01", "02"])
+
+
+class TestMNSServer(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        self.handled = threading.Event()
+        self.server = mapmns.MNSServer("", self.handler)
+        self.listen_socket = listen_socket()
+        thread = threading.Thread(target=serve, args=(self.server, self.listen_socket))
+        thread.daemon = True
+        thread.start()
+        self.mse = client.Client("127.0.0.1", self.listen_socket.getsockname()[1])
+        self.mse.max_packet_length = 255  # reports span several PUT packets
+        self.mse.set_socket(socket.create_connection(self.listen_socket.getsockname()))
+
+    def tearDown(self):
+        self.mse.socket.close()
+        self.listen_socket.close()
+
+    def handler(self, instance_id, event):
+        self.events.append((instance_id, event))
+        if event.type == "MemoryFull":
+            self.handled.set()
+
+    def connect(self):
+        return self.mse.connect(header_list=[headers.Target(mapmns.MNS_TARGET_UUID)])
+
+    def send_report(self, body, report_type=b"x-bt/MAP-event-report", instance_id=1):
+        return self.mse.put("", body, [headers.Type(report_type),
+                                       headers.App_Parameters({"MASInstanceID": headers.MASInstanceID(instance_id)})])
+
+    def test_rejects_connect_without_mns_target(self):
+        self.mse.socket.sendall(requests.Connect((0x10, 0, 0xffff)).encode())
+        code, _ = struct.unpack(">BH", self.mse.socket.recv(3))
+        self.assertEqual(code, responses.Forbidden.code)
+
+    def test_passes_reported_events_to_handler(self):
+        self.assertIsInstance(self.connect(), responses.ConnectSuccess)
+        body = event_report(
+            '<event type="NewMessage" handle="0A" folder="TELECOM/MSG/INBOX" msg_type="SMS_GSM"/>',
+            '<event type="MessageDeleted" handle="0B" folder="TELECOM/MSG/INBOX" msg_type="SMS_GSM"/>'
+            "<!--" + "padding " * 60 + "-->",
+            '<event type="MemoryFull"/>')
+        self.assertIsInstance(self.send_report(body), responses.Success)
+        self.assertTrue(self.handled.wait(5))
+        self.assertEqual([(instance_id, event.type, event.handle) for instance_id, event in self.events],
+                         [(1, "NewMessage", "0A"), (1, "MessageDeleted", "0B"), (1, "MemoryFull", None)])
+
+    def test_rejects_other_objects_and_malformed_reports(self):
+        self.connect()
+        self.assertIsInstance(self.send_report(event_report(), b"x-bt/message"), responses.BadRequest)
+        self.assertIsInstance(self.send_report(b'<MAP-event-report version="1.1"><event type='),
+                              responses.BadRequest)
+        self.assertEqual(self.events, [])
+
+    def test_failing_handler_doesnt_fail_the_report(self):
+        def handler(instance_id, event):
+            self.handled.set()
+            raise RuntimeError("handler failed")
+        self.server.handler = handler
+        self.connect()
+        self.assertIsInstance(self.send_report(event_report('<event type="MemoryFull"/>')), responses.Success)
+        self.assertTrue(self.handled.wait(5))
+
+
+class TestMASSessionManagerEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = mapcommon.LRUCache()
+        self.manager = mapclient.MASSessionManager("00:00:00:00:00:00", message_cache=self.cache)
+        for instance_id in (0, 1):
+            sms_client = mapclient.MAPClient("00:00:00:00:00:00", instance_id + 1, message_cache=self.cache)
+            sms_client.mas_instance_id = instance_id
+            self.manager.clients[instance_id] = sms_client
+            self.cache.put((instance_id, "01", 1, 1), ({}, b"BEGIN:BMSG"))
+            self.cache.put((instance_id, "02", 1, 1), ({}, b"BEGIN:BMSG"))
+        self.manager.mailbox.load(0, INBOX, [listing.MessageRecord("01"), listing.MessageRecord("02")])
+
+    def test_event_is_applied_to_mailbox(self):
+        self.manager._on_event(0, new_message("03"))
+        self.assertEqual([record.handle for record in self.manager.mailbox.messages(0, INBOX)], ["03", "01", "02"])
+
+    def test_changed_message_is_dropped_from_cache_of_its_instance(self):
+        self.manager._on_event(0, mapmns.Event("MessageDeleted", handle="01", folder="TELECOM/MSG/INBOX"))
+        self.assertEqual(sorted(self.cache._entries), [(0, "02", 1, 1), (1, "01", 1, 1), (1, "02", 1, 1)])
+        self.assertEqual([record.handle for record in self.manager.mailbox.messages(0, INBOX)], ["02"])
+
+    def test_other_events_keep_cache(self):
+        self.manager._on_event(0, mapmns.Event("SendingSuccess", handle="01", folder="TELECOM/MSG/SENT"))
+        self.manager._on_event(5, mapmns.Event("MessageDeleted", handle="01"))
+        self.assertEqual(len(self.cache), 4)
+
+
+
+class RegisteringMSE(mapmse.MSEServer):
+    """MSE stand-in recording the notification registrations and filters it receives"""
+
+    def __init__(self, address, store):
+        mapmse.MSEServer.__init__(self, address, store)
+        self.registrations = []
+
+    def put(self, socket, request):
+        decoded_header = self._collect_request(socket, request)
+        if decoded_header["Type"] == "x-bt/MAP-NotificationRegistration":
+            param = "NotificationStatus"
+        elif decoded_header["Type"] == "x-bt/MAP-notification-filter":
+            param = "NotificationFilterMask"
+        else:
+            self.send_response(socket, responses.Bad_Request())
+            return
+        self.registrations.append((param, self._app_param(decoded_header["App_Parameters"], param),
+                                   decoded_header.get("Body")))
+        self.send_response(socket, responses.Success())
+
+
+class TestNotificationRegistration(unittest.TestCase):
+
+    def setUp(self):
+        store = mapstore.MessageStore()
+        store.add_message("telecom/msg/inbox", b"BEGIN:BMSG", type="SMS_GSM", subject="one")
+        self.mse = RegisteringMSE("", store)
+        self.mas_socket = listen_socket()
+        thread = threading.Thread(target=serve, args=(self.mse, self.mas_socket))
+        thread.daemon = True
+        thread.start()
+        map_client = mapclient.MAPClient("127.0.0.1", self.mas_socket.getsockname()[1])
+        map_client.set_socket(socket.create_connection(self.mas_socket.getsockname()))
+        self.assertIsInstance(map_client.connect(header_list=[headers.Target(mapmse.MAS_TARGET_UUID)]),
+                              responses.ConnectSuccess)
+        self.manager = mapclient.MASSessionManager("00:00:00:00:00:00")
+        self.manager.clients[0] = map_client
+
+    def tearDown(self):
+        self.manager.clients[0].socket.close()
+        self.mas_socket.close()
+
+    def test_registers_mns_and_applies_reported_events(self):
+        self.assertEqual(self.manager.track_folder(INBOX), [])
+        mns_socket = listen_socket()
+        mask = mapmns.filter_mask(mapmns.SYNC_EVENTS)
+        self.assertEqual(self.manager.start_notifications(mask, listen_socket=mns_socket), [])
+        self.assertEqual(self.mse.registrations, [("NotificationFilterMask", mask, b"0"),
+                                                  ("NotificationStatus", 1, b"0")])
+
+        # the MSE connects to the MNS and reports a new message
+        phone = client.Client("127.0.0.1", mns_socket.getsockname()[1])
+        phone.set_socket(socket.create_connection(mns_socket.getsockname()))
+        phone.connect(header_list=[headers.Target(mapmns.MNS_TARGET_UUID)])
+        report = event_report('<event type="NewMessage" handle="0000000000000002" folder="TELECOM/MSG/INBOX" '
+                              'msg_type="SMS_GSM" subject="two"/>')
+        response = phone.put("", report, [headers.Type(b"x-bt/MAP-event-report"),
+                                          headers.App_Parameters({"MASInstanceID": headers.MASInstanceID(0)})])
+        self.assertIsInstance(response, responses.Success)
+        # the MNS session handles the events before it reads the next request
+        phone.disconnect()
+        phone.socket.close()
+        self.assertEqual([record.subject for record in self.manager.mailbox.messages(0, INBOX)], ["two", "one"])
+
+        self.manager.stop_notifications()
+        self.assertEqual(self.mse.registrations[-1], ("NotificationStatus", 0, b"0"))
+        self.assertIsNone(self.manager.mns_server)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""Tests of the MSE server requests against an in-memory message store"""
+
+import socket
+import threading
+import unittest
+
+import mapclient
+import mapheaders as headers
+import maplisting as listing
+import mapmse
+import mapresponses as responses
+import mapstore
+
+INBOX = "telecom/msg/inbox"
+DELETED = "telecom/msg/deleted"
+
+
+def serve(server, sock):
+    try:
+        server.serve(sock)
+    except IOError:
+        pass  # listen socket closed by the test
+
+
+class TestMSEServer(unittest.TestCase):
+
+    def setUp(self):
+        self.store = mapstore.MessageStore()
+        self.handles = [self.store.add_message(INBOX, b"BEGIN:BMSG", type=message_type, read=read,
+                                               datetime="2026010{}T100000".format(i + 1))
+                        for i, (message_type, read) in enumerate([("SMS_GSM", 0), ("EMAIL", 1), ("SMS_GSM", 0),
+                                                                  ("MMS", 1), ("SMS_GSM", 0)])]
+        self.mas_socket = socket.socket()
+        self.mas_socket.bind(("127.0.0.1", 0))
+        self.mas_socket.listen(1)
+        thread = threading.Thread(target=serve, args=(mapmse.MSEServer("", self.store), self.mas_socket))
+        thread.daemon = True
+        thread.start()
+        self.client = mapclient.MAPClient("127.0.0.1", self.mas_socket.getsockname()[1])
+        self.client.set_socket(socket.create_connection(self.mas_socket.getsockname()))
+        self.assertIsInstance(self.client.connect(header_list=[headers.Target(mapmse.MAS_TARGET_UUID)]),
+                              responses.ConnectSuccess)
+        self.client.set_msg_folder_path("/telecom/msg")
+
+    def tearDown(self):
+        self.client.socket.close()
+        self.mas_socket.close()
+
+    def listed(self, folder="inbox", **params):
+        response = self.client.get_messages_listing(folder, **params)
+        records = listing.iter_records(listing.MessagesListingParser(), [response[1]])
+        return [self.handles.index(record.handle) for record in records]
+
+    def test_messages_listing_paging(self):
+        self.assertEqual(self.listed(), [4, 3, 2, 1, 0])
+        self.assertEqual(self.listed(max_list_count=2), [4, 3])
+        self.assertEqual(self.listed(max_list_count=2, list_startoffset=2), [2, 1])
+        self.assertEqual(self.listed(max_list_count=2, list_startoffset=4), [0])
+
+    def test_walk_messages_listing_reports_listing_size(self):
+        completed = []
+        records = list(self.client.walk_messages_listing("inbox", page_size=2, on_complete=completed.append))
+        self.assertEqual([self.handles.index(record.handle) for record in records], [4, 3, 2, 1, 0])
+        self.assertEqual(completed, [5])
+
+    def test_failed_walk_is_not_completed(self):
+        completed = []
+        self.assertEqual(list(self.client.walk_messages_listing("nothere", on_complete=completed.append)), [])
+        self.assertEqual(completed, [])
+
+    def test_messages_listing_filters(self):
+        self.assertEqual(self.listed(filter_messageType=0x01), [3, 1])
+        self.assertEqual(self.listed(filter_readStatus=1), [4, 2, 0])
+        self.assertEqual(self.listed(filter_readStatus=2, filter_messageType=0x08), [1])
+        self.assertEqual(self.listed(filter_readStatus=1, max_list_count=1, list_startoffset=1), [2])
+
+    def test_messages_listing_of_unknown_folder(self):
+        self.assertIsNone(self.client.get_messages_listing("nothere"))
+
+    def test_set_read_status(self):
+        self.assertIsInstance(self.client.set_msg_status(self.handles[0], 0, 1), responses.Success)
+        self.assertEqual(self.listed(filter_readStatus=2), [3, 1, 0])
+        self.assertIsInstance(self.client.set_msg_status(self.handles[0], 0, 0), responses.Success)
+        self.assertEqual(self.listed(filter_readStatus=2), [3, 1])
+
+    def test_delete_and_undelete(self):
+        self.assertIsInstance(self.client.set_msg_status(self.handles[2], 1, 1), responses.Success)
+        self.assertEqual(self.listed(), [4, 3, 1, 0])
+        self.assertEqual(self.listed("deleted"), [2])
+        self.assertIsInstance(self.client.set_msg_status(self.handles[2], 1, 0), responses.Success)
+        self.assertEqual(self.listed(), [4, 3, 2, 1, 0])
+        self.assertEqual(self.listed("deleted"), [])
+
+    def test_status_of_unknown_message(self):
+        self.assertIsNone(self.client.set_msg_status("00000000000000FF", 0, 1))
+
+    def test_unknown_optional_header_is_ignored(self):
+        response = self.client.get(header_list=[headers.Type(b"x-obex/folder-listing"),
+                                                headers.Description("listing please")])
+        records = listing.iter_records(listing.FolderListingParser(), [response[1]])
+        self.assertEqual(sorted(record.name for record in records), ["deleted", "draft", "inbox", "outbox", "sent"])
+        # the session is still served
+        self.assertEqual(self.listed(max_list_count=1), [4])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""Tests of the SQLite message store of the MSE server"""
+
+import unittest
+
+import mapstore
+
+INBOX = "telecom/msg/inbox"
+DELETED = "telecom/msg/deleted"
+
+
+class TestMessageStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = mapstore.MessageStore()
+        self.handles = [
+            self.store.add_message(INBOX, b"1", type="SMS_GSM", datetime="20260101T100000", sender_name="Alice"),
+            self.store.add_message(INBOX, b"2", type="EMAIL", datetime="20260102T100000", sender_name="Bob",
+                                   read=1, priority=1),
+            self.store.add_message(INBOX, b"3", type="MMS", datetime="20260103T100000", sender_name="100%_Carol"),
+            self.store.add_message(INBOX, b"4", type="SMS_GSM", datetime="20260104T100000", sender_name="Dave",
+                                   recipient_addressing="+4912345"),
+        ]
+
+    def listed(self, folder=INBOX, offset=0, limit=None, **filters):
+        count, entries = self.store.list_messages(folder, offset, limit, **filters)
+        return count, [self.handles.index(entry["handle"]) for entry in entries]
+
+    def test_lists_newest_first(self):
+        self.assertEqual(self.listed(), (4, [3, 2, 1, 0]))
+
+    def test_paging(self):
+        self.assertEqual(self.listed(offset=1, limit=2), (4, [2, 1]))
+        self.assertEqual(self.listed(offset=3, limit=2), (4, [0]))
+        self.assertEqual(self.listed(offset=4, limit=2), (4, []))
+        self.assertEqual(self.listed(limit=0), (4, []))
+
+    def test_message_type_filter(self):
+        self.assertEqual(self.listed(message_type=0x01), (2, [2, 1]))  # no SMS_GSM
+        self.assertEqual(self.listed(message_type=0x1F), (0, []))
+
+    def test_period_filter(self):
+        self.assertEqual(self.listed(period_begin="20260102T000000", period_end="20260104T000000"), (2, [2, 1]))
+
+    def test_read_status_and_priority_filters(self):
+        self.assertEqual(self.listed(read_status=1), (3, [3, 2, 0]))
+        self.assertEqual(self.listed(read_status=2), (1, [1]))
+        self.assertEqual(self.listed(priority=1), (1, [1]))
+        self.assertEqual(self.listed(priority=2), (3, [3, 2, 0]))
+
+    def test_originator_and_recipient_filters(self):
+        self.assertEqual(self.listed(originator="alice"), (1, [0]))
+        self.assertEqual(self.listed(originator="*o*"), (2, [2, 1]))
+        self.assertEqual(self.listed(originator="100%_*"), (1, [2]))
+        self.assertEqual(self.listed(originator="100*"), (1, [2]))
+        self.assertEqual(self.listed(originator="1000*"), (0, []))
+        self.assertEqual(self.listed(recipient="+49*"), (1, [3]))
+
+    def test_filters_combined_with_paging(self):
+        self.assertEqual(self.listed(offset=1, limit=1, read_status=1), (3, [2]))
+
+    def test_set_read(self):
+        version = self.store.folder_version(INBOX)
+        self.assertTrue(self.store.set_read(self.handles[0], True))
+        self.assertEqual(self.listed(read_status=2), (2, [1, 0]))
+        self.assertNotEqual(self.store.folder_version(INBOX), version)
+        self.assertFalse(self.store.set_read("00000000000000FF", True))
+        self.assertTrue(self.store.has_unread(INBOX))
+
+    def test_delete_moves_to_deleted_then_removes(self):
+        inbox_version, deleted_version = self.store.folder_version(INBOX), self.store.folder_version(DELETED)
+        self.assertTrue(self.store.delete_message(self.handles[1]))
+        self.assertEqual(self.listed(), (3, [3, 2, 0]))
+        self.assertEqual(self.listed(DELETED), (1, [1]))
+        self.assertNotEqual(self.store.folder_version(INBOX), inbox_version)
+        self.assertNotEqual(self.store.folder_version(DELETED), deleted_version)
+
+        self.assertTrue(self.store.delete_message(self.handles[1]))
+        self.assertEqual(self.listed(DELETED), (0, []))
+        self.assertIsNone(self.store.get_message(self.handles[1]))
+        self.assertFalse(self.store.delete_message(self.handles[1]))
+
+    def test_undelete(self):
+        self.store.delete_message(self.handles[0])
+        self.assertTrue(self.store.undelete_message(self.handles[0]))
+        self.assertEqual(self.listed(), (4, [3, 2, 1, 0]))
+        self.assertEqual(self.store.get_message(self.handles[0]), b"1")
+
+    def test_folders(self):
+        self.assertTrue(self.store.folder_exists("/telecom/msg/"))
+        self.assertFalse(self.store.folder_exists("telecom/nothere"))
+        self.assertEqual(self.store.list_folders("telecom/msg", 1, 2),
+                         (5, sorted(["inbox", "outbox", "sent", "deleted", "draft"])[1:3]))
@@ -0,0 +1,107 @@
+# Copyright (c) 2018 Kannan Subramani <Kannan.Subramani@bmw.de>
+# SPDX-License-Identifier: GPL-3.0
+# -*- coding: utf-8 -*-
+"""Tests of the delta sync of MAP folders"""
+
+import unittest
+
+import maplisting as listing
+import mapsync
+
+DEVICE = "00:00:00:00:00:00"
+INBOX = "/telecom/msg/inbox"
+
+
+class FakeClient(object):
+    """MAPClient stand-in listing the messages of its inbox attribute.
+    A walk fails after fail_after entries if set."""
+
+    def __init__(self):
+        self.address = DEVICE
+        self.mas_instance_id = 0
+        self.current_dir = "/telecom/msg"
+        self.database_id = "0" * 32
+        self.folder_version = "1".zfill(32)
+        self.inbox = []
+        self.fail_after = None
+        self.listing_size = None
+        self.walks = 0
+
+    def get_listing_versions(self, name):
+        return {"ListingSize": len(self.inbox) if self.listing_size is None else self.listing_size,
+                "NewMessage": 0, "DatabaseIdentifier": self.database_id,
+                "FolderVersionCounter": self.folder_version}
+
+    def walk_messages_listing(self, name, page_size=1024, fields=None, on_complete=None):
+        self.walks += 1
+        for index, record in enumerate(self.inbox):
+            if index == self.fail_after:
+                return
+            yield record
+        if on_complete is not None:
+            on_complete(len(self.inbox))
+
+
+def message(handle, subject="hi", read=False):
+    return listing.MessageRecord(handle, subject=subject, datetime="20260101T100000", type="SMS_GSM", read=read)
+
+
+class TestDeltaSync(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeClient()
+        self.client.inbox = [message("01"), message("02"), message("03")]
+        self.state = mapsync.SyncState()
+        self.sync = mapsync.DeltaSync(self.client, self.state)
+        self.assertEqual(self.sync.sync_folder("inbox"),
+                         mapsync.FolderDelta(INBOX, ["01", "02", "03"], [], [], False))
+
+    def tearDown(self):
+        self.state.close()
+
+    def test_unchanged_folder_is_not_listed(self):
+        self.client.inbox.append(message("04"))  # not reflected in the version counter
+        self.assertEqual(self.sync.sync_folder("inbox"), mapsync.FolderDelta(INBOX, [], [], [], False))
+        self.assertEqual(self.client.walks, 1)
+
+    def test_changed_folder(self):
+        self.client.inbox = [message("04"), message("01", read=True), message("03")]
+        self.client.folder_version = "2".zfill(32)
+        self.assertEqual(self.sync.sync_folder("inbox"), mapsync.FolderDelta(INBOX, ["04"], ["02"], ["01"], False))
+        self.assertEqual(self.state.versions(DEVICE, 0, INBOX), (self.client.database_id, self.client.folder_version))
+        self.assertEqual(sorted(self.state.snapshot(DEVICE, 0, INBOX)), ["01", "03", "04"])
+
+    def test_new_database_identifier_syncs_from_scratch(self):
+        self.client.database_id = "F" * 32
+        self.client.inbox = [message("01", subject="reused handle")]
+        self.assertEqual(self.sync.sync_folder("inbox"), mapsync.FolderDelta(INBOX, ["01"], [], [], True))
+        self.assertEqual(self.state.database_ids(DEVICE, 0), {"F" * 32})
+
+    def test_failed_listing_is_not_saved(self):
+        self.client.inbox = [message("04"), message("01"), message("02"), message("03")]
+        self.client.folder_version = "2".zfill(32)
+        self.client.fail_after = 2
+        self.assertIsNone(self.sync.sync_folder("inbox"))
+        self.assertEqual(self.state.versions(DEVICE, 0, INBOX), (self.client.database_id, "1".zfill(32)))
+        self.assertEqual(sorted(self.state.snapshot(DEVICE, 0, INBOX)), ["01", "02", "03"])
+
+        self.client.fail_after = None
+        self.assertEqual(self.sync.sync_folder("inbox"), mapsync.FolderDelta(INBOX, ["04"], [], [], False))
+
+    def test_listing_short_of_listing_size_is_not_saved(self):
+        self.client.inbox = [message("01"), message("03")]
+        self.client.listing_size = 3  # a message moved between pages and was skipped
+        self.client.folder_version = "2".zfill(32)
+        self.assertIsNone(self.sync.sync_folder("inbox"))
+        self.assertEqual(sorted(self.state.snapshot(DEVICE, 0, INBOX)), ["01", "02", "03"])
+
+    def test_counters_of_old_mse(self):
+        self.client.database_id = self.client.folder_version = None
+        self.client.inbox.pop()
+        self.assertEqual(self.sync.sync_folder("inbox"), mapsync.FolderDelta(INBOX, [], ["03"], [], False))
+        self.assertEqual(self.sync.sync_folder("inbox"), mapsync.FolderDelta(INBOX, [], [], [], False))
+        self.assertEqual(self.client.walks, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()